@@ -0,0 +1,104 @@
+"""Compress large responses with brotli or gzip, as the client accepts.
+
+Only the content types of COMPRESSION_CONTENT_TYPES are compressed, so HTML
+pages reflecting input next to the CSRF token are never open to BREACH.
+Brotli is preferred when the optional `brotli` package is installed.
+"""
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+QUALITY_PARAM = re.compile(r'\bq=([0-9.]+)')
+
+
+def accepted_encodings(header):
+    """Map the codings of an Accept-Encoding header to their quality."""
+    encodings = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        match = QUALITY_PARAM.search(params)
+        try:
+            quality = float(match.group(1)) if match else 1.0
+        except ValueError:
+            quality = 0.0
+        encodings[coding.strip().lower()] = quality
+    return encodings
+
+
+def choose_encoding(header):
+    """Pick the content coding for a response, None to send it as is."""
+    encodings = accepted_encodings(header)
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if encodings.get(coding, encodings.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def compress(coding, content):
+    if coding == 'br':
+        return brotli.compress(content, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    return compress_string(content)
+
+
+def compress_stream(coding, sequence):
+    if coding != 'br':
+        return compress_sequence(sequence)
+    return brotli_sequence(sequence)
+
+
+def brotli_sequence(sequence):
+    """Compress a stream, flushing each chunk so the client gets it right away."""
+    compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+    for chunk in sequence:
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compressible(response):
+    """Whether the content type of a response is one to compress."""
+    content_type = response.get('Content-Type', '').partition(';')[0].strip().lower()
+    return content_type in settings.COMPRESSION_CONTENT_TYPES
+
+
+class CompressionMiddleware(object):
+    """Compress API and export responses of at least COMPRESSION_MIN_SIZE bytes, and streams."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or not compressible(response):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        coding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if coding is None:
+            return response
+        if response.streaming:
+            response.streaming_content = compress_stream(coding, response.streaming_content)
+            # The compressed length is not known in advance.
+            del response['Content-Length']
+        else:
+            content = compress(coding, response.content)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+        # A strong ETag names the exact bytes, the compressed ones differ.
+        if response.get('ETag', '').startswith('"'):
+            response['ETag'] = 'W/' + response['ETag']
+        response['Content-Encoding'] = coding
+        return response
@@ -0,0 +1,89 @@
+"""Conditional GET for viewsets, answering 304 before anything is serialized.
+
+The validators of a response come from one aggregate query over the rows it
+shows: the latest `date_changed` of the rows and of the related rows they
+nest, the number of rows, and of nested rows that can be removed.
+"""
+import hashlib
+from calendar import timegm
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date
+
+
+class ConditionalGetMixin(object):
+    """Weak ETag and Last-Modified validators for read actions.
+
+    Actions call `not_modified` with the queryset they are about to
+    serialize and return its 304 response when there is one.
+    """
+    # Timestamps bumped whenever a row, or what it nests, changes.
+    last_modified_fields = ('date_changed',)
+    validators = None
+
+    def get_validators(self, queryset, fields=None, key=None, counts=()):
+        """Get the (ETag, Last-Modified timestamp) of a queryset, None when empty.
+
+        `counts` are nested relations whose rows are counted as well, deleting
+        one of them bumps no timestamp.
+        """
+        fields = fields or self.last_modified_fields
+        aggregates = dict(('last_modified_%s' % index, Max(field)) for index, field in enumerate(fields))
+        nested = dict(('count_%s' % index, Count(field, distinct=True)) for index, field in enumerate(counts))
+        # Rows repeat across joined related rows.
+        values = queryset.order_by().aggregate(
+            count=Count('pk', distinct=len(fields) > 1 or bool(counts)), **dict(aggregates, **nested))
+        count = values.pop('count')
+        nested_counts = [values.pop(name) for name in sorted(nested)]
+        changes = [value for value in values.values() if value is not None]
+        if not count or not changes:
+            return None
+        last_modified = max(changes)
+        request = self.request
+        renderer = getattr(request, 'accepted_renderer', None)
+        # The same URL shows each user their own rows, in the negotiated format.
+        tag = hashlib.md5(force_bytes(':'.join(str(part) for part in [
+            request.user.pk, renderer.format if renderer else '', count, last_modified.isoformat(), key
+        ] + nested_counts)))
+        return 'W/"%s"' % tag.hexdigest(), timegm(last_modified.utctimetuple())
+
+    def not_modified(self, request, queryset, fields=None, key=None, counts=()):
+        """Get a 304 response when the client already has the current rows, None otherwise."""
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        self.validators = self.get_validators(queryset, fields, key, counts)
+        if self.validators is None:
+            return None
+        etag, last_modified = self.validators
+        return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).finalize_response(request, response, *args, **kwargs)
+        if self.validators and (200 <= response.status_code < 300 or response.status_code == 304):
+            etag, last_modified = self.validators
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            # Revalidate every time instead of guessing a freshness from Last-Modified.
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class ConditionalModelMixin(ConditionalGetMixin):
+    """Conditional `list` and `retrieve` of a generic viewset."""
+
+    def list(self, request, *args, **kwargs):
+        response = self.not_modified(request, self.filter_queryset(self.get_queryset()))
+        if response is not None:
+            return response
+        return super(ConditionalModelMixin, self).list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        response = self.not_modified(request, queryset)
+        if response is not None:
+            return response
+        return super(ConditionalModelMixin, self).retrieve(request, *args, **kwargs)
@@ -0,0 +1,66 @@
+"""Send reads to replicas and writes to the primary database.
+
+Only safe requests read from `DATABASE_REPLICAS`. A request that writes
+reads from the primary from then on, and the client stays pinned to the
+primary for `REPLICA_PIN_SECONDS` through a cookie, so users always see
+their own writes. Code running outside a request, such as management
+commands, always uses the primary. Sessions always live on the primary and
+saving one never pins the client.
+"""
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+PIN_COOKIE = 'pin_primary'
+# Read and written on the primary only, their writes do not pin the client.
+PRIMARY_APPS = ('sessions',)
+
+_state = threading.local()
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if model._meta.app_label in PRIMARY_APPS:
+            return DEFAULT_DB_ALIAS
+        if not replicas or not getattr(_state, 'use_replicas', False):
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # Reads inside a transaction belong with its writes.
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in PRIMARY_APPS:
+            _state.use_replicas = False
+            _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set([DEFAULT_DB_ALIAS] + list(settings.DATABASE_REPLICAS))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaPinningMiddleware(object):
+    """Let safe requests read from replicas unless the client wrote recently."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.use_replicas = request.method in SAFE_METHODS and PIN_COOKIE not in request.COOKIES
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            if _state.wrote and settings.DATABASE_REPLICAS:
+                response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True)
+            return response
+        finally:
+            _state.use_replicas = False
+            _state.wrote = False
@@ -1,7 +1,71 @@
-from rest_framework.pagination import PageNumberPagination
+from collections import OrderedDict
+
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class CursorResultsSetPagination(CursorPagination):
+    """Keyset pagination, deep pages cost the same as the first one."""
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    count_query_param = 'count'
+
+    def __init__(self, ordering):
+        self.ordering = ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # Counting is optional, pass `count=false` to skip it.
+        self.count = None
+        if request.query_params.get(self.count_query_param) != 'false':
+            self.count = queryset.count()
+        return super(CursorResultsSetPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
 
 
 class StandardResultsSetPagination(PageNumberPagination):
+    """Page number pagination, or cursor pagination on request.
+
+    Views declaring a `cursor_ordering` switch to cursor pagination when
+    called with `pagination=cursor` or a `cursor`.
+    """
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 100
+    cursor_paginator = None
+
+    def use_cursor(self, request, view):
+        params = request.query_params
+        return getattr(view, 'cursor_ordering', None) and (
+            params.get('pagination') == 'cursor' or CursorPagination.cursor_query_param in params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_cursor(request, view):
+            self.cursor_paginator = CursorResultsSetPagination(view.cursor_ordering)
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        return super(StandardResultsSetPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super(StandardResultsSetPagination, self).get_paginated_response(data)
+
+
+class OptionalResultsSetPagination(StandardResultsSetPagination):
+    """Paginate only when a page, page size or cursor is requested."""
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if not any(param in params for param in (
+                self.page_query_param, self.page_size_query_param,
+                'pagination', CursorPagination.cursor_query_param)):
+            return None
+        return super(OptionalResultsSetPagination, self).paginate_queryset(queryset, request, view)
@@ -0,0 +1,22 @@
+"""JSON parsing through simplejson, reading fractional numbers as Decimal."""
+import simplejson
+from django.conf import settings
+from django.utils import six
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from fremancer.renderers import SimpleJSONRenderer
+
+
+class SimpleJSONParser(JSONParser):
+    """The JSON parser, amounts such as `0.1` are read without float rounding."""
+    renderer_class = SimpleJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            return simplejson.loads(
+                stream.read().decode(encoding), use_decimal=True, allow_nan=not self.strict)
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % six.text_type(exc))
@@ -0,0 +1,45 @@
+"""JSON rendering through simplejson and its C speedups.
+
+Decimal values are written exactly rather than through float, every other
+type is encoded as the REST framework encoder does it.
+"""
+import simplejson
+from rest_framework.compat import INDENT_SEPARATORS, LONG_SEPARATORS, SHORT_SEPARATORS
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+# Dates, times, UUIDs, lazy strings, querysets and the like.
+default = encoders.JSONEncoder().default
+
+
+def reject_constant(constant):
+    raise ValueError('Out of range values are not JSON compliant: %s' % constant)
+
+
+def dumps(data, ensure_ascii=False, allow_nan=False, separators=SHORT_SEPARATORS, indent=None):
+    ret = simplejson.dumps(
+        data, ensure_ascii=ensure_ascii, allow_nan=allow_nan, separators=separators, indent=indent,
+        use_decimal=True, namedtuple_as_object=False, default=default)
+    # simplejson before 4.0 writes Decimal NaN and Infinity whatever allow_nan says,
+    # the rare output that may hold one is parsed again to be sure.
+    if not allow_nan and ('NaN' in ret or 'Infinity' in ret):
+        simplejson.loads(ret, parse_constant=reject_constant)
+    return ret
+
+
+class SimpleJSONRenderer(JSONRenderer):
+    """The JSON renderer, encoding with simplejson."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is None:
+            separators = SHORT_SEPARATORS if self.compact else LONG_SEPARATORS
+        else:
+            separators = INDENT_SEPARATORS
+        ret = dumps(data, ensure_ascii=self.ensure_ascii, allow_nan=not self.strict,
+                    separators=separators, indent=indent)
+        # Keep the output a strict JavaScript subset.
+        ret = ret.replace(u'\u2028', u'\\u2028').replace(u'\u2029', u'\\u2029')
+        return ret.encode('utf-8')
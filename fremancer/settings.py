@@ -22,6 +22,12 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = ''
 STRIPE_KEY = ''
+STRIPE_WEBHOOK_SECRET = ''  # Signing secret of the webhook endpoint, whsec_...
+STRIPE_TIMEOUT = (3.05, 15)  # Connect and read timeouts in seconds.
+STRIPE_MAX_RETRIES = 2
+STRIPE_POOL_SIZE = 10
+STRIPE_CIRCUIT_FAILURES = 5
+STRIPE_CIRCUIT_RESET = 30  # Seconds.
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -45,7 +51,8 @@ INSTALLED_APPS = [
     'fremancer_contracts',
     'fremancer_timesheets',
     'fremancer_invoices',
-    'fremancer_withdrawals'
+    'fremancer_withdrawals',
+    'fremancer_reports'
 ]
 
 REST_FRAMEWORK = {
@@ -58,19 +65,37 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'fremancer.pagination.StandardResultsSetPagination',
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
+    'DEFAULT_RENDERER_CLASSES': (
+        'fremancer.renderers.SimpleJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'fremancer.parsers.SimpleJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'PAGE_SIZE': 10
 }
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'fremancer.compression.CompressionMiddleware',
+    'fremancer.db_router.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'fremancer_users.middleware.MembershipMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Smaller bodies are not worth the compression work.
+COMPRESSION_MIN_SIZE = 1024  # Bytes.
+COMPRESSION_BROTLI_QUALITY = 5  # Of 11, fast enough for dynamic responses.
+# API data and exports only, pages carrying the CSRF token are never compressed (BREACH).
+COMPRESSION_CONTENT_TYPES = ('application/json', 'application/x-ndjson', 'text/csv')
+
 ROOT_URLCONF = 'fremancer.urls'
 
 TEMPLATES = [
@@ -101,6 +126,15 @@ DATABASES = {
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
     }
 }
+# Read replicas are the other aliases, for example a SQLite copy locally:
+# DATABASES['replica1'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, 'db.replica1.sqlite3'),
+#     'TEST': {'MIRROR': 'default'},
+# }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['fremancer.db_router.ReplicaRouter']
+REPLICA_PIN_SECONDS = 5  # Reads stay on the primary this long after a write.
 
 
 # Password validation
@@ -0,0 +1,33 @@
+"""Stream large querysets as JSON without holding them in memory."""
+from django.http import StreamingHttpResponse
+
+from fremancer.renderers import dumps
+
+CHUNK_SIZE = 100
+
+
+def encode(data):
+    return dumps(data).encode('utf-8')
+
+
+def iter_json(queryset, serializer_class, chunk_size=CHUNK_SIZE):
+    """Yield a JSON array of the serialized rows, a chunk of rows at a time."""
+    yield b'['
+    rows = []
+    first = True
+    for instance in queryset.iterator():
+        rows.append(encode(serializer_class(instance).data))
+        if len(rows) >= chunk_size:
+            yield (b'' if first else b',') + b','.join(rows)
+            rows = []
+            first = False
+    if rows:
+        yield (b'' if first else b',') + b','.join(rows)
+    yield b']'
+
+
+def stream_json(queryset, serializer_class, chunk_size=CHUNK_SIZE):
+    """Respond with the rows of a queryset read through a server-side cursor."""
+    return StreamingHttpResponse(
+        iter_json(queryset, serializer_class, chunk_size),
+        content_type='application/json')
@@ -0,0 +1,402 @@
+"""Loopback HTTP stand-in for the Stripe endpoints the payments code uses.
+
+Serves customers, sources, tokens, charges and events from memory with
+configurable latency and failure injection, so the payment paths can be
+tested and benchmarked offline:
+
+    emulator = StripeEmulator(latency=0.05).start()
+    emulator.add_customer('cus_1', sources=[{'id': 'card_1', 'object': 'card'}])
+    ...
+    emulator.stop()
+"""
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+import stripe
+from django.utils import six
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qsl, urlparse
+
+FAILURES = {
+    'error': (500, 'api_error', 'An unexpected error occurred.'),
+    'rate_limit': (429, 'rate_limit_error', 'Too many requests hit the API too quickly.'),
+}
+TEST_CARDS = {
+    'tok_visa': 'Visa',
+    'tok_mastercard': 'MasterCard',
+    'tok_amex': 'American Express',
+    'tok_chargeDeclined': 'Visa',
+}
+
+
+class StripeError(Exception):
+
+    def __init__(self, status, error_type, message, code=None, **fields):
+        super(StripeError, self).__init__(message)
+        self.status = status
+        self.body = {'error': dict(fields, type=error_type, message=message, code=code)}
+
+
+def not_found(kind, object_id):
+    return StripeError(404, 'invalid_request_error', 'No such %s: %s' % (kind, object_id), 'resource_missing')
+
+
+def parse_params(query):
+    """Decode Stripe form encoding such as `metadata[key]=1&amounts[0]=32`."""
+    params = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        names = re.findall(r'[^\[\]]+', key)
+        node = params
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+        node[names[-1]] = value
+    return lists(params)
+
+
+def lists(node):
+    if not isinstance(node, dict):
+        return node
+    if node and all(key.isdigit() for key in node):
+        return [lists(node[key]) for key in sorted(node, key=int)]
+    return dict((key, lists(value)) for key, value in node.items())
+
+
+def new_id(prefix):
+    return '%s_%s' % (prefix, uuid.uuid4().hex[:14])
+
+
+def signed_event(event, secret):
+    """Get the body and Stripe-Signature header Stripe sends an event with."""
+    payload = event if isinstance(event, six.string_types) else json.dumps(event)
+    timestamp = int(time.time())
+    signature = stripe.WebhookSignature._compute_signature('%d.%s' % (timestamp, payload), secret)
+    return payload, 't=%d,v1=%s' % (timestamp, signature)
+
+
+class StripeEmulator(object):
+    """In-memory Stripe account served over HTTP on the loopback interface.
+
+    `latency` and `jitter` delay every response by seconds. `failure_rate`
+    fails that fraction of requests with `failure_mode`: 'reset' drops the
+    connection, 'error' answers 500 and 'rate_limit' answers 429.
+    """
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0, failure_mode='reset'):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.lock = threading.RLock()
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        """Forget every object and request."""
+        with self.lock:
+            self.customers = {}
+            self.sources = {}
+            self.tokens = {}
+            self.charges = []
+            self.events = []
+            self.idempotent_responses = {}
+            self.requests = []
+            self.failures = []
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    def start(self):
+        """Serve in a background thread and point the Stripe SDK here."""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StripeRequestHandler)
+        self.server.emulator = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.previous = stripe.api_base, stripe.api_key
+        stripe.api_base = self.url
+        stripe.api_key = stripe.api_key or 'sk_test_emulator'
+        return self
+
+    def stop(self):
+        stripe.api_base, stripe.api_key = self.previous
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_connections()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count=1, mode='reset'):
+        """Fail the next requests regardless of the failure rate."""
+        with self.lock:
+            self.failures.extend([mode] * count)
+
+    def next_failure(self):
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+        if self.failure_rate and random.random() < self.failure_rate:
+            return self.failure_mode
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def add_customer(self, customer_id=None, sources=(), **fields):
+        """Seed a customer and its sources."""
+        with self.lock:
+            customer = dict(fields, id=customer_id or new_id('cus'), object='customer',
+                            created=int(time.time()), sources=[])
+            self.customers[customer['id']] = customer
+            for source in sources:
+                self.attach(customer, dict(source))
+            return customer
+
+    def attach(self, customer, source):
+        source.setdefault('id', new_id('card'))
+        source.setdefault('object', 'card')
+        source['customer'] = customer['id']
+        self.sources[source['id']] = source
+        customer['sources'].append(source['id'])
+        if not customer.get('default_source'):
+            customer['default_source'] = source['id']
+        self.emit('customer.source.created', source)
+        return source
+
+    def emit(self, event_type, obj):
+        self.events.append({
+            'id': new_id('evt'),
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'data': {'object': json.loads(json.dumps(self.public(obj)))},
+        })
+
+    def pop_events(self):
+        """Remove and return the events not delivered yet."""
+        with self.lock:
+            events, self.events = self.events, []
+            return events
+
+    def source_from_token(self, token):
+        if token in TEST_CARDS:
+            return {
+                'id': new_id('card'), 'object': 'card', 'brand': TEST_CARDS[token],
+                'last4': '0341' if token == 'tok_chargeDeclined' else '4444',
+                'exp_month': 8, 'exp_year': 2030, 'name': None,
+                'declines': token == 'tok_chargeDeclined',
+            }
+        if token in self.tokens:
+            return self.tokens.pop(token)
+        raise not_found('token', token)
+
+    def customer(self, customer_id):
+        if customer_id not in self.customers:
+            raise not_found('customer', customer_id)
+        return self.customers[customer_id]
+
+    def source_list(self, customer, params):
+        sources = [self.sources[source_id] for source_id in customer['sources']]
+        if params.get('object'):
+            sources = [source for source in sources if source['object'] == params['object']]
+        return self.page(sources, params, '/v1/customers/%s/sources' % customer['id'])
+
+    def page(self, items, params, url):
+        total_count = len(items)
+        if params.get('starting_after'):
+            ids = [item['id'] for item in items]
+            items = items[ids.index(params['starting_after']) + 1:]
+        limit = int(params.get('limit') or 10)
+        return {
+            'object': 'list', 'url': url, 'total_count': total_count,
+            'data': [self.public(item) for item in items[:limit]], 'has_more': len(items) > limit,
+        }
+
+    def public(self, obj):
+        if obj.get('object') == 'customer' and not obj.get('deleted'):
+            return dict(obj, sources=self.source_list(obj, {'limit': 100}))
+        return dict((key, value) for key, value in obj.items() if key != 'declines')
+
+    def handle(self, method, path, params):
+        """Route one API request, returning the object to answer with."""
+        parts = path.strip('/').split('/')[1:]
+        resource, rest = parts[0], parts[1:]
+        if resource == 'customers':
+            return self.handle_customers(method, rest, params)
+        if resource == 'charges':
+            return self.handle_charges(method, rest, params)
+        if resource == 'sources' and method == 'GET' and rest:
+            source = self.sources.get(rest[0])
+            if source is None or source['object'] != 'source':
+                raise not_found('source', rest[0])
+            return source
+        if resource == 'tokens' and method == 'POST':
+            bank_account = dict(params.get('bank_account', {}))
+            number = bank_account.pop('account_number', '')
+            bank_account.update(id=new_id('ba'), object='bank_account', last4=number[-4:],
+                                bank_name='STRIPE TEST BANK', status='new')
+            token = {'id': new_id('btok'), 'object': 'token', 'type': 'bank_account',
+                     'bank_account': bank_account}
+            self.tokens[token['id']] = bank_account
+            return token
+        if resource == 'events' and method == 'GET':
+            return self.page(self.events, params, '/v1/events')
+        raise StripeError(404, 'invalid_request_error', 'Unrecognized request URL (%s: %s)' % (method, path))
+
+    def handle_customers(self, method, rest, params):
+        if not rest:
+            if method == 'GET':
+                return self.page(list(self.customers.values()), params, '/v1/customers')
+            customer = self.add_customer(email=params.get('email'), description=params.get('description'))
+            if params.get('source'):
+                self.attach(customer, self.source_from_token(params['source']))
+            self.emit('customer.created', customer)
+            return customer
+        customer = self.customer(rest[0])
+        if len(rest) == 1:
+            if method == 'DELETE':
+                for source_id in customer['sources']:
+                    self.sources.pop(source_id, None)
+                del self.customers[customer['id']]
+                return {'id': customer['id'], 'object': 'customer', 'deleted': True}
+            return customer
+        if len(rest) == 2:
+            if method == 'GET':
+                return self.source_list(customer, params)
+            return self.attach(customer, self.source_from_token(params.get('source') or params.get('card')))
+        source_id = rest[2]
+        if source_id not in customer['sources']:
+            raise not_found('source', source_id)
+        source = self.sources[source_id]
+        if len(rest) == 4 and rest[3] == 'verify':
+            if [int(amount) for amount in params.get('amounts', [])] != [32, 45]:
+                raise StripeError(400, 'invalid_request_error', 'The amounts provided do not match.')
+            source['status'] = 'verified'
+            return source
+        if method == 'DELETE':
+            customer['sources'].remove(source_id)
+            del self.sources[source_id]
+            self.emit('customer.source.deleted', source)
+            return {'id': source_id, 'object': source['object'], 'deleted': True}
+        return source
+
+    def handle_charges(self, method, rest, params):
+        if rest:
+            for charge in self.charges:
+                if charge['id'] == rest[0]:
+                    return charge
+            raise not_found('charge', rest[0])
+        if method == 'GET':
+            charges = list(reversed(self.charges))
+            created = params.get('created') or {}
+            if 'gte' in created:
+                charges = [charge for charge in charges if charge['created'] >= int(created['gte'])]
+            return self.page(charges, params, '/v1/charges')
+        customer = self.customer(params.get('customer'))
+        source_id = params.get('source') or customer.get('default_source')
+        if source_id not in customer['sources']:
+            raise not_found('source', source_id)
+        source = self.sources[source_id]
+        charge = {
+            'id': new_id('ch'), 'object': 'charge', 'amount': int(params.get('amount', 0)),
+            'currency': params.get('currency', 'usd'), 'customer': customer['id'],
+            'description': params.get('description'), 'metadata': params.get('metadata', {}),
+            'source': self.public(source), 'created': int(time.time()), 'refunded': False,
+        }
+        if source.get('declines'):
+            charge.update(paid=False, status='failed')
+            self.charges.append(charge)
+            self.emit('charge.failed', charge)
+            raise StripeError(402, 'card_error', 'Your card was declined.', 'card_declined', charge=charge['id'])
+        # Bank debits settle later, like ACH payments on Stripe.
+        pending = source['object'] == 'bank_account'
+        charge.update(paid=not pending, status='pending' if pending else 'succeeded')
+        self.charges.append(charge)
+        self.emit('charge.pending' if pending else 'charge.succeeded', charge)
+        return charge
+
+    def respond(self, method, path, params, idempotency_key=None):
+        """Answer a request as (status, body), replaying idempotent responses."""
+        with self.lock:
+            self.requests.append((method, path, idempotency_key))
+            if idempotency_key in self.idempotent_responses:
+                return self.idempotent_responses[idempotency_key]
+            try:
+                response = 200, self.public(self.handle(method, path, params))
+            except StripeError as e:
+                response = e.status, e.body
+            if idempotency_key and method == 'POST':
+                self.idempotent_responses[idempotency_key] = response
+            return response
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def server_activate(self):
+        BaseHTTPServer.HTTPServer.server_activate(self)
+        self.connections = set()
+
+    def process_request_thread(self, request, client_address):
+        self.connections.add(request)
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connections.discard(request)
+
+    def close_connections(self):
+        """Hang up on clients keeping connections alive."""
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # Let handler threads finish before the interpreter may exit.
+        deadline = time.time() + 1
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class StripeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API.
+
+    def handle_request(self):
+        emulator = self.server.emulator
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if isinstance(body, six.binary_type):
+            body = body.decode('utf-8')
+        params = parse_params(url.query if self.command in ('GET', 'DELETE') else body)
+        emulator.delay()
+        failure = emulator.next_failure()
+        if failure == 'reset':
+            self.close_connection = True
+            return
+        if failure:
+            status, error_type, message = FAILURES[failure]
+            content = {'error': {'type': error_type, 'message': message}}
+        else:
+            status, content = emulator.respond(
+                self.command, url.path, params, self.headers.get('Idempotency-Key'))
+        payload = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', new_id('req'))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,201 @@
+"""Shared gateway to the Stripe API for every payments code path.
+
+Calls go through one pooled keep-alive session with per-call timeouts.
+Idempotent calls are retried with jittered exponential backoff, a circuit
+breaker fails fast while Stripe is unavailable and concurrent identical
+lookups are merged into a single request.
+"""
+import random
+import threading
+import time
+import uuid
+
+import requests
+import stripe
+from django.conf import settings
+
+RETRYABLE_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError)
+BACKOFF_BASE = 0.25  # Seconds.
+BACKOFF_CAP = 4.0  # Seconds.
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """Stripe failed too often recently, calls are not attempted."""
+
+
+class CircuitBreaker(object):
+    """Open after consecutive failures, let a trial call through after a cool down."""
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.clock() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError('Stripe is unavailable, try again later.')
+            # Half open: let this call probe Stripe, fail the others meanwhile.
+            self.opened_at = self.clock()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+
+class SingleFlight(object):
+    """Merge concurrent calls sharing a key into one call."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+        else:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self.lock:
+                    self.calls.pop(key, None)
+                call['done'].set()
+        if 'error' in call:
+            raise call['error']
+        return call['result']
+
+
+def new_http_client():
+    """Create a Stripe HTTP client keeping a pool of keep-alive connections."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.STRIPE_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return stripe.http_client.RequestsClient(timeout=settings.STRIPE_TIMEOUT, session=session)
+
+
+stripe.api_key = settings.STRIPE_KEY
+stripe.max_network_retries = 0  # Retries are handled here.
+stripe.default_http_client = new_http_client()
+breaker = CircuitBreaker(settings.STRIPE_CIRCUIT_FAILURES, settings.STRIPE_CIRCUIT_RESET)
+lookups = SingleFlight()
+
+
+def backoff(attempt):
+    """Full jitter exponential backoff delay of an attempt."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def call(fn, *args, **kwargs):
+    """Call Stripe through the circuit breaker, retrying idempotent calls.
+
+    Pass `idempotent=True` for calls that are safe to repeat.
+    """
+    idempotent = kwargs.pop('idempotent', False)
+    attempts = settings.STRIPE_MAX_RETRIES + 1 if idempotent else 1
+    for attempt in range(attempts):
+        breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except RETRYABLE_ERRORS:
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise
+            time.sleep(backoff(attempt))
+        except stripe.error.StripeError:
+            # Stripe answered, only the request was refused.
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+def lookup(key, fn, *args, **kwargs):
+    """Retrieve an object once for every concurrent caller asking for it."""
+    return lookups.do(key, lambda: call(fn, idempotent=True, *args, **kwargs))
+
+
+def retrieve_customer(customer_id):
+    return lookup(('customer', customer_id), stripe.Customer.retrieve, customer_id)
+
+
+def create_customer(**params):
+    params.setdefault('idempotency_key', str(uuid.uuid4()))
+    return call(stripe.Customer.create, idempotent=True, **params)
+
+
+def delete_customer(customer_id):
+    return call(stripe.Customer.delete, customer_id, idempotent=True)
+
+
+def create_source(customer_id, source):
+    return call(stripe.Customer.create_source, customer_id, source=source,
+                idempotency_key=str(uuid.uuid4()), idempotent=True)
+
+
+def delete_source(customer_id, source_id):
+    return call(stripe.Customer.delete_source, customer_id, source_id, idempotent=True)
+
+
+def list_sources(customer_id, **params):
+    """Iterate every source of a customer, page by page."""
+    return paginate(stripe.Customer.list_sources, customer_id, **params)
+
+
+def verify_bank_account(bank_account, amounts):
+    return call(bank_account.verify, amounts=amounts)
+
+
+def retrieve_source(source_id):
+    return lookup(('source', source_id), stripe.Source.retrieve, source_id)
+
+
+def create_charge(**params):
+    """Create a charge, retried only when an idempotency key guards it."""
+    return call(stripe.Charge.create, idempotent='idempotency_key' in params, **params)
+
+
+def retrieve_charge(charge_id):
+    return lookup(('charge', charge_id), stripe.Charge.retrieve, charge_id)
+
+
+def list_charges(**params):
+    """Iterate charges matching the filters, page by page."""
+    return paginate(stripe.Charge.list, **params)
+
+
+def create_token(**params):
+    return call(stripe.Token.create, **params)
+
+
+def paginate(fn, *args, **params):
+    """Follow a Stripe list through its pages, each page a gateway call."""
+    while True:
+        page = call(fn, idempotent=True, *args, **params)
+        for item in page.data:
+            yield item
+        if not page.has_more or not page.data:
+            return
+        params['starting_after'] = page.data[-1].id
@@ -0,0 +1,368 @@
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from io import BytesIO
+
+from unittest import skipUnless
+
+import stripe
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from fremancer import compression, stripe_gateway
+from fremancer.compression import CompressionMiddleware
+from fremancer.db_router import PIN_COOKIE
+from fremancer.parsers import SimpleJSONParser
+from fremancer.renderers import SimpleJSONRenderer
+from fremancer_contracts.models import FremancerContract
+from fremancer_contracts.views import ContractsViewSet
+from fremancer_invoices.views import InvoicesViewSet
+from fremancer_timesheets.models import FremancerDailySheet, FremancerTimeSheet
+from fremancer_timesheets.views import DailySheetsViewSet, TimeSheetsViewSet
+from fremancer_users.models import MEMBERSHIP_SESSION_KEY, UserProfile
+from fremancer_withdrawals.views import WithdrawalsViewSet
+
+
+@override_settings(STRIPE_MAX_RETRIES=2)
+class StripeGatewayTestCase(SimpleTestCase):
+    """Testing retries, circuit breaking and merged lookups of the Stripe gateway."""
+
+    def setUp(self):
+        self.breaker = stripe_gateway.breaker
+        stripe_gateway.breaker = stripe_gateway.CircuitBreaker(3, 30)
+        self.backoff = stripe_gateway.backoff
+        stripe_gateway.backoff = lambda attempt: 0
+
+    def tearDown(self):
+        stripe_gateway.breaker = self.breaker
+        stripe_gateway.backoff = self.backoff
+
+    def flaky(self, failures):
+        calls = []
+
+        def fn(**params):
+            calls.append(params)
+            if len(calls) <= failures:
+                raise stripe.error.APIConnectionError('Connection reset.')
+            return 'ok'
+        return fn, calls
+
+    def test_retry_idempotent_calls(self):
+        fn, calls = self.flaky(2)
+        self.assertEqual(stripe_gateway.call(fn, idempotent=True, amount=1), 'ok')
+        self.assertEqual(calls, [{'amount': 1}] * 3)
+
+    def test_no_retry_without_idempotency(self):
+        fn, calls = self.flaky(1)
+        with self.assertRaises(stripe.error.APIConnectionError):
+            stripe_gateway.call(fn)
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_breaker(self):
+        now = [0]
+        stripe_gateway.breaker = stripe_gateway.CircuitBreaker(3, 30, clock=lambda: now[0])
+        fn, calls = self.flaky(3)
+        with self.assertRaises(stripe.error.APIConnectionError):
+            stripe_gateway.call(fn, idempotent=True)
+        with self.assertRaises(stripe_gateway.CircuitOpenError):
+            stripe_gateway.call(fn, idempotent=True)
+        self.assertEqual(len(calls), 3)
+        # After the cool down a trial call goes through and closes the circuit.
+        now[0] = 31
+        self.assertEqual(stripe_gateway.call(fn), 'ok')
+        self.assertEqual(stripe_gateway.call(fn), 'ok')
+
+    def test_merge_concurrent_lookups(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def retrieve(customer_id):
+            calls.append(customer_id)
+            started.set()
+            release.wait()
+            return {'id': customer_id}
+
+        results = []
+
+        def lookup():
+            results.append(stripe_gateway.lookup(('customer', 'cus_1'), retrieve, 'cus_1'))
+        threads = [threading.Thread(target=lookup) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['cus_1'])
+        self.assertEqual(results, [{'id': 'cus_1'}] * 5)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are checked on SQLite.')
+class QueryPlanTestCase(TestCase):
+    """Testing the list queries of every viewset are served from an index, unsorted."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='plan@fremancer.com')
+
+    def query_plan(self, viewset, membership, ordering=None):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        request.membership = membership
+        qs = viewset(request=request, format_kwarg=None).get_queryset()
+        if ordering:
+            qs = qs.order_by(*ordering)
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, viewset, membership, ordering=None):
+        plan = self.query_plan(viewset, membership, ordering)
+        for detail in plan:
+            self.assertNotIn('TEMP B-TREE', detail, plan)
+            # A scan of the listed table itself, rather than through an index.
+            self.assertFalse(detail.startswith('SCAN') and 'INDEX' not in detail, plan)
+
+    def test_invoices(self):
+        self.assertIndexed(InvoicesViewSet, 'freelancer')
+        self.assertIndexed(InvoicesViewSet, 'hirer')
+        self.assertIndexed(InvoicesViewSet, 'hirer', InvoicesViewSet.cursor_ordering)
+
+    def test_withdrawals(self):
+        self.assertIndexed(WithdrawalsViewSet, 'freelancer')
+        self.assertIndexed(WithdrawalsViewSet, 'freelancer', WithdrawalsViewSet.cursor_ordering)
+
+    def test_timesheets(self):
+        self.assertIndexed(TimeSheetsViewSet, 'freelancer')
+        self.assertIndexed(TimeSheetsViewSet, 'freelancer', TimeSheetsViewSet.cursor_ordering)
+        self.assertIndexed(TimeSheetsViewSet, 'hirer')
+        self.assertIndexed(TimeSheetsViewSet, 'hirer', TimeSheetsViewSet.cursor_ordering)
+
+    def test_daily_sheets(self):
+        self.assertIndexed(DailySheetsViewSet, 'freelancer')
+        self.assertIndexed(DailySheetsViewSet, 'freelancer', DailySheetsViewSet.cursor_ordering)
+
+    def test_contracts(self):
+        self.assertIndexed(ContractsViewSet, 'freelancer')
+        self.assertIndexed(ContractsViewSet, 'hirer')
+
+
+class ReplicaRouterTestCase(TransactionTestCase):
+    """Testing reads go to SQLite files standing in for replicas until the client writes.
+
+    Reads inside a transaction stay on the primary, so tests run outside one.
+    """
+    replicas = ('replica1', 'replica2')
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReplicaRouterTestCase, cls).setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        for alias in cls.replicas:
+            connections.databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(cls.directory, '%s.sqlite3' % alias),
+            }
+            call_command('migrate', database=alias, run_syncdb=True, verbosity=0, interactive=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in cls.replicas:
+            connections[alias].close()
+            del connections.databases[alias]
+        shutil.rmtree(cls.directory)
+        super(ReplicaRouterTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.hirer = User.objects.create(username='replica@fremancer.com')
+        UserProfile.objects.create(user=self.hirer, membership='hirer')
+        FremancerContract.objects.create(
+            hirer=self.hirer, description='Primary only', duration='short', contract_type='hourly')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.hirer)
+
+    @override_settings(DATABASE_REPLICAS=replicas)
+    def test_pin_primary_after_write(self):
+        # The replicas have not caught up with the primary.
+        response = self.client.get('/api/contracts/')
+        self.assertEqual(response.json(), [])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        response = self.client.post('/api/contracts/', {
+            'title': 'Second',
+            'hirer': self.hirer.id,
+            'description': 'Written to the primary',
+            'default_payment': 'card_replica',
+            'duration': 'short',
+            'contract_type': 'hourly',
+        })
+        self.assertEqual(response.status_code, 201, response)
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+        # The client reads its own writes while pinned.
+        response = self.client.get('/api/contracts/')
+        self.assertEqual(len(response.json()), 2)
+
+    @override_settings(DATABASE_REPLICAS=replicas)
+    def test_session_write_not_pinned(self):
+        # Only the user has reached the replicas.
+        for alias in self.replicas:
+            User.objects.using(alias).create(pk=self.hirer.pk, username=self.hirer.username)
+            UserProfile.objects.using(alias).create(user_id=self.hirer.pk, membership='hirer')
+            self.addCleanup(User.objects.using(alias).filter(pk=self.hirer.pk).delete)
+        client = APIClient()
+        client.force_login(self.hirer)
+        # The session is read from the primary and remembers the membership there.
+        response = client.get('/api/contracts/')
+        self.assertEqual(response.json(), [])
+        session = Session.objects.get(session_key=client.session.session_key)
+        self.assertIn(MEMBERSHIP_SESSION_KEY, session.get_decoded())
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_primary_without_replicas(self):
+        response = self.client.get('/api/contracts/')
+        self.assertEqual(len(response.json()), 1)
+        response = self.client.post('/api/contracts/', {
+            'title': 'Second',
+            'hirer': self.hirer.id,
+            'description': 'Nothing to pin',
+            'default_payment': 'card_replica',
+            'duration': 'short',
+            'contract_type': 'hourly',
+        })
+        self.assertEqual(response.status_code, 201, response)
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+
+class ConditionalGetTestCase(TestCase):
+    """Testing reads answer 304 from the validators alone while nothing changed."""
+
+    def setUp(self):
+        cache.clear()
+        self.hirer = User.objects.create(username='etag@fremancer.com')
+        UserProfile.objects.create(user=self.hirer, membership='hirer')
+        self.contract = FremancerContract.objects.create(
+            hirer=self.hirer, freelancer=self.hirer, description='Cached',
+            duration='short', contract_type='hourly', hourly_rate=20)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.hirer)
+
+    def test_list(self):
+        response = self.client.get('/api/contracts/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        # The membership and validators only.
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/contracts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        # Another format is another representation.
+        response = self.client.get('/api/contracts/', {'format': 'api'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.contract.save()
+        response = self.client.get('/api/contracts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        # Removing a row changes the count.
+        FremancerContract.objects.create(
+            hirer=self.hirer, description='Removed', duration='short', contract_type='hourly')
+        response = self.client.get('/api/contracts/')
+        FremancerContract.objects.filter(description='Removed').delete()
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get('/api/contracts/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail(self):
+        timesheet = FremancerTimeSheet.objects.create(
+            contract=self.contract, start_date=date(2017, 7, 3), user=self.hirer)
+        url = '/api/timesheets/%s/' % timesheet.id
+        last_modified = self.client.get(url)['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        etag = response['ETag']
+        # Nested contracts are part of the representation.
+        self.contract.title = 'Renamed'
+        self.contract.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['contract']['title'], 'Renamed')
+        # So are its daily sheets, removing one bumps no timestamp.
+        for day in (3, 4):
+            FremancerDailySheet.objects.create(timesheet=timesheet, report_date=date(2017, 7, day), user=self.hirer)
+        etag = self.client.get(url)['ETag']
+        FremancerDailySheet.objects.filter(report_date=date(2017, 7, 3)).delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # Writes are not conditional.
+        response = self.client.patch(url, {'summary': 'Done'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+class RenderingTestCase(SimpleTestCase):
+    """Testing the simplejson renderer and parser, and the response compression."""
+
+    def test_renderer(self):
+        data = {'title': u'Caf\xe9 \u2028', 'hours': ['20.00'], 'date_created': datetime(2017, 7, 3, 10)}
+        self.assertEqual(SimpleJSONRenderer().render(data), JSONRenderer().render(data))
+        # Decimals are written exactly, not through float.
+        self.assertEqual(SimpleJSONRenderer().render([Decimal('411.90'), Decimal('0.1')]), b'[411.90,0.1]')
+        with self.assertRaises(ValueError):
+            SimpleJSONRenderer().render([Decimal('NaN')])
+        with self.assertRaises(ValueError):
+            SimpleJSONRenderer().render({'amount': Decimal('-Infinity')})
+        self.assertEqual(SimpleJSONRenderer().render(['NaN', 'Infinity']), b'["NaN","Infinity"]')
+
+    def test_parser(self):
+        data = SimpleJSONParser().parse(BytesIO(b'{"amount": 0.1, "hours": [2]}'))
+        self.assertEqual(data, {'amount': Decimal('0.1'), 'hours': [2]})
+        with self.assertRaises(ParseError):
+            SimpleJSONParser().parse(BytesIO(b'[NaN]'))
+
+    def respond(self, response, accept_encoding):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_compression(self):
+        content = b'{"id":1}' * 500
+        response = self.respond(HttpResponse(content, content_type='application/json'), 'gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(response.content)).read(), content)
+        response = self.respond(HttpResponse(b'{"id":1}', content_type='application/json'), 'gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        response = self.respond(HttpResponse(content, content_type='application/json'), 'gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        response = self.respond(StreamingHttpResponse([content, content], content_type='text/csv'), 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(b''.join(response.streaming_content))).read(),
+                         content * 2)
+        # Pages carrying the CSRF token are left alone.
+        response = self.respond(HttpResponse(content, content_type='text/html; charset=utf-8'), 'gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, content)
+
+    @skipUnless(compression.brotli, 'brotli is not installed.')
+    def test_brotli(self):
+        content = b'{"id":1}' * 500
+        response = self.respond(HttpResponse(content, content_type='application/json'), 'gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(response.content), content)
+        response = self.respond(StreamingHttpResponse([content, content], content_type='text/csv'), 'br')
+        self.assertEqual(compression.brotli.decompress(b''.join(response.streaming_content)), content * 2)
@@ -21,6 +21,7 @@ from fremancer import views
 from fremancer import webhook
 from fremancer_contracts import views as contracts_views
 from fremancer_invoices import views as invoices_views
+from fremancer_reports import views as reports_views
 from fremancer_timesheets import views as timesheets_views
 from fremancer_users import views as users_views
 from fremancer_withdrawals import views as withdrawals_views
@@ -31,6 +32,7 @@ router.register(r'dailysheets', timesheets_views.DailySheetsViewSet)
 router.register(r'invoices', invoices_views.InvoicesViewSet)
 router.register(r'payments', invoices_views.PaymentsViewSet, base_name='payments')
 router.register(r'profiles', users_views.UserProfileViewSet)
+router.register(r'reports', reports_views.ReportsViewSet, base_name='reports')
 router.register(r'timesheets', timesheets_views.TimeSheetsViewSet)
 router.register(r'users', users_views.UserViewSet)
 router.register(r'withdrawals', withdrawals_views.WithdrawalsViewSet)
@@ -1,21 +1,42 @@
 """View handlers for main page."""
 import json
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
 from django.http import JsonResponse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
+from stripe import Webhook, WebhookSignature
+from stripe.error import SignatureVerificationError
 
-from fremancer_invoices.models import FremancerInvoice
+from fremancer_invoices.models import FremancerStripeEvent
 
 
 @csrf_exempt
 @require_POST
 def stripe(request):
-    """Handle Stripe webhook."""
-    data = json.loads(request.body).get('object')
-    if data.get('object') == 'charge':
-        invoice = FremancerInvoice.objects.get(stripe_charge_id=data.get('id'))
-        invoice.paid = data.get('paid')
-        invoice.stripe_charge_status = data.get('status')
-        invoice.save()
+    """Store a Stripe webhook event and acknowledge it right away."""
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        # Fail loudly, Stripe keeps retrying until the secret is configured.
+        raise ImproperlyConfigured('STRIPE_WEBHOOK_SECRET is required to verify Stripe webhooks.')
+    try:
+        payload = request.body.decode('utf-8')
+        # The event id is only trusted once Stripe signed the body.
+        WebhookSignature.verify_header(
+            payload, request.META.get('HTTP_STRIPE_SIGNATURE', ''),
+            settings.STRIPE_WEBHOOK_SECRET, Webhook.DEFAULT_TOLERANCE)
+        data = json.loads(payload)
+    except (ValueError, SignatureVerificationError):
+        return JsonResponse({'success': False}, status=400)
+    if not isinstance(data, dict) or not data.get('id'):
+        return JsonResponse({'success': False}, status=400)
+    try:
+        with transaction.atomic():
+            FremancerStripeEvent.objects.create(
+                event_id=data['id'],
+                event_type=data.get('type') or '',
+                payload=payload)
+    except IntegrityError:
+        pass  # Stripe retried an event already stored.
     return JsonResponse({'success': True})
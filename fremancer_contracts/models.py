@@ -39,6 +39,10 @@ class FremancerContract(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_changed = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Per user lists, newest first.
+        index_together = (('hirer', 'date_created'), ('freelancer', 'date_created'))
+
     def freelancer_name(self):
         return self.freelancer.get_full_name() if self.freelancer else ''
 
@@ -1,7 +1,10 @@
+import json
+
 from django.contrib.auth.models import User
 from django.test import TestCase, Client
 from rest_framework.test import APIClient
 
+from fremancer_contracts.models import FremancerContract
 from fremancer_users.models import UserProfile
 
 
@@ -40,3 +43,27 @@ class ContractsTestCase(TestCase):
             'hourly_rate': 20.0
         })
         self.assertEqual(response.status_code, 201, response)
+
+    def test_list_modes(self):
+        """Test contracts are listed whole, by page or streamed."""
+        for index in range(15):
+            FremancerContract.objects.create(
+                title='Contract %s' % index,
+                hirer=self.hirer,
+                freelancer=self.freelancer,
+                description='Test Contract listing',
+                duration='short',
+                contract_type='hourly',
+                hourly_rate=20.0
+            )
+        contracts = self.client.get('/api/contracts/').json()
+        self.assertEqual(len(contracts), 15)
+        self.assertEqual(contracts[0].get('freelancer_name'), self.freelancer.get_full_name())
+        response = self.client.get('/api/contracts/?page_size=5')
+        self.assertEqual(response.json().get('count'), 15)
+        self.assertEqual(len(response.json().get('results')), 5)
+        # Membership, validators, then one query with the users joined, read through a cursor.
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/contracts/?stream=true')
+            content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content.decode('utf-8')), contracts)
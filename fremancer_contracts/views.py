@@ -3,26 +3,38 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import detail_route
 from rest_framework.response import Response
 
+from fremancer.conditional import ConditionalModelMixin
+from fremancer.pagination import OptionalResultsSetPagination
+from fremancer.streaming import stream_json
 from fremancer_contracts.serializers import ContractSerializer
 from fremancer_contracts.models import FremancerContract
-from fremancer_users.models import UserProfile
 
 
-class ContractsViewSet(viewsets.ModelViewSet):
+class ContractsViewSet(ConditionalModelMixin, viewsets.ModelViewSet):
     """API endpoint for contracts handlers."""
     queryset = FremancerContract.objects.all().order_by('-date_created')
     serializer_class = ContractSerializer
-    pagination_class = None
+    pagination_class = OptionalResultsSetPagination
     filter_fields = '__all__'
+    cursor_ordering = ('-date_created', '-id')
 
     def get_queryset(self):
-        profile = UserProfile.objects.get(user=self.request.user)
-        qs = FremancerContract.objects.order_by('-date_created')
-        if profile.is_hirer():
+        qs = FremancerContract.objects.select_related('freelancer', 'hirer').order_by('-date_created')
+        if self.request.membership == 'hirer':
             return qs.filter(hirer=self.request.user)
         else:
             return qs.filter(freelancer=self.request.user)
 
+    def list(self, request):
+        """List contracts, all at once, by page or streamed with `stream=true`."""
+        if request.query_params.get('stream') == 'true':
+            queryset = self.filter_queryset(self.get_queryset())
+            response = self.not_modified(request, queryset)
+            if response is not None:
+                return response
+            return stream_json(queryset, self.get_serializer_class())
+        return super(ContractsViewSet, self).list(request)
+
     @detail_route(methods=['post'])
     def accept(self, request, pk):
         contract = FremancerContract.objects.get(pk=pk)
@@ -0,0 +1,43 @@
+"""Stripe processing fees of invoices."""
+from decimal import Decimal
+
+from django.core.cache import cache
+
+from fremancer import stripe_gateway
+
+STRIPE_CREDIT_PERCENTAGE = Decimal(0.029)  # 2.9%.
+STRIPE_CREDIT_FEE = Decimal(0.30)  # 30 cents.
+STRIPE_ACH_FEE = Decimal(5.0)  # 5 dollars.
+SOURCE_SPLIT_CHAR = '_'
+SOURCE_TYPE_CACHE_TIMEOUT = 60 * 60 * 24  # One day.
+CENTS = Decimal('0.01')
+
+
+def get_source_type(default_payment):
+    """Resolve a Stripe payment id to its type, caching remote lookups."""
+    prefix = default_payment.split(SOURCE_SPLIT_CHAR)[0]
+    if prefix != 'src':
+        # Cards and bank accounts carry their type in the id.
+        return prefix
+    key = 'stripe_source_type:%s' % default_payment
+    source_type = cache.get(key)
+    if source_type is None:
+        source_type = stripe_gateway.retrieve_source(default_payment).type
+        cache.set(key, source_type, SOURCE_TYPE_CACHE_TIMEOUT)
+    return source_type
+
+
+def calculate_fee(source_type, amount):
+    """Calculate the processing fee of an amount, rounded to cents."""
+    if 'card' in source_type:
+        fee = Decimal(amount) * STRIPE_CREDIT_PERCENTAGE + STRIPE_CREDIT_FEE
+    else:
+        fee = STRIPE_ACH_FEE
+    return fee.quantize(CENTS)
+
+
+def quote(default_payment, amount):
+    """Get the fee and total amount an invoice would be charged."""
+    amount = Decimal(amount).quantize(CENTS)
+    fee = calculate_fee(get_source_type(default_payment), amount)
+    return fee, amount + fee
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from fremancer_invoices.stripe_events import BATCH_SIZE, apply_events
+
+
+class Command(BaseCommand):
+    help = 'Apply stored Stripe webhook events in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only events received at or after this ISO datetime.')
+        parser.add_argument('--until', help='Only events received before this ISO datetime.')
+        parser.add_argument('--replay', action='store_true',
+                            help='Reapply events of the range that were already processed.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep polling for new events as a worker.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait between polls when watching.')
+
+    def parse(self, value):
+        if not value:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise CommandError('Invalid datetime: %s' % value)
+        return parsed
+
+    def handle(self, *args, **options):
+        since = self.parse(options['since'])
+        until = self.parse(options['until'])
+        if options['replay'] and not (since or until):
+            raise CommandError('Replaying needs --since or --until.')
+        while True:
+            processed = apply_events(
+                since=since,
+                until=until,
+                replay=options['replay'],
+                batch_size=options['batch_size'])
+            if processed or not options['watch']:
+                self.stdout.write('Processed %s events.' % processed)
+            if not options['watch']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,149 @@
+import math
+import time
+import uuid
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from fremancer.stripe_emulator import StripeEmulator, signed_event
+from fremancer_contracts.models import FremancerContract
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_timesheets.models import FremancerTimeSheet
+from fremancer_users.models import UserBank, UserProfile
+
+PATHS = ('invoice', 'pay', 'payments', 'webhook')
+CUSTOMER_ID = 'cus_benchmark'
+CARD_ID = 'card_benchmark'
+WEBHOOK_SECRET = 'whsec_benchmark'
+
+
+def percentile(timings, percent):
+    """Nearest rank percentile of sorted timings."""
+    return timings[max(int(math.ceil(percent / 100.0 * len(timings))) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the payment paths against the offline Stripe emulator.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100, help='Requests per path.')
+        parser.add_argument('--latency', type=float, default=0, help='Stripe latency in ms.')
+        parser.add_argument('--jitter', type=float, default=0, help='Random extra Stripe latency in ms.')
+        parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of failed Stripe requests.')
+        parser.add_argument('--failure-mode', choices=('reset', 'error', 'rate_limit'), default='reset')
+        parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS))
+
+    def handle(self, *args, **options):
+        emulator = StripeEmulator(
+            latency=options['latency'] / 1000.0,
+            jitter=options['jitter'] / 1000.0,
+            failure_rate=options['failure_rate'],
+            failure_mode=options['failure_mode'])
+        with emulator, override_settings(
+                ALLOWED_HOSTS=['testserver'], STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET), transaction.atomic():
+            emulator.add_customer(CUSTOMER_ID, sources=[{'id': CARD_ID, 'object': 'card', 'brand': 'Visa'}])
+            self.setup_data()
+            for path in options['paths']:
+                timings, errors = getattr(self, 'run_%s' % path)(emulator, options['requests'])
+                self.report(path, timings, errors)
+            # Leave the database as it was.
+            transaction.set_rollback(True)
+
+    def setup_data(self):
+        suffix = uuid.uuid4().hex[:8]
+        self.hirer = User.objects.create(username='hirer_%s@benchmark.com' % suffix)
+        UserProfile.objects.create(user=self.hirer, membership='hirer')
+        UserBank.objects.create(user=self.hirer, stripe_customer_id=CUSTOMER_ID)
+        self.freelancer = User.objects.create(username='freelancer_%s@benchmark.com' % suffix)
+        UserProfile.objects.create(user=self.freelancer, membership='freelancer')
+        self.contract = FremancerContract.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            description='Benchmark contract',
+            default_payment=CARD_ID,
+            duration='short',
+            contract_type='hourly',
+            hourly_rate=20.0)
+        self.timesheet = FremancerTimeSheet.objects.create(
+            contract=self.contract,
+            start_date=date(2017, 7, 3),
+            summary='Benchmark timesheet',
+            total_hours=20.0,
+            total_amount=400.0,
+            user=self.freelancer)
+
+    def client(self, user):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        return client
+
+    def measure(self, requests):
+        """Time each request, counting error responses."""
+        timings = []
+        errors = 0
+        for request in requests:
+            start = time.time()
+            response = request()
+            timings.append(time.time() - start)
+            errors += response.status_code >= 400
+        return timings, errors
+
+    def run_invoice(self, emulator, count):
+        client = self.client(self.freelancer)
+        params = {
+            'hirer': self.hirer.id,
+            'freelancer': self.freelancer.id,
+            'contract': self.contract.id,
+            'total_hours': 20.0,
+            'amount': 400.0,
+            'timesheets': [self.timesheet.id]
+        }
+        return self.measure(lambda: client.post('/api/invoices/', params) for _ in range(count))
+
+    def run_pay(self, emulator, count):
+        client = self.client(self.hirer)
+        invoices = []
+        for _ in range(count):
+            invoice = FremancerInvoice.objects.create(
+                hirer=self.hirer,
+                freelancer=self.freelancer,
+                contract=self.contract,
+                total_hours=20.0,
+                amount=400.0,
+                total_amount=411.9)
+            invoice.timesheets.add(self.timesheet)
+            invoices.append(invoice)
+        return self.measure(
+            lambda pk=invoice.pk: client.post('/api/invoices/%s/pay/' % pk) for invoice in invoices)
+
+    def run_payments(self, emulator, count):
+        client = self.client(self.hirer)
+        return self.measure(lambda: client.get('/api/payments/') for _ in range(count))
+
+    def run_webhook(self, emulator, count):
+        client = APIClient()
+        events = emulator.pop_events()[:count]
+        for index in range(len(events), count):
+            events.append({
+                'id': 'evt_benchmark_%s' % index, 'object': 'event', 'type': 'charge.succeeded',
+                'data': {'object': {'id': 'ch_benchmark_%s' % index, 'object': 'charge',
+                                    'paid': True, 'status': 'succeeded'}}
+            })
+        return self.measure(
+            lambda event=event: self.post_event(client, event) for event in events)
+
+    def post_event(self, client, event):
+        payload, signature = signed_event(event, WEBHOOK_SECRET)
+        return client.post(
+            '/webhook/', data=payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=signature)
+
+    def report(self, path, timings, errors):
+        total = sum(timings)
+        timings = sorted(timings)
+        self.stdout.write('%-10s %6d requests %5d errors %9.1f req/s  p50 %8.2f ms  p99 %8.2f ms' % (
+            path, len(timings), errors, len(timings) / total if total else 0,
+            percentile(timings, 50) * 1000, percentile(timings, 99) * 1000))
@@ -0,0 +1,111 @@
+import time
+import uuid
+from datetime import date, timedelta
+from io import BytesIO
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from fremancer import compression
+from fremancer.parsers import SimpleJSONParser
+from fremancer.renderers import SimpleJSONRenderer
+from fremancer_contracts.models import FremancerContract
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_invoices.serializers import InvoiceSerializer
+from fremancer_timesheets.models import FremancerTimeSheet
+from fremancer_timesheets.serializers import TimeSheetSerializer
+from fremancer_users.models import UserProfile
+
+RENDERERS = (
+    ('stdlib', JSONRenderer(), JSONParser()),
+    ('simplejson', SimpleJSONRenderer(), SimpleJSONParser()),
+)
+
+
+def best_of(repeat, fn):
+    """Fastest run of a function in ms, the least disturbed by other work."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return min(timings) * 1000
+
+
+class Command(BaseCommand):
+    help = 'Compare the JSON renderers, parsers and compression on invoice and timesheet payloads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help='Invoices and timesheets per payload.')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs of each measure, the best is kept.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            payloads = self.payloads(options['rows'])
+            # Leave the database as it was.
+            transaction.set_rollback(True)
+        repeat = options['repeat']
+        for name, data in payloads:
+            content = None
+            for renderer_name, renderer, parser in RENDERERS:
+                content = renderer.render(data)
+                self.stdout.write('%-10s %-10s render %8.2f ms  parse %8.2f ms  %8d bytes' % (
+                    name, renderer_name,
+                    best_of(repeat, lambda: renderer.render(data)),
+                    best_of(repeat, lambda: parser.parse(BytesIO(content))),
+                    len(content)))
+            for coding in ('gzip', 'br'):
+                if coding == 'br' and compression.brotli is None:
+                    self.stdout.write('%-10s br         brotli is not installed' % name)
+                    continue
+                compressed = compression.compress(coding, content)
+                self.stdout.write('%-10s %-10s  comp. %8.2f ms %23d bytes' % (
+                    name, coding, best_of(repeat, lambda: compression.compress(coding, content)),
+                    len(compressed)))
+
+    def payloads(self, rows):
+        """Serialize invoices and timesheets as the list endpoints do."""
+        suffix = uuid.uuid4().hex[:8]
+        hirer = User.objects.create(username='hirer_%s@benchmark.com' % suffix)
+        UserProfile.objects.create(user=hirer, membership='hirer')
+        freelancer = User.objects.create(username='freelancer_%s@benchmark.com' % suffix)
+        UserProfile.objects.create(user=freelancer, membership='freelancer')
+        contract = FremancerContract.objects.create(
+            hirer=hirer,
+            freelancer=freelancer,
+            title=u'Benchmark contract \u2013 caf\xe9',
+            description='Benchmark contract',
+            duration='short',
+            contract_type='hourly',
+            hourly_rate=20.0)
+        for index in range(rows):
+            timesheet = FremancerTimeSheet.objects.create(
+                contract=contract,
+                start_date=date(2017, 7, 3) + timedelta(weeks=index),
+                summary='Benchmark timesheet %s' % index,
+                total_hours=20.25,
+                total_amount=405.0,
+                user=freelancer)
+            invoice = FremancerInvoice.objects.create(
+                hirer=hirer,
+                freelancer=freelancer,
+                contract=contract,
+                total_hours=20.25,
+                amount=405.0,
+                fee=12.05,
+                total_amount=417.05)
+            invoice.timesheets.add(timesheet)
+        invoices = FremancerInvoice.objects.filter(hirer=hirer).select_related(
+            'contract__freelancer', 'contract__hirer'
+        ).prefetch_related(Prefetch('timesheets', queryset=FremancerTimeSheet.objects.select_related('contract')))
+        timesheets = FremancerTimeSheet.objects.filter(user=freelancer).select_related('contract')
+        return [
+            ('invoices', InvoiceSerializer(invoices, many=True).data),
+            ('timesheets', TimeSheetSerializer(timesheets, many=True).data),
+            # Raw Decimal values, as the summary endpoints answer.
+            ('summary', [FremancerInvoice.objects.filter(hirer=hirer).summary()] * rows),
+        ]
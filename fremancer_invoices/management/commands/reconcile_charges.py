@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from fremancer_invoices.stripe_events import BATCH_SIZE, reconcile_charges
+
+
+class Command(BaseCommand):
+    help = 'Sync unpaid and pending invoices with the status of their Stripe charges.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        updated = reconcile_charges(batch_size=options['batch_size'])
+        self.stdout.write('Updated %s invoices.' % updated)
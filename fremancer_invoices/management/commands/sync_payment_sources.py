@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from fremancer import stripe_gateway
+from fremancer_users.models import UserBank, UserPaymentSource
+
+
+class Command(BaseCommand):
+    help = 'Refresh the local mirror of Stripe payment sources.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only refresh this user id.')
+
+    def handle(self, *args, **options):
+        banks = UserBank.objects.exclude(stripe_customer_id=None).exclude(stripe_customer_id='')
+        if options['user']:
+            banks = banks.filter(user=options['user'])
+        synced = 0
+        for bank in banks.iterator():
+            sources = stripe_gateway.list_sources(bank.stripe_customer_id)
+            UserPaymentSource.replace(bank.user_id, list(sources))
+            synced += 1
+        self.stdout.write('Synced payment sources of %s customers.' % synced)
@@ -1,9 +1,48 @@
+from decimal import Decimal
+
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
 
 from fremancer_timesheets.models import FremancerTimeSheet
 from fremancer_contracts.models import FremancerContract
+from fremancer_users.models import UserLedgerEntry
+
+CANCELLED_CHARGE_STATUSES = ('failed', 'refunded')
+
+
+class FremancerInvoiceQuerySet(models.QuerySet):
+
+    def summary(self):
+        """Aggregate amounts per charge status in a single grouped query."""
+        groups = self.order_by().values('paid', 'stripe_charge_status').annotate(
+            count=models.Count('pk'),
+            total=models.Sum('total_amount'))
+        summary = {
+            'count': 0,
+            'total': Decimal(0),
+            'pending': Decimal(0),
+            'paid': Decimal(0),
+            'cancelled': Decimal(0),
+            'by_status': {}
+        }
+        for group in groups:
+            total = group['total'] or Decimal(0)
+            charge_status = group['stripe_charge_status'] or 'invoiced'
+            summary['count'] += group['count']
+            summary['total'] += total
+            if charge_status == 'pending':
+                summary['pending'] += total
+            if group['paid']:
+                summary['paid'] += total
+            if charge_status in CANCELLED_CHARGE_STATUSES:
+                summary['cancelled'] += total
+            by_status = summary['by_status'].setdefault(charge_status, {'count': 0, 'total': Decimal(0)})
+            by_status['count'] += group['count']
+            by_status['total'] += total
+        return summary
 
 
 class FremancerInvoice(models.Model):
@@ -57,10 +96,47 @@ class FremancerInvoice(models.Model):
 
     stripe_charge_id = models.CharField(max_length=100, blank=True, null=True)
     stripe_charge_status = models.CharField(max_length=100, blank=True, null=True)
+    stripe_charge_synced = models.DateTimeField(blank=True, null=True)
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_changed = models.DateTimeField(auto_now=True)
 
+    objects = FremancerInvoiceQuerySet.as_manager()
+
+    class Meta:
+        # Per user lists, newest first.
+        index_together = (('freelancer', 'date_created'), ('hirer', 'date_created'))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(FremancerInvoice, cls).from_db(db, field_names, values)
+        instance._loaded_paid = instance.__dict__.get('paid')
+        return instance
+
+    @classmethod
+    def sync_billing_status(cls, invoice_ids):
+        """Propagate invoice billing changes to the covered timesheets."""
+        timesheet_ids = cls.timesheets.through.objects.filter(
+            fremancerinvoice__in=list(invoice_ids)
+        ).values_list('fremancertimesheet', flat=True)
+        FremancerTimeSheet.sync_billing_status(timesheet_ids)
+
+    def record_ledger(self):
+        """Record the freelancer earning and whether it is still pending."""
+        if not self.freelancer_id:
+            return None
+        pending = self.amount if not self.paid or self.pending else 0
+        return UserLedgerEntry.record(
+            self.freelancer_id, 'invoice', self.pk,
+            earned=self.amount, pending=pending)
+
+    def save(self, *args, **kwargs):
+        super(FremancerInvoice, self).save(*args, **kwargs)
+        if self.paid != getattr(self, '_loaded_paid', False):
+            FremancerInvoice.sync_billing_status([self.pk])
+        self._loaded_paid = self.paid
+        self.record_ledger()
+
     @property
     def status(self):
         if self.stripe_charge_status:
@@ -72,6 +148,11 @@ class FremancerInvoice(models.Model):
     def pending(self):
         return self.stripe_charge_status == 'pending'
 
+    @property
+    def charged(self):
+        """Flag a charge that did not fail, paying again would charge twice."""
+        return bool(self.stripe_charge_id) and self.stripe_charge_status != 'failed'
+
     @property
     def contract_data(self):
         return self.contract
@@ -79,3 +160,54 @@ class FremancerInvoice(models.Model):
     @property
     def timesheets_data(self):
         return self.timesheets
+
+
+class FremancerStripeEvent(models.Model):
+    """A raw Stripe webhook event, applied later in batches."""
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100, blank=True)
+    payload = models.TextField()
+    status = models.CharField(max_length=25, default='pending', db_index=True, choices=[
+        ['pending', 'Pending'],
+        ['applied', 'Applied'],
+        ['ignored', 'Ignored'],
+        ['failed', 'Failed']
+    ])
+    error = models.TextField(blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+    date_processed = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return '%s %s: %s' % (self.event_id, self.event_type, self.status)
+
+
+@receiver(m2m_changed, sender=FremancerInvoice.timesheets.through)
+def invoice_timesheets_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep timesheet billing status in sync with invoice membership."""
+    if action == 'pre_clear' and not reverse:
+        instance._cleared_timesheets = list(instance.timesheets.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            timesheet_ids = [instance.pk]
+        elif action == 'post_clear':
+            timesheet_ids = getattr(instance, '_cleared_timesheets', [])
+        else:
+            timesheet_ids = pk_set
+        FremancerTimeSheet.sync_billing_status(timesheet_ids)
+
+
+@receiver(pre_delete, sender=FremancerInvoice)
+def invoice_deleting(sender, instance, **kwargs):
+    """Note the timesheets of an invoice about to go and reverse its ledger entries."""
+    # The m2m rows go by cascade, without an m2m_changed.
+    instance._deleted_timesheets = list(instance.timesheets.values_list('pk', flat=True))
+    # Before the delete, in its transaction, while the account still exists.
+    if instance.freelancer_id:
+        UserLedgerEntry.record(instance.freelancer_id, 'invoice', instance.pk)
+
+
+@receiver(post_delete, sender=FremancerInvoice)
+def invoice_deleted(sender, instance, **kwargs):
+    """Release the timesheets of a deleted invoice."""
+    FremancerTimeSheet.sync_billing_status(getattr(instance, '_deleted_timesheets', []))
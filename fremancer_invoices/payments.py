@@ -0,0 +1,105 @@
+"""Charge invoices through Stripe."""
+from multiprocessing.pool import ThreadPool
+
+from django.db import transaction
+from django.db.models import BooleanField, Case, CharField, Value, When
+from django.utils import timezone
+
+from fremancer import stripe_gateway
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_invoices.signals import invoices_changed
+
+CHARGE_WORKERS = 8
+
+
+def create_metadata(invoice):
+    """Create metadata for Stripe."""
+    metadata = {
+        'contract': invoice.contract_id,
+        'hours': invoice.total_hours
+    }
+    index = 0
+    for ts in invoice.timesheets.all():
+        metadata['timesheet_%s_id' % index] = ts.id
+        metadata['timesheet_%s_hours' % index] = ts.total_hours
+        metadata['timesheet_%s_amount' % index] = ts.total_amount
+        index += 1
+    return metadata
+
+
+def charge_params(invoice, customer_id):
+    """Build the Stripe charge of an invoice."""
+    return {
+        'amount': int(invoice.total_amount * 100),
+        'currency': 'usd',
+        'customer': customer_id,
+        'source': invoice.contract.default_payment,
+        'description': 'Charge for %s in %s hours' % (
+            invoice.freelancer, invoice.total_hours
+        ),
+        'metadata': create_metadata(invoice),
+        # Retried requests of an attempt never charge twice, the next attempt
+        # follows the charge that failed and may use another customer or source.
+        'idempotency_key': 'invoice-%s-%s-%s-%s-%s' % (
+            invoice.pk, int(invoice.total_amount * 100), customer_id,
+            invoice.contract.default_payment, invoice.stripe_charge_id or 'first'),
+    }
+
+
+def declined_charge(error):
+    """Get the id of the failed charge a card error reports, None otherwise."""
+    body = getattr(error, 'json_body', None) or {}
+    return body.get('error', {}).get('charge')
+
+
+def pay_invoices(invoices, customer_id, create_charge=None, workers=CHARGE_WORKERS):
+    """Charge invoices concurrently and store the charges with one update.
+
+    Returns a list of (invoice, charge, error) in the order of the invoices.
+    """
+    create_charge = create_charge or stripe_gateway.create_charge
+    jobs = [(invoice, charge_params(invoice, customer_id)) for invoice in invoices]
+    if not jobs:
+        return []
+
+    def charge(job):
+        invoice, params = job
+        try:
+            return invoice, create_charge(**params), None
+        except Exception as e:
+            return invoice, None, e
+
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        results = pool.map(charge, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    charged = [(paid, created) for paid, created, error in results if error is None]
+    # Declined charges are stored as failed, so that paying again is a new attempt.
+    charged += [
+        (declined, {'id': declined_charge(error), 'paid': False, 'status': 'failed'})
+        for declined, created, error in results if error is not None and declined_charge(error)]
+    if charged:
+        now = timezone.now()
+        for invoice, charge in charged:
+            invoice.paid = charge.get('paid')
+            invoice.stripe_charge_id = charge.get('id')
+            invoice.stripe_charge_status = charge.get('status')
+            invoice.stripe_charge_synced = now
+        with transaction.atomic():
+            FremancerInvoice.objects.filter(pk__in=[invoice.pk for invoice, charge in charged]).update(
+                paid=Case(*[When(pk=invoice.pk, then=Value(invoice.paid)) for invoice, charge in charged],
+                          output_field=BooleanField()),
+                stripe_charge_id=Case(*[When(pk=invoice.pk, then=Value(invoice.stripe_charge_id))
+                                        for invoice, charge in charged], output_field=CharField()),
+                stripe_charge_status=Case(*[When(pk=invoice.pk, then=Value(invoice.stripe_charge_status))
+                                            for invoice, charge in charged], output_field=CharField()),
+                stripe_charge_synced=now,
+                date_changed=now)
+            FremancerInvoice.sync_billing_status([invoice.pk for invoice, charge in charged])
+            for invoice, charge in charged:
+                invoice.record_ledger()
+            invoices_changed.send(
+                sender=FremancerInvoice, invoice_ids=[invoice.pk for invoice, charge in charged])
+    return results
@@ -32,3 +32,18 @@ class InvoiceSerializer(serializers.ModelSerializer):
             raise ValidationError(
                 'Invalid Amount: %s' % data.get('amount'))
         return data
+
+
+class QuoteSerializer(serializers.Serializer):
+    contract = serializers.IntegerField(required=False)
+    default_payment = serializers.CharField(required=False)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+    def validate(self, data):
+        if not data.get('contract') and not data.get('default_payment'):
+            raise ValidationError('Either contract or default payment is required.')
+        return data
+
+
+class BulkPaySerializer(serializers.Serializer):
+    invoices = serializers.ListField(child=serializers.IntegerField(), min_length=1, max_length=100)
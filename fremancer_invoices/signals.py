@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent when invoices change through queryset updates, which skip post_save.
+invoices_changed = Signal(providing_args=['invoice_ids'])
@@ -0,0 +1,290 @@
+"""Apply Stripe state, from webhooks or reconciliation, in batches."""
+import calendar
+import json
+from collections import OrderedDict
+
+import stripe
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from fremancer import stripe_gateway
+from fremancer_invoices.models import FremancerInvoice, FremancerStripeEvent
+from fremancer_invoices.signals import invoices_changed
+from fremancer_users.models import UserBank, UserPaymentSource
+
+BATCH_SIZE = 100
+
+
+def event_object(payload):
+    """Get the object of an event, `data.object` or the legacy top level `object`."""
+    obj = payload.get('data', {}).get('object')
+    if obj is None and isinstance(payload.get('object'), dict):
+        obj = payload['object']
+    return obj or {}
+
+
+def update_invoices(charges):
+    """Bulk update invoices from a map of charge id to (paid, charge status).
+
+    Returns the charge ids that matched an invoice.
+    """
+    groups = {}
+    for charge_id, state in charges.items():
+        groups.setdefault(state, []).append(charge_id)
+    now = timezone.now()
+    for (paid, charge_status), charge_ids in groups.items():
+        FremancerInvoice.objects.filter(stripe_charge_id__in=charge_ids).update(
+            paid=paid, stripe_charge_status=charge_status,
+            stripe_charge_synced=now, date_changed=now)
+    invoices = list(FremancerInvoice.objects.filter(stripe_charge_id__in=list(charges)))
+    FremancerInvoice.sync_billing_status([invoice.pk for invoice in invoices])
+    for invoice in invoices:
+        invoice.record_ledger()
+    invoices_changed.send(sender=FremancerInvoice, invoice_ids=[invoice.pk for invoice in invoices])
+    return set(invoice.stripe_charge_id for invoice in invoices)
+
+
+def charge_state(charge):
+    """Get the (paid, charge status) an invoice takes from a charge."""
+    refunded = bool(charge.get('refunded'))
+    charge_status = 'refunded' if refunded else charge.get('status')
+    return bool(charge.get('paid')) and not refunded, charge_status
+
+
+def apply_charges(items):
+    """Apply charge state, the latest event of a charge wins."""
+    charges = OrderedDict()
+    for event, charge in items:
+        charges[charge.get('id')] = charge_state(charge)
+    matched = update_invoices(charges)
+    return dict((event.pk, charge.get('id') in matched) for event, charge in items)
+
+
+def dispute_state(dispute):
+    """Get the (paid, charge status) an invoice takes from a dispute."""
+    if dispute.get('status') == 'won':
+        return True, 'succeeded'
+    elif dispute.get('status') == 'lost':
+        return False, 'refunded'
+    return True, 'disputed'
+
+
+def apply_disputes(items):
+    """Flag disputed charges, resolving them once the dispute closes."""
+    charges = OrderedDict()
+    for event, dispute in items:
+        charges[dispute.get('charge')] = dispute_state(dispute)
+    matched = update_invoices(charges)
+    return dict((event.pk, dispute.get('charge') in matched) for event, dispute in items)
+
+
+def apply_sources(items):
+    """Mirror payment sources added to, changed on or removed from customers."""
+    customer_ids = set(source.get('customer') for event, source in items)
+    users = dict(UserBank.objects.filter(
+        stripe_customer_id__in=customer_ids
+    ).values_list('stripe_customer_id', 'user'))
+    applied = {}
+    for event, source in items:
+        user_id = users.get(source.get('customer'))
+        if user_id is None:
+            applied[event.pk] = False
+            continue
+        if event.event_type.endswith('.deleted'):
+            UserPaymentSource.objects.filter(stripe_source_id=source.get('id')).delete()
+        else:
+            UserPaymentSource.mirror(user_id, source)
+        applied[event.pk] = True
+    return applied
+
+
+EVENT_HANDLERS = {
+    'bank_account': apply_sources,
+    'card': apply_sources,
+    'charge': apply_charges,
+    'dispute': apply_disputes,
+}
+# The charge changed by an event and the state it takes, per object type.
+EVENT_CHARGES = {
+    'charge': (lambda obj: obj.get('id'), charge_state),
+    'dispute': (lambda obj: obj.get('charge'), dispute_state),
+}
+
+
+def stale_events(items_by_type):
+    """Events created before their invoice last synced its charge, that would roll it back."""
+    created = {}
+    for object_type, (charge_id, state) in EVENT_CHARGES.items():
+        for event, obj in items_by_type.get(object_type, []):
+            if event.created:
+                created[event.pk] = (charge_id(obj), event.created, state(obj))
+    if not created:
+        return set()
+    synced = dict(
+        (charge_id, (timestamp, (paid, charge_status)))
+        for charge_id, timestamp, paid, charge_status in FremancerInvoice.objects.filter(
+            stripe_charge_id__in=set(charge_id for charge_id, timestamp, state in created.values()),
+            stripe_charge_synced__isnull=False
+        ).values_list('stripe_charge_id', 'stripe_charge_synced', 'paid', 'stripe_charge_status'))
+    # Timestamps are in seconds, an event of the state already synced still applies.
+    return set(
+        event_pk for event_pk, (charge_id, timestamp, state) in created.items()
+        if charge_id in synced and timestamp < calendar.timegm(synced[charge_id][0].utctimetuple())
+        and state != synced[charge_id][1])
+
+
+def apply_batch(events, replay=False):
+    """Apply a batch of events, grouped by object type, in the order Stripe created them.
+
+    Charge events older than the state already synced are ignored, unless replayed.
+    """
+    items_by_type = OrderedDict()
+    outcome = {}
+    for event in events:
+        try:
+            payload = json.loads(event.payload)
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            outcome[event.pk] = ('failed', 'Invalid JSON payload')
+            continue
+        obj = event_object(payload)
+        # Deliveries may come out of order, Stripe stamps events when created.
+        event.created = payload.get('created')
+        if obj.get('object') in EVENT_HANDLERS:
+            items_by_type.setdefault(obj.get('object'), []).append((event, obj))
+        else:
+            outcome[event.pk] = ('ignored', '')
+    stale = set() if replay else stale_events(items_by_type)
+    for event_pk in stale:
+        outcome[event_pk] = ('ignored', 'Older than the synced charge')
+    for object_type, items in items_by_type.items():
+        items = sorted(
+            [item for item in items if item[0].pk not in stale],
+            key=lambda item: item[0].created or 0)
+        if not items:
+            continue
+        try:
+            with transaction.atomic():
+                applied = EVENT_HANDLERS[object_type](items)
+        except Exception as e:
+            applied = dict((event.pk, e) for event, obj in items)
+        for event_pk, result in applied.items():
+            if isinstance(result, Exception):
+                outcome[event_pk] = ('failed', str(result))
+            else:
+                outcome[event_pk] = ('applied' if result else 'ignored', '')
+    # Record the outcome with one update per status.
+    by_status = {}
+    for event_pk, state in outcome.items():
+        by_status.setdefault(state, []).append(event_pk)
+    now = timezone.now()
+    for (event_status, error), event_pks in by_status.items():
+        FremancerStripeEvent.objects.filter(pk__in=event_pks).update(
+            status=event_status, error=error, date_processed=now)
+    return outcome
+
+
+def apply_events(since=None, until=None, replay=False, batch_size=BATCH_SIZE):
+    """Apply pending events, or replay every event of a time range.
+
+    Returns the number of events processed.
+    """
+    qs = FremancerStripeEvent.objects.order_by('pk')
+    if not replay:
+        qs = qs.filter(status='pending')
+    if since:
+        qs = qs.filter(date_created__gte=since)
+    if until:
+        qs = qs.filter(date_created__lt=until)
+    processed = last_pk = 0
+    while True:
+        events = list(qs.filter(pk__gt=last_pk)[:batch_size])
+        if not events:
+            return processed
+        apply_batch(events, replay)
+        processed += len(events)
+        last_pk = events[-1].pk
+
+
+def outstanding_invoices():
+    """Invoices whose charge may still change on Stripe, pending or never synced.
+
+    Charges that failed for good are left out, so the scan does not grow with history.
+    """
+    return FremancerInvoice.objects.exclude(stripe_charge_id=None).filter(
+        Q(stripe_charge_status='pending') | Q(stripe_charge_synced=None))
+
+
+def list_charges(created_gte, batch_size=BATCH_SIZE):
+    """Page through Stripe charges created since a timestamp."""
+    return stripe_gateway.list_charges(limit=batch_size, created={'gte': created_gte})
+
+
+def retrieve_charges(charge_ids):
+    """Retrieve charges one by one, None for those Stripe does not know."""
+    for charge_id in charge_ids:
+        try:
+            yield charge_id, stripe_gateway.retrieve_charge(charge_id)
+        except stripe.error.InvalidRequestError as e:
+            if e.http_status != 404:
+                raise
+            yield charge_id, None
+
+
+def mark_missing(charge_ids):
+    """Settle invoices whose charge Stripe does not know, deleted or of another account.
+
+    Returns the number of invoices updated.
+    """
+    if not charge_ids:
+        return 0
+    now = timezone.now()
+    return FremancerInvoice.objects.filter(stripe_charge_id__in=charge_ids).update(
+        stripe_charge_status='missing', stripe_charge_synced=now, date_changed=now)
+
+
+def reconcile_charges(charges=None, batch_size=BATCH_SIZE):
+    """Sync outstanding invoices with their charges, listed page by page.
+
+    Charges the listing never showed are then retrieved directly, so no invoice
+    stays outstanding to be listed again on every run.
+    Returns the number of invoices updated.
+    """
+    qs = outstanding_invoices()
+    charge_ids = set(qs.values_list('stripe_charge_id', flat=True))
+    if not charge_ids:
+        return 0
+    if charges is None:
+        oldest = qs.aggregate(oldest=Min('date_created'))['oldest']
+        charges = list_charges(calendar.timegm(oldest.utctimetuple()), batch_size)
+    batch = OrderedDict()
+    updated = 0
+    for charge in charges:
+        if charge.get('id') not in charge_ids:
+            continue
+        batch[charge.get('id')] = charge_state(charge)
+        charge_ids.discard(charge.get('id'))
+        if len(batch) >= batch_size or not charge_ids:
+            with transaction.atomic():
+                updated += len(update_invoices(batch))
+            batch = OrderedDict()
+        if not charge_ids:
+            break
+    if batch:
+        with transaction.atomic():
+            updated += len(update_invoices(batch))
+    leftover = sorted(charge_ids)
+    for index in range(0, len(leftover), batch_size):
+        batch, missing = OrderedDict(), []
+        for charge_id, charge in retrieve_charges(leftover[index:index + batch_size]):
+            if charge is None:
+                missing.append(charge_id)
+            else:
+                batch[charge_id] = charge_state(charge)
+        with transaction.atomic():
+            if batch:
+                updated += len(update_invoices(batch))
+            updated += mark_missing(missing)
+    return updated
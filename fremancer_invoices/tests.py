@@ -1,23 +1,54 @@
+import os
 import stripe
+import time
 
-from django.conf import settings
-from datetime import date
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from datetime import date, timedelta
 from django.contrib.auth.models import User
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from rest_framework.test import APIClient
 
+from fremancer import stripe_gateway
+from fremancer.stripe_emulator import StripeEmulator, signed_event
 from fremancer_users.models import UserProfile, UserBank
 from fremancer_contracts.models import FremancerContract
 from fremancer_timesheets.models import FremancerTimeSheet
-from fremancer_invoices.models import FremancerInvoice
+from fremancer_invoices.models import FremancerInvoice, FremancerStripeEvent
+from fremancer_invoices.payments import pay_invoices
+from fremancer_invoices.stripe_events import apply_events, outstanding_invoices, reconcile_charges
 
-stripe.api_key = settings.STRIPE_KEY
 
+WEBHOOK_SECRET = 'whsec_test'
 
+
+def post_event(client, event, secret=WEBHOOK_SECRET):
+    """Post an event to the webhook as Stripe signs it."""
+    payload, signature = signed_event(event, secret)
+    return client.post(
+        '/webhook/', data=payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=signature)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
 class InvoicesTestCase(TestCase):
     """Testing the handling of invoices."""
 
+    @classmethod
+    def setUpClass(cls):
+        super(InvoicesTestCase, cls).setUpClass()
+        cls.stripe = StripeEmulator().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stripe.stop()
+        super(InvoicesTestCase, cls).tearDownClass()
+
     def setUp(self):
+        self.stripe.reset()
+        self.stripe.add_customer('cus_B8yCih3DvwhOR7', sources=[
+            {'id': 'card_1AoWMOCaQ7YmitADQPH7cLQq', 'object': 'card', 'brand': 'Visa', 'last4': '4242'}
+        ])
         self.hirer = User.objects.create(
             username='hirer@fremancer.com', email='hirer@fremancer.com', password='bar'
         )
@@ -81,6 +112,17 @@ class InvoicesTestCase(TestCase):
         response = self.client.post('/api/invoices/', invoice_params)
         self.assertEqual(response.status_code, 201, response)
 
+    def test_create_invoice_quote_fails(self):
+        """Test no invoice is stored when its fee cannot be quoted."""
+        self.contract.default_payment = 'src_missing'
+        self.contract.save()
+        response = self.client.post('/api/invoices/', self.invoice_params)
+        self.assertEqual(response.status_code, 400, response)
+        self.stripe.fail_next(count=3)
+        response = self.client.post('/api/invoices/', self.invoice_params)
+        self.assertEqual(response.status_code, 503, response)
+        self.assertFalse(FremancerInvoice.objects.exists())
+
     def test_update_invoice(self):
         """Test update existing invoice."""
         invoice_params = self.invoice_params
@@ -130,6 +172,74 @@ class InvoicesTestCase(TestCase):
         self.assertTrue(paid_invoice.paid)
         self.assertIsNotNone(paid_invoice.stripe_charge_id)
         self.assertEqual(paid_invoice.stripe_charge_status, 'succeeded')
+        # Paying again is refused without charging.
+        response = self.client.post('/api/invoices/%s/pay/' % invoice.id)
+        self.assertEqual(response.status_code, 400, response)
+        self.assertEqual(response.json(), 'Invoice Already Paid')
+        self.assertEqual(len(self.stripe.charges), 1)
+
+    def test_pay_other_hirer(self):
+        """Test only the hirer of an invoice pays it."""
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_hours=2.0,
+            total_amount=84.0,
+        )
+        self.client.force_authenticate(user=self.freelancer)
+        response = self.client.post('/api/invoices/%s/pay/' % invoice.id)
+        self.assertEqual(response.status_code, 404, response)
+        response = self.client.post('/api/invoices/0/pay/')
+        self.assertEqual(response.status_code, 404, response)
+        self.assertFalse(FremancerInvoice.objects.get(pk=invoice.pk).paid)
+        self.assertEqual(self.stripe.charges, [])
+
+    def test_pay_after_decline(self):
+        """Test a declined charge is kept and paying again makes a new attempt."""
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_hours=22.0,
+            total_amount=440.0,
+        )
+        invoice.timesheets.add(self.timesheet_1)
+        card = self.stripe.sources[self.contract.default_payment]
+        card['declines'] = True
+        response = self.client.post('/api/invoices/%s/pay/' % invoice.id)
+        self.assertEqual(response.status_code, 400, response)
+        declined = FremancerInvoice.objects.get(pk=invoice.pk)
+        self.assertEqual(declined.stripe_charge_status, 'failed')
+        self.assertEqual(declined.stripe_charge_id, self.stripe.charges[0]['id'])
+        card['declines'] = False
+        response = self.client.post('/api/invoices/%s/pay/' % invoice.id)
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(len(self.stripe.charges), 2)
+        self.assertTrue(FremancerInvoice.objects.get(pk=invoice.pk).paid)
+
+    def test_pay_retries_dropped_connection(self):
+        """Test a dropped charge request is retried without charging twice."""
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_hours=22.0,
+            total_amount=440.0,
+        )
+        invoice.timesheets.add(self.timesheet_1)
+        self.stripe.fail_next(1)
+        response = self.client.post('/api/invoices/%s/pay/' % invoice.id)
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(len(self.stripe.charges), 1)
+        self.assertEqual(self.stripe.requests[-1][2], 'invoice-%s-44000-cus_B8yCih3DvwhOR7-%s-first' % (
+            invoice.id, self.contract.default_payment))
+        # The charge events of the emulator are applied through the webhook.
+        for event in self.stripe.pop_events():
+            post_event(self.client, event)
+        apply_events()
+        self.assertEqual(FremancerStripeEvent.objects.get(event_type='charge.succeeded').status, 'applied')
+        self.assertTrue(FremancerInvoice.objects.get(pk=invoice.pk).paid)
 
     def test_get_balance(self):
         response = self.client.post('/api/invoices/', self.invoice_params)
@@ -157,9 +267,11 @@ class InvoicesTestCase(TestCase):
         response = self.client.post('/api/invoices/', self.invoice_params)
         self.assertEqual(response.status_code, 201, response)
         invoice = response.json()
+        FremancerInvoice.objects.filter(id=invoice.get('id')).update(stripe_charge_id='ch_webhook')
         test_event = {
+          "id": "evt_webhook",
           "object": {
-            "id": invoice.get('stripe_charge_id'),
+            "id": 'ch_webhook',
             "object": 'charge',
             "paid": True,
             "receipt_email": invoice.get('hirer@fremancer.com'),
@@ -167,14 +279,308 @@ class InvoicesTestCase(TestCase):
           }
         }
         c = APIClient()
-        response = c.post('/webhook/', data=test_event, format='json')
+        response = post_event(c, test_event)
         self.assertEqual(response.status_code, 200)
+        # Retries of the same event are stored once.
+        response = post_event(c, test_event)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FremancerStripeEvent.objects.count(), 1)
+        # Only events signed by Stripe are stored, and only under their id.
+        forged = dict(test_event, id='evt_forged')
+        response = post_event(c, forged, secret='whsec_forged')
+        self.assertEqual(response.status_code, 400)
+        response = c.post('/webhook/', data=forged, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = post_event(c, dict(test_event, id=None))
+        self.assertEqual(response.status_code, 400)
+        with self.settings(STRIPE_WEBHOOK_SECRET=''), self.assertRaises(ImproperlyConfigured):
+            post_event(c, forged, secret='')
+        self.assertEqual(FremancerStripeEvent.objects.count(), 1)
+        call_command('apply_stripe_events', stdout=open(os.devnull, 'w'))
         hooked_invoice = FremancerInvoice.objects.get(id=invoice.get('id'))
         self.assertEqual(hooked_invoice.paid, True)
         self.assertEqual(hooked_invoice.stripe_charge_status, 'test_status')
+        self.assertEqual(FremancerStripeEvent.objects.get().status, 'applied')
+
+    def test_stripe_webhook_batch(self):
+        """Test events are applied in batches, unknown ones are ignored."""
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            amount=840,
+            total_amount=864.66,
+            stripe_charge_id='ch_batch',
+            stripe_charge_status='pending')
+        invoice.timesheets.add(self.timesheet_1)
+        c = APIClient()
+        events = [
+            ('evt_1', 'charge.pending', {'id': 'ch_batch', 'object': 'charge', 'paid': False, 'status': 'pending'}),
+            ('evt_2', 'charge.succeeded', {'id': 'ch_batch', 'object': 'charge', 'paid': True, 'status': 'succeeded'}),
+            ('evt_3', 'charge.succeeded', {'id': 'ch_unknown', 'object': 'charge', 'paid': True, 'status': 'succeeded'}),
+            ('evt_4', 'customer.created', {'id': 'cus_1', 'object': 'customer'}),
+        ]
+        for event_id, event_type, obj in events:
+            post_event(c, {
+                'id': event_id, 'object': 'event', 'type': event_type, 'data': {'object': obj}
+            })
+        self.assertEqual(apply_events(batch_size=3), 4)
+        invoice = FremancerInvoice.objects.get(pk=invoice.pk)
+        self.assertTrue(invoice.paid)
+        self.assertEqual(invoice.stripe_charge_status, 'succeeded')
+        self.assertEqual(FremancerTimeSheet.objects.get(pk=self.timesheet_1.pk).status(), 'Paid')
+        statuses = dict(FremancerStripeEvent.objects.values_list('event_id', 'status'))
+        self.assertEqual(statuses, {
+            'evt_1': 'applied', 'evt_2': 'applied', 'evt_3': 'ignored', 'evt_4': 'ignored'})
+        # Replaying a range reapplies events already processed.
+        FremancerInvoice.objects.filter(pk=invoice.pk).update(paid=False)
+        self.assertEqual(apply_events(), 0)
+        self.assertEqual(apply_events(replay=True, since=invoice.date_created), 4)
+        self.assertTrue(FremancerInvoice.objects.get(pk=invoice.pk).paid)
+
+    def test_stripe_webhook_order(self):
+        """Test charge events apply in the order Stripe created them, late ones are ignored."""
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            amount=840,
+            total_amount=864.66,
+            stripe_charge_id='ch_order',
+            stripe_charge_status='pending')
+        c = APIClient()
+        for body in ['[]', '"event"', '1']:
+            response = post_event(c, body)
+            self.assertEqual(response.status_code, 400, response)
+        now = int(time.time())
+        events = [
+            ('evt_succeeded', now - 60, {'id': 'ch_order', 'object': 'charge', 'paid': True, 'status': 'succeeded'}),
+            ('evt_pending', now - 120, {'id': 'ch_order', 'object': 'charge', 'paid': False, 'status': 'pending'}),
+        ]
+        for event_id, created, obj in events:
+            post_event(c, {
+                'id': event_id, 'object': 'event', 'created': created, 'data': {'object': obj}
+            })
+        apply_events()
+        self.assertEqual(FremancerInvoice.objects.get(pk=invoice.pk).stripe_charge_status, 'succeeded')
+        # An older event delivered after the invoice synced is ignored.
+        post_event(c, {
+            'id': 'evt_failed', 'object': 'event', 'created': now - 90,
+            'data': {'object': {'id': 'ch_order', 'object': 'charge', 'paid': False, 'status': 'failed'}}
+        })
+        apply_events()
+        self.assertEqual(FremancerInvoice.objects.get(pk=invoice.pk).stripe_charge_status, 'succeeded')
+        self.assertEqual(FremancerStripeEvent.objects.get(event_id='evt_failed').status, 'ignored')
+        # One of the state already synced still applies, as when it was sent during the charge.
+        post_event(c, {
+            'id': 'evt_resent', 'object': 'event', 'created': now - 90,
+            'data': {'object': {'id': 'ch_order', 'object': 'charge', 'paid': True, 'status': 'succeeded'}}
+        })
+        apply_events()
+        self.assertEqual(FremancerStripeEvent.objects.get(event_id='evt_resent').status, 'applied')
+
+    def test_reconcile_charges(self):
+        """Test outstanding invoices are synced from a page of charges."""
+        invoices = []
+        for charge_id in ['ch_1', 'ch_2', 'ch_3']:
+            invoices.append(FremancerInvoice.objects.create(
+                hirer=self.hirer,
+                freelancer=self.freelancer,
+                contract=self.contract,
+                amount=100,
+                total_amount=100,
+                stripe_charge_id=charge_id,
+                stripe_charge_status='pending'))
+        charges = [
+            {'id': 'ch_0', 'paid': True, 'status': 'succeeded'},
+            {'id': 'ch_1', 'paid': True, 'status': 'succeeded'},
+            {'id': 'ch_2', 'paid': False, 'status': 'failed'},
+        ]
+        # Charges missing from the listing are retrieved, ch_3 is unknown to Stripe.
+        self.assertEqual(reconcile_charges(charges, batch_size=1), 3)
+        invoice_1, invoice_2, invoice_3 = [FremancerInvoice.objects.get(pk=i.pk) for i in invoices]
+        self.assertTrue(invoice_1.paid)
+        self.assertEqual(invoice_2.stripe_charge_status, 'failed')
+        self.assertIsNotNone(invoice_2.stripe_charge_synced)
+        self.assertEqual(invoice_3.stripe_charge_status, 'missing')
+        self.assertIsNotNone(invoice_3.stripe_charge_synced)
+        self.assertEqual(self.stripe.requests[-1][1], '/v1/charges/ch_3')
+        # Settled, failed and missing charges are not looked up again.
+        self.assertEqual(list(outstanding_invoices()), [])
+        self.assertEqual(reconcile_charges([]), 0)
+        # A charge the listing missed but Stripe knows is synced from its retrieval.
+        FremancerInvoice.objects.filter(pk=invoice_3.pk).update(
+            stripe_charge_status='pending', stripe_charge_synced=None)
+        response = self.client.post('/api/invoices/', self.invoice_params)
+        invoice = FremancerInvoice.objects.get(pk=response.json().get('id'))
+        self.client.post('/api/invoices/%s/pay/' % invoice.id)
+        charge_id = FremancerInvoice.objects.get(pk=invoice.pk).stripe_charge_id
+        FremancerInvoice.objects.filter(pk=invoice_3.pk).update(stripe_charge_id=charge_id)
+        FremancerInvoice.objects.filter(pk=invoice.pk).update(stripe_charge_id=None)
+        self.assertEqual(reconcile_charges([]), 1)
+        invoice_3 = FremancerInvoice.objects.get(pk=invoice_3.pk)
+        self.assertEqual((invoice_3.paid, invoice_3.stripe_charge_status), (True, 'succeeded'))
+        # Viewing an invoice only serves the local state.
+        response = self.client.get('/api/invoices/%s/' % invoice_3.id)
+        self.assertEqual(response.json().get('stripe_charge_status'), 'succeeded')
+        self.assertIn('stripe_charge_synced', response.json())
+
+    def test_pay_invoices_concurrently(self):
+        """Test bulk payment charges through a stub and stores results at once."""
+        invoices = []
+        for total_amount in [100, 200, 300]:
+            invoice = FremancerInvoice.objects.create(
+                hirer=self.hirer,
+                freelancer=self.freelancer,
+                contract=self.contract,
+                amount=total_amount,
+                total_amount=total_amount)
+            invoices.append(invoice)
+        invoices[0].timesheets.add(self.timesheet_1)
+        requests = []
+
+        def create_charge(**params):
+            requests.append(params)
+            if params['amount'] == 20000:
+                raise stripe.error.CardError('Your card was declined.', None, 'card_declined')
+            return {'id': 'ch_%s' % params['amount'], 'paid': True, 'status': 'succeeded'}
+
+        results = pay_invoices(invoices, 'cus_stub', create_charge=create_charge, workers=2)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(len(set(params['idempotency_key'] for params in requests)), 3)
+        self.assertEqual([error is None for _, _, error in results], [True, False, True])
+        paid = FremancerInvoice.objects.filter(paid=True).order_by('total_amount')
+        self.assertEqual([i.stripe_charge_id for i in paid], ['ch_10000', 'ch_30000'])
+        self.assertEqual(FremancerTimeSheet.objects.get(pk=self.timesheet_1.pk).status(), 'Paid')
+
+    def test_bulk_pay_validation(self):
+        """Test invoices that cannot be paid are reported without charging."""
+        paid_invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_amount=100,
+            paid=True)
+        pending_invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_amount=100,
+            stripe_charge_id='ch_pending',
+            stripe_charge_status='pending')
+        response = self.client.post('/api/invoices/bulk_pay/', {
+            'invoices': [paid_invoice.id, pending_invoice.id, 9999]
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(response.json(), [
+            {'invoice': paid_invoice.id, 'success': False, 'error': 'Invoice Already Paid'},
+            {'invoice': pending_invoice.id, 'success': False, 'error': 'Invoice Already Charged'},
+            {'invoice': 9999, 'success': False, 'error': 'Invalid Invoice'},
+        ])
+        self.assertEqual(self.stripe.charges, [])
+
+    def test_quote(self):
+        """Test quoting many invoices at once saves nothing."""
+        cache.set('stripe_source_type:src_cached', 'ach_credit_transfer')
+        response = self.client.post('/api/invoices/quote/', [
+            {'contract': self.contract.id, 'amount': 840},
+            {'default_payment': 'ba_1AoWMOCaQ7YmitAD', 'amount': 100},
+            {'default_payment': 'src_cached', 'amount': 100},
+        ], format='json')
+        self.assertEqual(response.status_code, 200, response)
+        quotes = response.json()
+        self.assertEqual(quotes[0].get('fee'), 24.66)
+        self.assertEqual(quotes[0].get('total_amount'), 864.66)
+        self.assertEqual(quotes[1].get('fee'), 5.0)
+        self.assertEqual(quotes[2].get('total_amount'), 105.0)
+        self.assertEqual(FremancerInvoice.objects.count(), 0)
+        response = self.client.post('/api/invoices/quote/', [{'amount': 10}], format='json')
+        self.assertEqual(response.status_code, 400, response)
+
+    def test_list_query_count(self):
+        """Test the invoice list and detail run a constant number of queries."""
+        for week in range(10):
+            timesheet = FremancerTimeSheet.objects.create(
+                contract=self.contract,
+                start_date=date(2017, 8, 7) + timedelta(weeks=week),
+                total_hours=10.0,
+                total_amount=200.0,
+                user=self.freelancer
+            )
+            invoice = FremancerInvoice.objects.create(
+                hirer=self.hirer,
+                freelancer=self.freelancer,
+                contract=self.contract,
+                total_hours=10.0,
+                amount=200.0,
+                total_amount=206.1)
+            invoice.timesheets.add(timesheet, self.timesheet_1)
+        # Membership, validators, count, page with contract and users, timesheets with their contract.
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/invoices/')
+        invoices = response.json().get('results')
+        self.assertEqual(len(invoices), 10)
+        self.assertEqual(invoices[0].get('contract_data').get('freelancer_name'), '')
+        self.assertEqual(len(invoices[0].get('timesheets_data')), 2)
+        self.assertEqual(invoices[0].get('timesheets_data')[0].get('status'), 'Invoiced')
+        # Membership, validators, invoice with contract and users, timesheets.
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/invoices/%s/' % invoice.id)
+        self.assertEqual(response.json().get('contract_data').get('id'), self.contract.id)
 
+    def test_invoice_summary(self):
+        """Test invoice amounts are aggregated in one query."""
+        other_contract = FremancerContract.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            description='Second contract',
+            default_payment='card_1AoWMOCaQ7YmitADQPH7cLQq',
+            duration='short',
+            contract_type='hourly',
+            hourly_rate=20.0
+        )
+        for contract, total_amount, paid, charge_status in [
+                (self.contract, 100, True, 'succeeded'),
+                (self.contract, 50, False, 'pending'),
+                (self.contract, 25, False, 'failed'),
+                (other_contract, 10, False, None)]:
+            FremancerInvoice.objects.create(
+                hirer=self.hirer,
+                freelancer=self.freelancer,
+                contract=contract,
+                amount=total_amount,
+                total_amount=total_amount,
+                paid=paid,
+                stripe_charge_status=charge_status)
+        # The membership and the grouped aggregate only.
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/invoices/summary/')
+        summary = response.json()
+        self.assertEqual(summary.get('count'), 4)
+        self.assertEqual(summary.get('total'), 185.0)
+        self.assertEqual(summary.get('pending'), 50.0)
+        self.assertEqual(summary.get('paid'), 100.0)
+        self.assertEqual(summary.get('cancelled'), 25.0)
+        self.assertEqual(summary.get('by_status').get('invoiced').get('total'), 10.0)
+        response = self.client.get('/api/invoices/summary/?contract=%s' % other_contract.id)
+        self.assertEqual(response.json().get('total'), 10.0)
+        response = self.client.get('/api/invoices/summary/?created_before=2000-01-01')
+        self.assertEqual(response.json().get('count'), 0)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
 class PaymentsTestCase(TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        super(PaymentsTestCase, cls).setUpClass()
+        cls.stripe = StripeEmulator().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stripe.stop()
+        super(PaymentsTestCase, cls).tearDownClass()
+
     def setUp(self):
         self.client = APIClient()
         response = self.client.post('/api/users/', {
@@ -197,24 +603,22 @@ class PaymentsTestCase(TestCase):
         hirer_bank = UserBank.objects.get(user=self.hirer)
         stripe_id = hirer_bank.stripe_customer_id
         self.assertIsNotNone(stripe_id)
-        stripe_user = stripe.Customer.retrieve(stripe_id)
+        stripe_user = stripe_gateway.retrieve_customer(stripe_id)
         self.assertEqual(stripe_user.sources.total_count, 1)
         # Add more stripe credit card.
         response = self.client.post('/api/payments/', {
             'id': 'tok_mastercard'
         })
         self.assertEqual(response.status_code, 201, response)
-        stripe_user = stripe.Customer.retrieve(stripe_id)
+        stripe_user = stripe_gateway.retrieve_customer(stripe_id)
         self.assertEqual(stripe_user.sources.total_count, 2)
         # Remove user from Stripe.
-        for customer in stripe.Customer.list().data:
-            if customer.email == 'test_stripe@fremancer.com':
-                customer.delete()
+        stripe_gateway.delete_customer(stripe_id)
 
     def test_create_bank_account(self):
         """Test creating first and adding more credit cards."""
         # Create bank account token.
-        token = stripe.Token.create(
+        token = stripe_gateway.create_token(
           bank_account={
             "country": 'US',
             "currency": 'usd',
@@ -232,14 +636,12 @@ class PaymentsTestCase(TestCase):
         hirer_bank = UserBank.objects.get(user=self.hirer)
         stripe_id = hirer_bank.stripe_customer_id
         self.assertIsNotNone(stripe_id)
-        stripe_user = stripe.Customer.retrieve(stripe_id)
-        user_sources = stripe_user.sources.all(object="bank_account")
+        stripe_user = stripe_gateway.retrieve_customer(stripe_id)
+        user_sources = stripe_user.sources.list(object="bank_account")
         self.assertEqual(len(user_sources.data), 1)
 
         # Remove user from Stripe.
-        for customer in stripe.Customer.list().data:
-            if customer.email == 'test_stripe@fremancer.com':
-                customer.delete()
+        stripe_gateway.delete_customer(stripe_id)
 
     def test_list_stripe_payment_options(self):
         response = self.client.get('/api/payments/')
@@ -257,3 +659,33 @@ class PaymentsTestCase(TestCase):
         # Remove the latest source.
         response = self.client.delete('/api/payments/%s/' % card.get('id'))
         self.assertEqual(response.status_code, 200, response)
+
+    def test_mirror_payment_sources(self):
+        """Test sources are mirrored from webhooks and listed locally."""
+        UserBank.objects.create(user=self.hirer, stripe_customer_id='cus_mirror')
+        card = {
+            'id': 'card_mirror', 'object': 'card', 'customer': 'cus_mirror',
+            'brand': 'Visa', 'last4': '4242', 'exp_month': 8, 'exp_year': 2030, 'name': 'Hirer'
+        }
+        bank_account = {
+            'id': 'ba_mirror', 'object': 'bank_account', 'customer': 'cus_mirror',
+            'bank_name': 'STRIPE TEST BANK', 'last4': '6789', 'account_holder_name': 'Hirer'
+        }
+        for event_id, event_type, obj in [
+                ('evt_card', 'customer.source.created', card),
+                ('evt_ba', 'customer.source.created', bank_account),
+                ('evt_ba_deleted', 'customer.source.deleted', bank_account)]:
+            post_event(self.client, {
+                'id': event_id, 'object': 'event', 'type': event_type, 'data': {'object': obj}
+            })
+        apply_events()
+        # Bank, validators and sources.
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/payments/')
+        self.assertEqual(response.json(), {
+            'stripe_id': 'cus_mirror',
+            'data': [{
+                'id': 'card_mirror', 'object': 'card', 'brand': 'Visa',
+                'last4': '4242', 'exp': '8/2030', 'name': 'Hirer'
+            }]
+        })
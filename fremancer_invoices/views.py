@@ -1,75 +1,60 @@
 import stripe
-
-from decimal import Decimal
-from django.conf import settings
+from django.db.models import Prefetch, Q
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, status
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
 
-from fremancer_invoices.serializers import InvoiceSerializer
+from fremancer import stripe_gateway
+from fremancer.conditional import ConditionalGetMixin, ConditionalModelMixin
+from fremancer_contracts.models import FremancerContract
+from fremancer_invoices.fees import quote
+from fremancer_invoices.filters import InvoiceFilter
+from fremancer_invoices.payments import pay_invoices
+from fremancer_invoices.serializers import BulkPaySerializer, InvoiceSerializer, QuoteSerializer
 from fremancer_invoices.models import FremancerInvoice
-from fremancer_users.models import UserProfile, UserBank
-
-stripe.api_key = settings.STRIPE_KEY
-STRIPE_CREDIT_PERCENTAGE = Decimal(0.029)  # 2.9%.
-STRIPE_CREDIT_FEE = Decimal(0.30)  # 30 cents.
-STRIPE_ACH_FEE = Decimal(5.0)  # 5 dollars.
-SOURCE_SPLIT_CHAR = '_'
+from fremancer_timesheets.models import FremancerTimeSheet
+from fremancer_users.models import UserBank, UserPaymentSource
 
 
-class InvoicesViewSet(viewsets.ModelViewSet):
+class InvoicesViewSet(ConditionalModelMixin, viewsets.ModelViewSet):
     """API endpoint for invoices handlers."""
     queryset = FremancerInvoice.objects.all().order_by('-date_created')
     serializer_class = InvoiceSerializer
+    filter_class = InvoiceFilter
+    cursor_ordering = ('-date_created', '-id')
+    last_modified_fields = ('date_changed', 'contract__date_changed', 'timesheets__date_changed')
 
     def get_queryset(self):
         """Pre filter queryset."""
-        profile = UserProfile.objects.get(user=self.request.user)
-        if profile.is_freelancer():
-            return FremancerInvoice.objects.filter(freelancer=self.request.user).order_by('-date_created')
+        # Contract users and timesheets with their contract are serialized nested.
+        timesheets = FremancerTimeSheet.objects.select_related('contract')
+        qs = FremancerInvoice.objects.select_related(
+            'contract__freelancer', 'contract__hirer'
+        ).prefetch_related(Prefetch('timesheets', queryset=timesheets))
+        if self.request.membership == 'freelancer':
+            return qs.filter(freelancer=self.request.user).order_by('-date_created')
         else:
-            return FremancerInvoice.objects.filter(hirer=self.request.user).order_by('-date_created')
-
-    def get_source_type(self, default_payment):
-        if default_payment.split(SOURCE_SPLIT_CHAR):
-            return default_payment.split(SOURCE_SPLIT_CHAR)[0]
-        source = stripe.Source.retrieve(default_payment)
-        return source.object
-
-    def calculate_fee(self, default_payment, amount):
-        source = self.get_source_type(default_payment)
-        if 'card' in source:
-            return amount * STRIPE_CREDIT_PERCENTAGE + STRIPE_CREDIT_FEE
-        else:
-            return STRIPE_ACH_FEE
-
-    def update_invoice_status(self, invoice):
-        charge = stripe.Charge.retrieve(invoice.stripe_charge_id)
-        invoice.paid = charge.paid
-        invoice.stripe_charge_status = charge.status
-        invoice.save()
-        return invoice
+            return qs.filter(hirer=self.request.user).order_by('-date_created')
 
     def create(self, request):
         """Create a new invoice."""
         serializer = InvoiceSerializer(data=request.data)
         if serializer.is_valid():
-            invoice = serializer.save(freelancer=request.user)
-            invoice.fee = self.calculate_fee(invoice.contract.default_payment, invoice.amount)
-            invoice.total_amount = invoice.amount + invoice.fee
-            invoice.save()
+            # Quote before saving, an invoice is never stored without its fee.
+            try:
+                fee, total_amount = quote(
+                    serializer.validated_data['contract'].default_payment,
+                    serializer.validated_data['amount'])
+            except stripe.error.StripeError as e:
+                unavailable = isinstance(e, stripe_gateway.RETRYABLE_ERRORS)
+                return Response(
+                    data={'error': str(e)},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE if unavailable else status.HTTP_400_BAD_REQUEST)
+            serializer.save(freelancer=request.user, fee=fee, total_amount=total_amount)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def retrieve(self, request, pk=None):
-        queryset = self.get_queryset()
-        invoice = get_object_or_404(queryset, pk=pk)
-        if invoice.stripe_charge_id and not invoice.paid:
-            invoice = self.update_invoice_status(invoice)
-        serializer = InvoiceSerializer(invoice)
-        return Response(serializer.data)
-
     def update(self, request, pk):
         return Response(
             data={'error': 'Unauthorized Request'},
@@ -80,122 +65,143 @@ class InvoicesViewSet(viewsets.ModelViewSet):
             data={'error': 'Unauthorized Request'},
             status=status.HTTP_400_BAD_REQUEST)
 
-    def create_metadata(self, invoice):
-        """Create metadata for Stripe."""
-        metadata = {
-            'contract': invoice.contract.id,
-            'hours': invoice.total_hours
-        }
-        index = 0
-        for ts in invoice.timesheets.all():
-            metadata['timesheet_%s_id' % index] = ts.id
-            metadata['timesheet_%s_hours' % index] = ts.total_hours
-            metadata['timesheet_%s_amount' % index] = ts.total_amount
-            index += 1
-        return metadata
-
     @detail_route(methods=['post'])
     def pay(self, request, pk):
         """Pay stub for owner."""
-        invoice = FremancerInvoice.objects.get(pk=pk)
-        assert not invoice.paid
+        invoice = get_object_or_404(FremancerInvoice, pk=pk, hirer=request.user)
+        if invoice.paid:
+            return Response(data='Invoice Already Paid', status=status.HTTP_400_BAD_REQUEST)
+        if invoice.charged:
+            return Response(data='Invoice Already Charged', status=status.HTTP_400_BAD_REQUEST)
         try:
             bank = UserBank.objects.get(user=request.user)
-            charge = stripe.Charge.create(
-                amount=int(invoice.total_amount * 100),
-                currency='usd',
-                customer=bank.stripe_customer_id,
-                source=invoice.contract.default_payment,
-                description='Charge for %s in %s hours' % (
-                    invoice.freelancer, invoice.total_hours
-                ),
-                metadata=self.create_metadata(invoice)
-            )
         except Exception as e:
             return Response(data=str(e), status=status.HTTP_400_BAD_REQUEST)
-        else:
-            invoice.paid = charge.paid
-            invoice.stripe_charge_id = charge.id
-            invoice.stripe_charge_status = charge.status
-            invoice.save()
-            return Response(charge)
+        [(invoice, charge, error)] = pay_invoices([invoice], bank.stripe_customer_id)
+        if error is not None:
+            return Response(data=str(error), status=status.HTTP_400_BAD_REQUEST)
+        return Response(charge)
+
+    @list_route(methods=['post'])
+    def bulk_pay(self, request):
+        """Pay many invoices at once, reporting the outcome of each."""
+        serializer = BulkPaySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        invoice_ids = serializer.validated_data['invoices']
+        bank = UserBank.objects.filter(user=request.user).exclude(stripe_customer_id=None).first()
+        if bank is None:
+            return Response(data={'error': 'No Payment Method'}, status=status.HTTP_400_BAD_REQUEST)
+        invoices = FremancerInvoice.objects.filter(
+            hirer=request.user, pk__in=invoice_ids
+        ).select_related('contract', 'freelancer').prefetch_related('timesheets').in_bulk()
+        report = dict((pk, {'invoice': pk, 'success': False}) for pk in invoice_ids)
+        payable = []
+        for pk in invoice_ids:
+            if pk not in invoices:
+                report[pk]['error'] = 'Invalid Invoice'
+            elif invoices[pk].paid:
+                report[pk]['error'] = 'Invoice Already Paid'
+            elif invoices[pk].charged:
+                report[pk]['error'] = 'Invoice Already Charged'
+            elif invoices[pk] not in payable:
+                payable.append(invoices[pk])
+        for invoice, charge, error in pay_invoices(payable, bank.stripe_customer_id):
+            if error is None:
+                report[invoice.pk].update({
+                    'success': True,
+                    'stripe_charge_id': invoice.stripe_charge_id,
+                    'stripe_charge_status': invoice.stripe_charge_status
+                })
+            else:
+                report[invoice.pk]['error'] = str(error)
+        return Response([report[pk] for pk in sorted(report, key=invoice_ids.index)])
+
+    @list_route(methods=['post'])
+    def quote(self, request):
+        """Quote fee and total amount of many prospective invoices, saving nothing."""
+        serializer = QuoteSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        contracts = FremancerContract.objects.filter(
+            Q(hirer=request.user) | Q(freelancer=request.user)
+        ).in_bulk([item['contract'] for item in serializer.validated_data if item.get('contract')])
+        quotes = []
+        for item in serializer.validated_data:
+            default_payment = item.get('default_payment')
+            if item.get('contract'):
+                if item['contract'] not in contracts:
+                    return Response(
+                        data={'error': 'Invalid Contract: %s' % item['contract']},
+                        status=status.HTTP_400_BAD_REQUEST)
+                default_payment = contracts[item['contract']].default_payment
+            fee, total_amount = quote(default_payment, item['amount'])
+            quotes.append({
+                'contract': item.get('contract'),
+                'default_payment': default_payment,
+                'amount': item['amount'],
+                'fee': fee,
+                'total_amount': total_amount
+            })
+        return Response(quotes)
 
     @list_route(methods=['get'])
     def balance(self, request):
         """Caculate the total of paid amount on an individual."""
-        total = 0
-        pending = 0
-        for invoice in self.get_queryset():
-            total += invoice.total_amount
-            if invoice.stripe_charge_status == 'pending':
-                pending += invoice.total_amount
-        return Response({
-            'total': total,
-            'pending': pending
-        })
+        return self.summary(request)
 
+    @list_route(methods=['get'])
+    def summary(self, request):
+        """Aggregate invoice amounts by charge status, filterable by contract and date."""
+        qs = self.filter_queryset(self.get_queryset())
+        return Response(qs.summary())
 
-class PaymentsViewSet(viewsets.ViewSet):
+
+class PaymentsViewSet(ConditionalGetMixin, viewsets.ViewSet):
     """API endpoint for handling payments managements."""
 
     def create(self, request):
         """Create a user account at Stripe with payment info."""
         bank, _ = UserBank.objects.get_or_create(user=request.user)
-        profile = UserProfile.objects.get(user=request.user)
         try:
             if not bank.stripe_customer_id:
-                customer = stripe.Customer.create(
+                customer = stripe_gateway.create_customer(
                     source=request.POST.get('id'),
                     email=request.user.email,
-                    description=profile.membership
+                    description=str(request.membership)
                 )
                 bank.stripe_customer_id = customer.id
                 bank.save()
                 if customer.sources.data:
                     card = customer.sources.data[0]
             else:
-                customer = stripe.Customer.retrieve(bank.stripe_customer_id)
-                card = customer.sources.create(card=request.POST.get('id'))
-                customer.save()
+                card = stripe_gateway.create_source(bank.stripe_customer_id, request.POST.get('id'))
             if card.object == 'bank_account':
-                card.verify(amounts=[32, 45])
+                stripe_gateway.verify_bank_account(card, amounts=[32, 45])
         except Exception as e:
             return Response(data=str(e), status=400)
         else:
+            UserPaymentSource.mirror(request.user.id, card)
             return Response({'id': card.id}, status=status.HTTP_201_CREATED)
 
     def list(self, request):
-        """List all payments associatd to a user."""
-        bank, _ = UserBank.objects.get_or_create(user=request.user)
-        payments = []
-        if bank.stripe_customer_id:
-            customer = stripe.Customer.retrieve(bank.stripe_customer_id)
-            for source in customer.sources:
-                source_data = {
-                    'id': source.id,
-                    'last4': source.last4,
-                    'object': source.object
-                }
-                if source.object == 'card':
-                    source_data['brand'] = source.brand
-                    source_data['exp'] = '%s/%s' % (source.exp_month, source.exp_year)
-                    source_data['name'] = source.name
-                else:
-                    source_data['brand'] = source.bank_name
-                    source_data['exp'] = ''
-                    source_data['name'] = source.account_holder_name
-                payments.append(source_data)
+        """List all payments associatd to a user from the local mirror."""
+        bank = UserBank.objects.filter(user=request.user).first()
+        sources = UserPaymentSource.objects.filter(user=request.user).order_by('date_created')
+        response = self.not_modified(request, sources, key=bank.stripe_customer_id if bank else None)
+        if response is not None:
+            return response
         return Response({
-            'data': payments,
-            'stripe_id': bank.stripe_customer_id
+            'data': [source.as_payment() for source in sources],
+            'stripe_id': bank.stripe_customer_id if bank else None
         })
 
     def destroy(self, request, pk):
         """Destroy associatd to a user."""
         bank = UserBank.objects.get(user=request.user)
         if bank.stripe_customer_id:
-            customer = stripe.Customer.retrieve(bank.stripe_customer_id)
-            customer.sources.retrieve(pk).delete()
+            stripe_gateway.delete_source(bank.stripe_customer_id, pk)
+            UserPaymentSource.objects.filter(user=request.user, stripe_source_id=pk).delete()
             return Response({'success': True})
         else:
             return Response(data='Invalid Request', status=400)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib import admin
+
+from fremancer_reports.models import MonthlyRollup, WeeklyRollup
+
+
+class RollupAdmin(admin.ModelAdmin):
+    """Rollups are rebuilt from timesheets and invoices, never edited by hand."""
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(WeeklyRollup)
+class WeeklyRollupAdmin(RollupAdmin):
+    list_display = ('user', 'contract', 'week', 'hours', 'amount', 'invoiced', 'paid')
+    list_filter = ('week',)
+
+
+@admin.register(MonthlyRollup)
+class MonthlyRollupAdmin(RollupAdmin):
+    list_display = ('user', 'month', 'invoices', 'hours', 'earned', 'spent', 'paid', 'unpaid')
+    list_filter = ('month',)
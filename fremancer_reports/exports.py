@@ -0,0 +1,159 @@
+"""Stream invoice, timesheet and withdrawal history as CSV or JSON Lines.
+
+Rows are read as tuples through a server-side cursor, with the contract
+and user columns joined in the same query, and written a chunk at a time.
+"""
+import csv
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from django.utils import six
+
+from fremancer.streaming import encode
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_timesheets.models import FremancerTimeSheet
+from fremancer_withdrawals.models import FremancerWithdrawal
+
+CHUNK_SIZE = 500
+# Spreadsheets run text cells starting with these as formulas.
+FORMULA_PREFIXES = ('=', '+', '-', '@')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+# Columns of each export, as (header, lookup).
+INVOICE_COLUMNS = (
+    ('id', 'id'),
+    ('date_created', 'date_created'),
+    ('contract_id', 'contract'),
+    ('contract', 'contract__title'),
+    ('hirer', 'hirer__username'),
+    ('freelancer', 'freelancer__username'),
+    ('total_hours', 'total_hours'),
+    ('amount', 'amount'),
+    ('fee', 'fee'),
+    ('total_amount', 'total_amount'),
+    ('paid', 'paid'),
+    ('charge_id', 'stripe_charge_id'),
+    ('charge_status', 'stripe_charge_status'),
+)
+TIMESHEET_COLUMNS = (
+    ('id', 'id'),
+    ('start_date', 'start_date'),
+    ('contract_id', 'contract'),
+    ('contract', 'contract__title'),
+    ('hirer', 'contract__hirer__username'),
+    ('freelancer', 'user__username'),
+    ('total_hours', 'total_hours'),
+    ('total_amount', 'total_amount'),
+    ('billing_status', 'billing_status'),
+    ('summary', 'summary'),
+)
+WITHDRAWAL_COLUMNS = (
+    ('id', 'id'),
+    ('date_created', 'date_created'),
+    ('freelancer', 'freelancer__username'),
+    ('method', 'method'),
+    ('receive_method', 'receive_method'),
+    ('receive', 'receive'),
+    ('fee', 'fee'),
+    ('total_amount', 'total_amount'),
+    ('status', 'status'),
+    ('cancel', 'cancel'),
+)
+
+
+def invoices(user, membership):
+    if membership == 'freelancer':
+        return FremancerInvoice.objects.filter(freelancer=user).order_by('date_created', 'id')
+    return FremancerInvoice.objects.filter(hirer=user).order_by('date_created', 'id')
+
+
+def timesheets(user, membership):
+    if membership == 'freelancer':
+        return FremancerTimeSheet.objects.filter(user=user).order_by('start_date', 'id')
+    return FremancerTimeSheet.objects.filter(contract__hirer=user).order_by('start_date', 'id')
+
+
+def withdrawals(user, membership):
+    return FremancerWithdrawal.objects.filter(freelancer=user).order_by('date_created', 'id')
+
+
+EXPORTS = {
+    'invoices': (INVOICE_COLUMNS, invoices),
+    'timesheets': (TIMESHEET_COLUMNS, timesheets),
+    'withdrawals': (WITHDRAWAL_COLUMNS, withdrawals),
+}
+
+
+def export_rows(records, user, membership):
+    """Get the headers and an iterator over the rows of a user's records."""
+    columns, scope = EXPORTS[records]
+    qs = scope(user, membership).values_list(*[lookup for header, lookup in columns])
+    return [header for header, lookup in columns], qs.iterator()
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, six.string_types) and value.startswith(FORMULA_PREFIXES):
+        # Quote user text so it reads as text, numbers and dates are left alone.
+        value = "'" + value
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    value = six.text_type(value)
+    # The Python 2 csv module only writes bytes.
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def iter_csv(headers, rows, chunk_size=CHUNK_SIZE):
+    """Yield CSV lines with a header, a chunk of rows at a time."""
+    buffer = six.BytesIO() if six.PY2 else six.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    count = 0
+    for row in rows:
+        writer.writerow([csv_value(value) for value in row])
+        count += 1
+        if count % chunk_size == 0:
+            yield flush(buffer)
+    yield flush(buffer)
+
+
+def flush(buffer):
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk if six.PY2 else chunk.encode('utf-8')
+
+
+def iter_jsonl(headers, rows, chunk_size=CHUNK_SIZE):
+    """Yield one JSON object per line, a chunk of rows at a time."""
+    lines = []
+    for row in rows:
+        # Amounts keep their exact decimal places, as in the API.
+        values = [str(value) if isinstance(value, Decimal) else value for value in row]
+        lines.append(encode(OrderedDict(zip(headers, values))) + b'\n')
+        if len(lines) >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+    if lines:
+        yield b''.join(lines)
+
+
+def iter_export(records, user, membership, output='csv', chunk_size=CHUNK_SIZE):
+    headers, rows = export_rows(records, user, membership)
+    if output == 'jsonl':
+        return iter_jsonl(headers, rows, chunk_size)
+    return iter_csv(headers, rows, chunk_size)
+
+
+def stream_export(records, user, membership, output='csv'):
+    """Respond with a user's records as a downloaded CSV or JSON Lines file."""
+    response = StreamingHttpResponse(
+        iter_export(records, user, membership, output),
+        content_type=CONTENT_TYPES[output])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (records, output)
+    return response
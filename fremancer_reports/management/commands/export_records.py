@@ -0,0 +1,31 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_text
+
+from fremancer_reports.exports import CONTENT_TYPES, EXPORTS, iter_export
+from fremancer_users.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Export the invoices, timesheets or withdrawals of a user as CSV or JSON Lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('records', choices=sorted(EXPORTS))
+        parser.add_argument('username')
+        parser.add_argument('--output-format', choices=sorted(CONTENT_TYPES), default='csv')
+        parser.add_argument('--output', help='File to write, stdout by default.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('User %s does not exist.' % options['username'])
+        chunks = iter_export(
+            options['records'], user, UserProfile.get_membership(user), options['output_format'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(force_text(chunk), ending='')
+            return
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
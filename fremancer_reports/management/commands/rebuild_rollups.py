@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_reports.models import MonthlyRollup, WeeklyRollup
+from fremancer_timesheets.models import FremancerTimeSheet
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the weekly and monthly report rollups from timesheets and invoices.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        timesheet_ids = list(FremancerTimeSheet.objects.order_by('pk').values_list('pk', flat=True))
+        for index in range(0, len(timesheet_ids), batch_size):
+            WeeklyRollup.refresh(timesheet_ids[index:index + batch_size])
+        # Rows of removed timesheets go with them, only months can go stale.
+        MonthlyRollup.objects.all().delete()
+        keys = set()
+        invoices = FremancerInvoice.objects.values_list('freelancer', 'hirer', 'date_created')
+        for freelancer_id, hirer_id, date_created in invoices.iterator():
+            keys |= MonthlyRollup.invoice_keys(freelancer_id, hirer_id, date_created)
+        keys = sorted(keys)
+        for index in range(0, len(keys), batch_size):
+            MonthlyRollup.refresh(keys[index:index + batch_size])
+        self.stdout.write('Rebuilt %s weeks and %s months.' % (len(timesheet_ids), len(keys)))
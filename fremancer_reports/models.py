@@ -0,0 +1,210 @@
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import models, transaction
+from django.db.models import Case, Count, DecimalField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from fremancer_contracts.models import FremancerContract
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_invoices.signals import invoices_changed
+from fremancer_timesheets.models import FremancerTimeSheet
+from fremancer_timesheets.signals import timesheets_changed
+
+
+def month_start(value):
+    """First day of the local month of a date or datetime."""
+    if isinstance(value, datetime):
+        value = timezone.localtime(value).date()
+    return value.replace(day=1)
+
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def local_midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def sum_when(condition, field):
+    """Sum a money field over the rows matching a condition."""
+    return Sum(Case(
+        When(condition, then=F(field)),
+        default=Value(0),
+        output_field=DecimalField(max_digits=12, decimal_places=2)))
+
+
+def amount_when(*billing_statuses):
+    """The timesheet amount in the given billing statuses, zero otherwise."""
+    return Case(
+        When(billing_status__in=billing_statuses, then=F('total_amount')),
+        default=Value(0),
+        output_field=DecimalField(max_digits=10, decimal_places=2))
+
+
+class WeeklyRollup(models.Model):
+    """Hours and amounts of a contract week, one row for each of its freelancer and hirer."""
+    user = models.ForeignKey(User, related_name='weekly_rollups')
+    contract = models.ForeignKey(FremancerContract, related_name='weekly_rollups')
+    timesheet = models.ForeignKey(FremancerTimeSheet, related_name='weekly_rollups')
+    week = models.DateField()  # The Monday of the ISO week.
+    hours = models.DecimalField(default=0.0, max_digits=7, decimal_places=2)
+    amount = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+    invoiced = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+    paid = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+
+    date_changed = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('user', 'contract', 'week'),)
+        # Dashboard of a user, latest week first.
+        index_together = (('user', 'week', 'contract'),)
+
+    @property
+    def year_week(self):
+        year, week, weekday = self.week.isocalendar()
+        return '%s-W%02d' % (year, week)
+
+    @classmethod
+    def refresh(cls, timesheet_ids):
+        """Rebuild the rows of the given timesheets from their current totals."""
+        timesheet_ids = set(timesheet_ids)
+        if not timesheet_ids:
+            return
+        timesheets = FremancerTimeSheet.objects.filter(pk__in=timesheet_ids).values_list(
+            'pk', 'contract', 'contract__hirer', 'user', 'start_date',
+            'total_hours', 'total_amount', 'billing_status')
+        rows = []
+        for pk, contract_id, hirer_id, user_id, start_date, hours, amount, billing_status in timesheets:
+            invoiced = amount if billing_status != FremancerTimeSheet.IN_PROGRESS else 0
+            paid = amount if billing_status == FremancerTimeSheet.PAID else 0
+            for participant_id in set([user_id, hirer_id]):
+                rows.append(cls(
+                    user_id=participant_id, contract_id=contract_id, timesheet_id=pk,
+                    week=start_date, hours=hours, amount=amount, invoiced=invoiced, paid=paid))
+        with transaction.atomic():
+            cls.objects.filter(timesheet__in=timesheet_ids).delete()
+            cls.objects.bulk_create(rows)
+
+    @classmethod
+    def update_totals(cls, timesheet_ids):
+        """Copy the totals of the given timesheets into their rows with one update.
+
+        Timesheets without rows yet are rebuilt instead.
+        """
+        timesheet_ids = set(timesheet_ids)
+        if not timesheet_ids:
+            return
+        timesheet = FremancerTimeSheet.objects.filter(pk=OuterRef('timesheet'))
+
+        def column(expression):
+            return Subquery(timesheet.annotate(value=expression).values('value')[:1])
+        rows = cls.objects.filter(timesheet__in=timesheet_ids)
+        updated = rows.update(
+            hours=column(F('total_hours')),
+            amount=column(F('total_amount')),
+            invoiced=column(amount_when(FremancerTimeSheet.INVOICED, FremancerTimeSheet.PAID)),
+            paid=column(amount_when(FremancerTimeSheet.PAID)),
+            date_changed=timezone.now())
+        # A timesheet has a row for its freelancer and one for its hirer.
+        if updated < 2 * len(timesheet_ids):
+            cls.refresh(timesheet_ids - set(rows.values_list('timesheet', flat=True)))
+
+
+class MonthlyRollup(models.Model):
+    """Invoiced earnings and spend of a user in a local calendar month."""
+    user = models.ForeignKey(User, related_name='monthly_rollups')
+    month = models.DateField()  # The first day of the month.
+    invoices = models.PositiveIntegerField(default=0)
+    hours = models.DecimalField(default=0.0, max_digits=9, decimal_places=2)
+    # Invoice amounts earned as a freelancer, totals spent as a hirer.
+    earned = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+    spent = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+    # Of those, what was paid and what is still unpaid.
+    paid = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+    unpaid = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+
+    date_changed = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('user', 'month'),)
+
+    @staticmethod
+    def invoice_keys(freelancer_id, hirer_id, date_created):
+        """Keys of the rows an invoice is counted in."""
+        month = month_start(date_created)
+        return set((user_id, month) for user_id in (freelancer_id, hirer_id) if user_id)
+
+    @classmethod
+    def refresh_invoices(cls, invoice_ids):
+        keys = set()
+        invoices = FremancerInvoice.objects.filter(pk__in=list(invoice_ids)).values_list(
+            'freelancer', 'hirer', 'date_created')
+        for freelancer_id, hirer_id, date_created in invoices:
+            keys |= cls.invoice_keys(freelancer_id, hirer_id, date_created)
+        cls.refresh(keys)
+
+    @classmethod
+    def refresh(cls, keys):
+        """Rebuild the rows of (user id, month) keys from their invoices."""
+        keys = set(keys)
+        if not keys:
+            return
+        rows = []
+        for user_id, month in keys:
+            freelancer, hirer = Q(freelancer=user_id), Q(hirer=user_id)
+            totals = FremancerInvoice.objects.filter(
+                freelancer | hirer,
+                date_created__gte=local_midnight(month),
+                date_created__lt=local_midnight(next_month(month))
+            ).aggregate(
+                invoices=Count('pk'),
+                hours=Sum('total_hours'),
+                earned=sum_when(freelancer, 'amount'),
+                spent=sum_when(hirer, 'total_amount'),
+                paid_earned=sum_when(freelancer & Q(paid=True), 'amount'),
+                paid_spent=sum_when(hirer & Q(paid=True), 'total_amount'))
+            if not totals['invoices']:
+                continue
+            paid = (totals['paid_earned'] or 0) + (totals['paid_spent'] or 0)
+            earned, spent = totals['earned'] or Decimal(0), totals['spent'] or Decimal(0)
+            rows.append(cls(
+                user_id=user_id, month=month, invoices=totals['invoices'], hours=totals['hours'] or 0,
+                earned=earned, spent=spent, paid=paid, unpaid=earned + spent - paid))
+        with transaction.atomic():
+            stale = Q()
+            for user_id, month in keys:
+                stale |= Q(user=user_id, month=month)
+            cls.objects.filter(stale).delete()
+            cls.objects.bulk_create(rows)
+
+
+@receiver(post_save, sender=FremancerTimeSheet)
+def timesheet_saved(sender, instance, **kwargs):
+    WeeklyRollup.refresh([instance.pk])
+
+
+@receiver(timesheets_changed)
+def timesheets_updated(sender, timesheet_ids, **kwargs):
+    WeeklyRollup.update_totals(timesheet_ids)
+
+
+@receiver(post_save, sender=FremancerInvoice)
+def invoice_saved(sender, instance, **kwargs):
+    MonthlyRollup.refresh(MonthlyRollup.invoice_keys(
+        instance.freelancer_id, instance.hirer_id, instance.date_created))
+
+
+@receiver(post_delete, sender=FremancerInvoice)
+def invoice_deleted(sender, instance, **kwargs):
+    MonthlyRollup.refresh(MonthlyRollup.invoice_keys(
+        instance.freelancer_id, instance.hirer_id, instance.date_created))
+
+
+@receiver(invoices_changed)
+def invoices_updated(sender, invoice_ids, **kwargs):
+    MonthlyRollup.refresh_invoices(invoice_ids)
@@ -0,0 +1,17 @@
+from rest_framework import serializers
+
+from fremancer_reports.models import MonthlyRollup, WeeklyRollup
+
+
+class WeeklyRollupSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = WeeklyRollup
+        fields = ('contract', 'timesheet', 'week', 'year_week', 'hours', 'amount', 'invoiced', 'paid')
+
+
+class MonthlyRollupSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = MonthlyRollup
+        fields = ('month', 'invoices', 'hours', 'earned', 'spent', 'paid', 'unpaid')
@@ -0,0 +1,160 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from fremancer_contracts.models import FremancerContract
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_invoices.stripe_events import update_invoices
+from fremancer_reports.exports import iter_export
+from fremancer_reports.models import MonthlyRollup, WeeklyRollup
+from fremancer_timesheets.models import FremancerDailySheet, FremancerTimeSheet
+from fremancer_users.models import UserProfile
+
+
+class ReportsTestCase(TestCase):
+    """Testing the rollups follow timesheets and invoices, and the reports read them."""
+
+    def setUp(self):
+        self.hirer = User.objects.create(username='hirer@fremancer.com')
+        UserProfile.objects.create(user=self.hirer, membership='hirer')
+        self.freelancer = User.objects.create(username='freelancer@fremancer.com')
+        UserProfile.objects.create(user=self.freelancer, membership='freelancer')
+        self.contract = FremancerContract.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            description='Test Contract creation',
+            duration='short',
+            contract_type='hourly',
+            hourly_rate=20.0)
+        self.timesheet = FremancerTimeSheet.objects.create(
+            contract=self.contract,
+            start_date=date(2017, 7, 3),
+            user=self.freelancer)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.freelancer)
+
+    def create_invoice(self):
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_hours=5.0,
+            amount=100.0,
+            total_amount=103.2,
+            stripe_charge_id='ch_report')
+        invoice.timesheets.add(self.timesheet)
+        return invoice
+
+    def test_weekly_follows_timesheets(self):
+        FremancerDailySheet.objects.create(
+            timesheet=self.timesheet, report_date=date(2017, 7, 4), user=self.freelancer, hours=5)
+        rows = WeeklyRollup.objects.filter(timesheet=self.timesheet)
+        self.assertEqual(set(rows.values_list('user', flat=True)), set([self.hirer.id, self.freelancer.id]))
+        for row in rows:
+            self.assertEqual((row.hours, row.amount, row.invoiced, row.paid),
+                             (Decimal('5'), Decimal('100'), 0, 0))
+        invoice = self.create_invoice()
+        self.assertEqual(rows.get(user=self.hirer).invoiced, Decimal('100'))
+        update_invoices({invoice.stripe_charge_id: (True, 'succeeded')})
+        self.assertEqual(rows.get(user=self.freelancer).paid, Decimal('100'))
+
+    def test_monthly_follows_invoices(self):
+        invoice = self.create_invoice()
+        month = timezone.localtime(invoice.date_created).date().replace(day=1)
+        freelancer = MonthlyRollup.objects.get(user=self.freelancer, month=month)
+        self.assertEqual((freelancer.invoices, freelancer.earned, freelancer.spent, freelancer.unpaid),
+                         (1, Decimal('100'), 0, Decimal('100')))
+        update_invoices({invoice.stripe_charge_id: (True, 'succeeded')})
+        hirer = MonthlyRollup.objects.get(user=self.hirer, month=month)
+        self.assertEqual((hirer.spent, hirer.paid, hirer.unpaid), (Decimal('103.2'), Decimal('103.2'), 0))
+        invoice.delete()
+        self.assertFalse(MonthlyRollup.objects.exists())
+
+    def test_reports(self):
+        FremancerTimeSheet.objects.create(
+            contract=self.contract, start_date=date(2017, 7, 10), user=self.freelancer, total_hours=2)
+        self.create_invoice()
+        response = self.client.get('/api/reports/weekly/', {'since': '2017-07-04'})
+        self.assertEqual(response.status_code, 200, response)
+        weeks = response.json()
+        self.assertEqual([week['year_week'] for week in weeks], ['2017-W28'])
+        self.assertEqual(weeks[0]['hours'], '2.00')
+        response = self.client.get('/api/reports/weekly/', {'contract': self.contract.id})
+        self.assertEqual(len(response.json()), 2)
+        response = self.client.get('/api/reports/weekly/', {'contract': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/reports/monthly/')
+        self.assertEqual(response.json()[0]['earned'], '100.00')
+        response = self.client.get('/api/reports/monthly/', {'until': 'July'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rebuild_rollups(self):
+        self.create_invoice()
+        weekly = WeeklyRollup.objects.order_by('user').values_list('user', 'week', 'amount', 'invoiced')
+        monthly = MonthlyRollup.objects.order_by('user').values_list('user', 'month', 'earned', 'spent')
+        expected = list(weekly), list(monthly)
+        WeeklyRollup.objects.all().delete()
+        MonthlyRollup.objects.all().delete()
+        call_command('rebuild_rollups', batch_size=1, stdout=open(os.devnull, 'w'))
+        self.assertEqual((list(weekly), list(monthly)), expected)
+
+    def test_export(self):
+        self.contract.title = u'Caf\xe9 website'
+        self.contract.save()
+        self.create_invoice()
+        self.client.force_authenticate(user=self.hirer)
+        response = self.client.get('/api/reports/export/invoices/')
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="invoices.csv"')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('id,date_created,contract_id,contract,hirer,freelancer'))
+        self.assertIn(u'Caf\xe9 website,hirer@fremancer.com,freelancer@fremancer.com,5.00,100.00', lines[1])
+        response = self.client.get('/api/reports/export/timesheets/', {'output': 'jsonl'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([(row['start_date'], row['freelancer'], row['total_amount']) for row in rows],
+                         [('2017-07-03', 'freelancer@fremancer.com', '0.00')])
+
+    def test_export_formulas(self):
+        self.contract.title = '=HYPERLINK("http://example.com")'
+        self.contract.save()
+        FremancerTimeSheet.objects.filter(contract=self.contract).update(summary='-1+2')
+        FremancerTimeSheet.objects.create(
+            contract=self.contract, start_date=date(2017, 7, 10), user=self.freelancer,
+            total_amount=-5, summary='@SUM(A1)')
+        self.client.force_authenticate(user=self.hirer)
+        response = self.client.get('/api/reports/export/timesheets/')
+        rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual([(row[3], row[7], row[9]) for row in rows[1:]], [
+            ('\'=HYPERLINK("http://example.com")', '0.00', "'-1+2"),
+            ('\'=HYPERLINK("http://example.com")', '-5.00', "'@SUM(A1)"),
+        ])
+        # JSON Lines is read as data, never as formulas.
+        response = self.client.get('/api/reports/export/timesheets/', {'output': 'jsonl'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(rows[0]['summary'], '-1+2')
+        response = self.client.get('/api/reports/export/withdrawals/', {'output': 'xml'})
+        self.assertEqual(response.status_code, 400)
+        # Users and contracts are joined in, whatever the number of rows.
+        with self.assertNumQueries(1):
+            list(iter_export('invoices', self.hirer, 'hirer', chunk_size=1))
+
+    def test_export_command(self):
+        self.create_invoice()
+        path = os.path.join(tempfile.mkdtemp(), 'invoices.jsonl')
+        call_command('export_records', 'invoices', self.freelancer.username, output_format='jsonl', output=path)
+        with open(path) as output:
+            rows = [json.loads(line) for line in output]
+        shutil.rmtree(os.path.dirname(path))
+        self.assertEqual([(row['freelancer'], row['amount'], row['paid']) for row in rows],
+                         [('freelancer@fremancer.com', '100.00', False)])
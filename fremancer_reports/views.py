@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from rest_framework import status
+from rest_framework import viewsets
+from rest_framework.decorators import list_route
+from rest_framework.response import Response
+
+from fremancer.conditional import ConditionalGetMixin
+from fremancer_reports.exports import CONTENT_TYPES, EXPORTS, stream_export
+from fremancer_reports.models import MonthlyRollup, WeeklyRollup
+from fremancer_reports.serializers import MonthlyRollupSerializer, WeeklyRollupSerializer
+
+
+class ReportsViewSet(ConditionalGetMixin, viewsets.ViewSet):
+    """API endpoint for the weekly and monthly reports of freelancers and hirers.
+
+    Reads the rollup tables only, filter with `since` and `until` dates.
+    Full history is exported from `export/<records>/`.
+    """
+
+    def date_range(self, request, field):
+        filters = {}
+        for param, lookup in (('since', 'gte'), ('until', 'lte')):
+            value = request.query_params.get(param)
+            if value:
+                filters['%s__%s' % (field, lookup)] = datetime.strptime(value, '%Y-%m-%d').date()
+        return filters
+
+    def bad_dates(self):
+        return Response(
+            data={'error': 'Dates must be formatted YYYY-MM-DD.'},
+            status=status.HTTP_400_BAD_REQUEST)
+
+    @list_route(methods=['get'])
+    def weekly(self, request):
+        """Hours and amounts per contract and week, latest week first."""
+        try:
+            filters = self.date_range(request, 'week')
+        except ValueError:
+            return self.bad_dates()
+        if request.query_params.get('contract'):
+            try:
+                filters['contract'] = int(request.query_params.get('contract'))
+            except ValueError:
+                return Response(
+                    data={'error': 'Contract must be an id.'},
+                    status=status.HTTP_400_BAD_REQUEST)
+        qs = WeeklyRollup.objects.filter(user=request.user, **filters).order_by('-week', '-contract')
+        response = self.not_modified(request, qs)
+        if response is not None:
+            return response
+        return Response(WeeklyRollupSerializer(qs, many=True).data)
+
+    @list_route(methods=['get'])
+    def monthly(self, request):
+        """Invoiced earnings and spend per month, latest month first."""
+        try:
+            filters = self.date_range(request, 'month')
+        except ValueError:
+            return self.bad_dates()
+        qs = MonthlyRollup.objects.filter(user=request.user, **filters).order_by('-month')
+        response = self.not_modified(request, qs)
+        if response is not None:
+            return response
+        return Response(MonthlyRollupSerializer(qs, many=True).data)
+
+    @list_route(methods=['get'], url_path='export/(?P<records>%s)' % '|'.join(sorted(EXPORTS)))
+    def export(self, request, records):
+        """Stream every invoice, timesheet or withdrawal of the user, `output=csv` or `output=jsonl`."""
+        output = request.query_params.get('output', 'csv')
+        if output not in CONTENT_TYPES:
+            return Response(
+                data={'error': 'Output must be one of %s.' % ', '.join(sorted(CONTENT_TYPES))},
+                status=status.HTTP_400_BAD_REQUEST)
+        return stream_export(records, request.user, request.membership, output)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from fremancer_timesheets.models import FremancerDailySheet, FremancerTimeSheet, to_hours
+from fremancer_timesheets.signals import timesheets_changed
+
+
+class Command(BaseCommand):
+    help = 'Recompute timesheet totals from their daily sheets, repairing drifted history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--contract', type=int, help='Only recompute timesheets of this contract.')
+        parser.add_argument(
+            '--include-invoiced', action='store_true',
+            help='Also repair invoiced and paid timesheets, their invoices were billed from the old totals.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        timesheets = FremancerTimeSheet.objects.select_related('contract').order_by('pk')
+        if options['contract']:
+            timesheets = timesheets.filter(contract=options['contract'])
+        timesheet_ids = list(timesheets.values_list('pk', flat=True))
+        repaired = skipped = 0
+        for index in range(0, len(timesheet_ids), batch_size):
+            batch = timesheet_ids[index:index + batch_size]
+            hours = dict(
+                FremancerDailySheet.objects.filter(timesheet__in=batch).values_list(
+                    'timesheet').annotate(hours=Sum('hours')))
+            with transaction.atomic():
+                changed = []
+                for timesheet in timesheets.filter(pk__in=batch):
+                    total_hours = to_hours(hours.get(timesheet.pk))
+                    total_amount = timesheet.amount_for_hours(total_hours)
+                    if (timesheet.total_hours, timesheet.total_amount) != (total_hours, total_amount):
+                        if not timesheet.is_editable() and not options['include_invoiced']:
+                            # Their invoices were billed from these totals, only report them.
+                            skipped += 1
+                            continue
+                        # Invoiced timesheets refuse save(), history is repaired on request.
+                        FremancerTimeSheet.objects.filter(pk=timesheet.pk).update(
+                            total_hours=total_hours, total_amount=total_amount, date_changed=timezone.now())
+                        changed.append(timesheet.pk)
+                if changed:
+                    timesheets_changed.send(sender=FremancerTimeSheet, timesheet_ids=changed)
+                repaired += len(changed)
+        self.stdout.write('Recomputed %s timesheets, repaired %s, left %s invoiced ones drifted.' % (
+            len(timesheet_ids), repaired, skipped))
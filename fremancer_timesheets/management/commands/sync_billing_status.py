@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+
+from fremancer_contracts.models import FremancerContract
+from fremancer_timesheets.models import FremancerTimeSheet
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized billing status and hirer of every timesheet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        FremancerTimeSheet.objects.filter(hirer=None).update(hirer=Subquery(
+            FremancerContract.objects.filter(pk=OuterRef('contract')).values('hirer')[:1]))
+        timesheet_ids = list(FremancerTimeSheet.objects.values_list('pk', flat=True))
+        for index in range(0, len(timesheet_ids), batch_size):
+            FremancerTimeSheet.sync_billing_status(timesheet_ids[index:index + batch_size])
+        self.stdout.write('Synced %s timesheets.' % len(timesheet_ids))
@@ -1,8 +1,19 @@
+from decimal import Decimal
+
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, SuspiciousOperation
-from django.db import models
+from django.db import models, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F
+from django.utils import timezone
 
 from fremancer_contracts.models import FremancerContract
+from fremancer_timesheets.signals import timesheets_changed
+
+CENTS = Decimal('0.01')
+
+
+def to_hours(hours):
+    return Decimal(str(hours or 0))
 
 
 def validate_monday(day):
@@ -17,8 +28,14 @@ def validate_monday(day):
 
 class FremancerTimeSheet(models.Model):
     """A weekly time report for freelancer."""
+    IN_PROGRESS = 'progress'
+    INVOICED = 'invoiced'
+    PAID = 'paid'
+
     contract = models.ForeignKey(FremancerContract)
     user = models.ForeignKey(User)
+    # Denormalized from the contract, so hirer lists are read in index order.
+    hirer = models.ForeignKey(User, related_name='hired_timesheets', blank=True, null=True)
     start_date = models.DateField(
         validators=[validate_monday])  # Must be a Monday.
     summary = models.TextField(blank=True)
@@ -30,12 +47,26 @@ class FremancerTimeSheet(models.Model):
         default=0.0,
         max_digits=10,
         decimal_places=2)
+    # Denormalized from the invoices covering this timesheet.
+    billing_status = models.CharField(max_length=25, default=IN_PROGRESS, db_index=True, choices=[
+        [IN_PROGRESS, 'In Progress'],
+        [INVOICED, 'Invoiced'],
+        [PAID, 'Paid']
+    ])
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_changed = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = (('contract', 'start_date'),)
+        index_together = (
+            # Not yet invoiced timesheets of a contract or a freelancer.
+            ('contract', 'billing_status'), ('user', 'billing_status'),
+            # Freelancer list, last changed first.
+            ('user', 'date_changed'),
+            # Freelancer and hirer lists, latest week first.
+            ('user', 'start_date'), ('hirer', 'start_date'),
+        )
         ordering = ['-start_date']
 
     def __str__(self):
@@ -50,23 +81,76 @@ class FremancerTimeSheet(models.Model):
         return self.contract.title
 
     def invoiced(self):
-        return FremancerTimeSheet.objects.filter(pk=self.pk, fremancer_invoice__isnull=False).exists()
+        return self.billing_status != self.IN_PROGRESS
 
     def paid(self):
-        return FremancerTimeSheet.objects.filter(pk=self.pk, fremancer_invoice__paid=True).exists()
+        return self.billing_status == self.PAID
 
     def status(self):
-        if self.paid():
-            return 'Paid'
-        elif self.invoiced():
-            return 'Invoiced'
-        return 'In Progress'
+        return self.get_billing_status_display()
+
+    def amount_for_hours(self, total_hours):
+        """Amount earned for the hours of the week under the contract terms."""
+        contract = self.contract
+        if contract.is_hourly() and contract.hourly_rate is not None:
+            return (contract.hourly_rate * Decimal(total_hours)).quantize(CENTS)
+        if contract.is_wage() and contract.wage_amount is not None:
+            return contract.wage_amount
+        return self.total_amount
 
     def is_editable(self):
         """Flag whether a timesheet is editable any more."""
         return False if self.invoiced() or self.paid() else True
 
+    @classmethod
+    def sync_billing_status(cls, timesheet_ids):
+        """Recompute the denormalized billing status from the invoices."""
+        timesheet_ids = set(timesheet_ids)
+        if not timesheet_ids:
+            return
+        qs = cls.objects.filter(pk__in=timesheet_ids)
+        paid = set(qs.filter(fremancer_invoice__paid=True).values_list('pk', flat=True))
+        invoiced = set(qs.filter(fremancer_invoice__isnull=False).values_list('pk', flat=True))
+        now = timezone.now()
+        for status, pks in [
+                (cls.PAID, paid),
+                (cls.INVOICED, invoiced - paid),
+                (cls.IN_PROGRESS, timesheet_ids - invoiced)]:
+            if pks:
+                qs.filter(pk__in=pks).exclude(billing_status=status).update(
+                    billing_status=status, date_changed=now)
+        timesheets_changed.send(sender=cls, timesheet_ids=timesheet_ids)
+
+    @classmethod
+    def lock_editable(cls, timesheet_ids):
+        """Lock timesheets whose daily sheets change, refusing the invoiced ones."""
+        statuses = cls.objects.select_for_update().filter(
+            pk__in=set(timesheet_ids)).order_by().values_list('billing_status', flat=True)
+        if any(status != cls.IN_PROGRESS for status in statuses):
+            raise SuspiciousOperation('Timesheet nolonger editable.')
+
+    @classmethod
+    def add_hours(cls, timesheet_id, hours):
+        """Apply a change of daily hours to the week totals with one update."""
+        if not hours:
+            return
+        contract = FremancerContract.objects.only(
+            'contract_type', 'hourly_rate', 'wage_amount'
+        ).get(fremancertimesheet=timesheet_id)
+        total_hours = F('total_hours') + hours
+        values = {'total_hours': total_hours, 'date_changed': timezone.now()}
+        if contract.is_hourly() and contract.hourly_rate is not None:
+            values['total_amount'] = ExpressionWrapper(
+                total_hours * contract.hourly_rate, output_field=DecimalField())
+        elif contract.is_wage() and contract.wage_amount is not None:
+            values['total_amount'] = contract.wage_amount
+        # Invoiced totals stay those of their invoice.
+        cls.objects.filter(pk=timesheet_id, billing_status=cls.IN_PROGRESS).update(**values)
+        timesheets_changed.send(sender=cls, timesheet_ids=[timesheet_id])
+
     def save(self, *args, **kwargs):
+        if self.hirer_id is None:
+            self.hirer_id = self.contract.hirer_id
         if self.is_editable():
             super(FremancerTimeSheet, self).save(*args, **kwargs)
         else:
@@ -91,4 +175,49 @@ class FremancerDailySheet(models.Model):
 
     class Meta:
         unique_together = (('timesheet', 'report_date'),)
+        # Freelancer list, latest day first.
+        index_together = (('user', 'report_date'),)
         ordering = ['report_date']
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(FremancerDailySheet, cls).from_db(db, field_names, values)
+        instance._loaded_timesheet_id = instance.timesheet_id
+        return instance
+
+    def lock_stored(self):
+        """Lock the weeks and the stored row of the day, and get its (timesheet, hours).
+
+        The delta is taken from the locked row, so concurrent edits of a day apply in turn.
+        """
+        loaded_timesheet_id = getattr(self, '_loaded_timesheet_id', self.timesheet_id)
+        FremancerTimeSheet.lock_editable([self.timesheet_id, loaded_timesheet_id])
+        stored = None
+        if self.pk is not None:
+            stored = FremancerDailySheet.objects.select_for_update().filter(
+                pk=self.pk).order_by().values_list('timesheet', 'hours').first()
+        if stored is None:
+            return self.timesheet_id, Decimal(0)
+        if stored[0] != loaded_timesheet_id:
+            # Moved to another week since it was read.
+            FremancerTimeSheet.lock_editable([stored[0]])
+        return stored[0], to_hours(stored[1])
+
+    def save(self, *args, **kwargs):
+        """Save and roll the change of hours up into the timesheet totals."""
+        with transaction.atomic():
+            stored_timesheet_id, stored_hours = self.lock_stored()
+            super(FremancerDailySheet, self).save(*args, **kwargs)
+            hours = to_hours(self.hours)
+            if stored_timesheet_id != self.timesheet_id:
+                FremancerTimeSheet.add_hours(stored_timesheet_id, -stored_hours)
+                stored_hours = 0
+            FremancerTimeSheet.add_hours(self.timesheet_id, hours - stored_hours)
+        self._loaded_timesheet_id = self.timesheet_id
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            stored_timesheet_id, stored_hours = self.lock_stored()
+            result = super(FremancerDailySheet, self).delete(*args, **kwargs)
+            FremancerTimeSheet.add_hours(stored_timesheet_id, -stored_hours)
+        return result
@@ -1,31 +1,135 @@
+from datetime import timedelta
+from decimal import Decimal
+
 from django.core.exceptions import ValidationError
+from django.db.models import Case, CharField, DecimalField, Sum, Value, When
+from django.utils import timezone
 from rest_framework import serializers
 
 from fremancer_timesheets.models import FremancerTimeSheet, FremancerDailySheet
-from fremancer_contracts.models import FremancerContract
+from fremancer_timesheets.signals import timesheets_changed
 
 
 class TimeSheetSerializer(serializers.ModelSerializer):
     contract_title = serializers.CharField(read_only=True)
     status = serializers.CharField(read_only=True)
 
-    def validate_total_hours(self, total_hours):
-        contract = FremancerContract.objects.get(pk=self.initial_data.get('contract'))
-        if contract.is_hourly() and total_hours > contract.max_weekly_hours:
-            raise ValidationError(
-                'Invalid Total Hours: %s - Max: %s' % (
-                    total_hours,
-                    contract.max_weekly_hours)
-            )
-        return total_hours
-
     class Meta:
         model = FremancerTimeSheet
         fields = '__all__'
+        # The week totals are rolled up from the daily sheets only.
+        read_only_fields = ('billing_status', 'hirer', 'total_hours', 'total_amount')
 
 
 class DailySheetSerializer(serializers.ModelSerializer):
 
+    def validate(self, data):
+        """Validate the week is still editable and stays within the contract maximum hours."""
+        instance = self.instance
+        timesheet = data.get('timesheet', instance.timesheet if instance else None)
+        for week in set([timesheet, instance.timesheet if instance else timesheet]):
+            if not week.is_editable():
+                raise ValidationError('Timesheet %s nolonger editable.' % week.pk)
+        report_date = data.get('report_date', instance.report_date if instance else None)
+        hours = data.get('hours', instance.hours if instance else 0)
+        contract = timesheet.contract
+        if contract.is_hourly() and contract.max_weekly_hours is not None:
+            other_days = FremancerDailySheet.objects.filter(
+                timesheet=timesheet
+            ).exclude(report_date=report_date).aggregate(hours=Sum('hours'))
+            total_hours = (other_days['hours'] or 0) + (hours or 0)
+            if total_hours > contract.max_weekly_hours:
+                raise ValidationError(
+                    'Invalid Total Hours: %s - Max: %s' % (total_hours, contract.max_weekly_hours))
+        return data
+
     class Meta:
         model = FremancerDailySheet
         fields = '__all__'
+
+
+class DailySheetEntrySerializer(serializers.Serializer):
+    timesheet = serializers.IntegerField()
+    report_date = serializers.DateField()
+    hours = serializers.DecimalField(
+        max_digits=4, decimal_places=2, min_value=0, max_value=24, required=False, allow_null=True)
+    summary = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+
+
+class DailySheetsUpsertSerializer(serializers.Serializer):
+    """Upsert the daily sheets of one or more weeks, a later entry of a day wins."""
+    daily_sheets = serializers.ListField(child=DailySheetEntrySerializer(), min_length=1, max_length=100)
+
+    def validate(self, data):
+        """Validate the weeks once, with every day of the request applied."""
+        entries = data.get('daily_sheets')
+        timesheet_ids = set(entry['timesheet'] for entry in entries)
+        timesheets = FremancerTimeSheet.objects.select_related('contract').select_for_update().filter(
+            pk__in=timesheet_ids, user=self.context['user']).in_bulk()
+        unknown = timesheet_ids - set(timesheets)
+        if unknown:
+            raise ValidationError('Invalid Timesheets: %s' % ', '.join(str(pk) for pk in sorted(unknown)))
+        for timesheet in timesheets.values():
+            if not timesheet.is_editable():
+                raise ValidationError('Timesheet %s nolonger editable.' % timesheet.pk)
+        sheets = dict(
+            ((sheet.timesheet_id, sheet.report_date), sheet)
+            for sheet in FremancerDailySheet.objects.filter(timesheet__in=timesheet_ids))
+        hours = dict((key, sheet.hours or 0) for key, sheet in sheets.items())
+        for entry in entries:
+            timesheet = timesheets[entry['timesheet']]
+            end_date = timesheet.start_date + timedelta(days=6)
+            if not timesheet.start_date <= entry['report_date'] <= end_date:
+                raise ValidationError('Invalid Report Date: %s' % entry['report_date'])
+            if 'hours' in entry:
+                hours[(timesheet.pk, entry['report_date'])] = entry['hours'] or 0
+        total_hours = dict((pk, Decimal(0)) for pk in timesheets)
+        for (timesheet_id, report_date), day_hours in hours.items():
+            total_hours[timesheet_id] += Decimal(day_hours)
+        for pk, timesheet in timesheets.items():
+            contract = timesheet.contract
+            if contract.is_hourly() and total_hours[pk] > contract.max_weekly_hours:
+                raise ValidationError(
+                    'Invalid Total Hours: %s - Max: %s' % (total_hours[pk], contract.max_weekly_hours))
+        data['timesheets'] = timesheets
+        data['sheets'] = sheets
+        data['total_hours'] = total_hours
+        return data
+
+    def save(self):
+        """Write the days with one update and one insert, then the week totals."""
+        data = self.validated_data
+        timesheets, sheets = data['timesheets'], data['sheets']
+        now = timezone.now()
+        changed = {}
+        for entry in data['daily_sheets']:
+            key = (entry['timesheet'], entry['report_date'])
+            sheet = sheets.get(key) or FremancerDailySheet(
+                timesheet=timesheets[entry['timesheet']],
+                report_date=entry['report_date'],
+                user=self.context['user'])
+            for field in ('hours', 'summary'):
+                if field in entry:
+                    setattr(sheet, field, entry[field])
+            sheets[key] = changed[key] = sheet
+        existing = [day for day in changed.values() if day.pk is not None]
+        if existing:
+            FremancerDailySheet.objects.filter(pk__in=[day.pk for day in existing]).update(
+                hours=Case(*[When(pk=day.pk, then=Value(day.hours)) for day in existing],
+                           output_field=DecimalField()),
+                summary=Case(*[When(pk=day.pk, then=Value(day.summary)) for day in existing],
+                             output_field=CharField()),
+                date_changed=now)
+        FremancerDailySheet.objects.bulk_create(
+            [day for day in changed.values() if day.pk is None])
+        for pk, timesheet in timesheets.items():
+            timesheet.total_hours = data['total_hours'][pk]
+            timesheet.total_amount = timesheet.amount_for_hours(timesheet.total_hours)
+        FremancerTimeSheet.objects.filter(pk__in=list(timesheets)).update(
+            total_hours=Case(*[When(pk=pk, then=Value(timesheet.total_hours))
+                               for pk, timesheet in timesheets.items()], output_field=DecimalField()),
+            total_amount=Case(*[When(pk=pk, then=Value(timesheet.total_amount))
+                                for pk, timesheet in timesheets.items()], output_field=DecimalField()),
+            date_changed=now)
+        timesheets_changed.send(sender=FremancerTimeSheet, timesheet_ids=list(timesheets))
+        return sorted(timesheets.values(), key=lambda timesheet: timesheet.start_date)
@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent when timesheets change through queryset updates, which skip post_save.
+timesheets_changed = Signal(providing_args=['timesheet_ids'])
@@ -1,11 +1,16 @@
-from datetime import date
+import os
+from datetime import date, timedelta
+
+from django.core.management import call_command
 from django.contrib.auth.models import User
+from django.core.exceptions import SuspiciousOperation
 from django.test import TestCase, Client
 from rest_framework.test import APIClient
 
 from fremancer_users.models import UserProfile
 from fremancer_contracts.models import FremancerContract
 from fremancer_timesheets.models import FremancerTimeSheet, FremancerDailySheet
+from fremancer_timesheets.serializers import DailySheetsUpsertSerializer
 
 
 class TimeSheetsTestCase(TestCase):
@@ -68,14 +73,38 @@ class TimeSheetsTestCase(TestCase):
             self.assertGreaterEqual(daily_sheet.report_date, timesheet.start_date)
 
     def test_create_over_weekly_hours(self):
-        response = self.client.post('/api/timesheets/', {
-            'contract': self.contract.id,
-            'start_date': '2017-07-10',
-            'summary': 'Test TimeSheet',
-            'total_hours': self.contract.max_weekly_hours + 10.0
-            'total_amount': 400.0,
+        """Test the daily sheets of a week stay within the contract maximum hours."""
+        FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 3),
+            hours=20,
+            user=self.freelancer
+        )
+        response = self.client.post('/api/dailysheets/', {
+            'report_date': '2017-07-04',
+            'hours': 15,
+            'timesheet': self.timesheet.id,
+            'user': self.freelancer.id
         })
         self.assertEqual(response.status_code, 400, response)
+        response = self.client.post('/api/dailysheets/', {
+            'report_date': '2017-07-04',
+            'hours': 10,
+            'timesheet': self.timesheet.id,
+            'user': self.freelancer.id
+        })
+        self.assertEqual(response.status_code, 201, response)
+
+    def test_totals_read_only(self):
+        """Test the week totals are only written from the daily sheets."""
+        response = self.client.patch('/api/timesheets/%s/' % self.timesheet.id, {
+            'summary': 'Week',
+            'total_hours': 35.0,
+            'total_amount': 1.0
+        })
+        self.assertEqual(response.status_code, 200, response)
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.summary, timesheet.total_hours, timesheet.total_amount), ('Week', 20, 400))
 
     def test_create_daily_timesheet(self):
         """Test creating a regular daily timesheet."""
@@ -106,3 +135,384 @@ class TimeSheetsTestCase(TestCase):
         """Test getting list of unpaid timesheets."""
         response = self.client.get('/api/timesheets/unpaid/')
         self.assertEqual(response.status_code, 200, response)
+
+    def test_unpaid_scoped_totals(self):
+        """Test unpaid timesheets are scoped to the user and totalled in one query."""
+        from fremancer_invoices.models import FremancerInvoice
+        invoiced = FremancerTimeSheet.objects.create(
+            contract=self.contract,
+            start_date=date(2017, 7, 10),
+            total_hours=10.0,
+            total_amount=200.0,
+            user=self.freelancer
+        )
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_hours=10.0,
+            amount=200.0,
+            total_amount=206.1)
+        invoice.timesheets.add(invoiced)
+        other = User.objects.create(username='other@yahoo.com', email='other@yahoo.com')
+        UserProfile.objects.create(user=other, membership='freelancer')
+        other_contract = FremancerContract.objects.create(
+            hirer=self.hirer, freelancer=other, description='Other', duration='short',
+            contract_type='hourly', hourly_rate=10.0)
+        FremancerTimeSheet.objects.create(
+            contract=other_contract, start_date=date(2017, 7, 3), total_hours=5.0, user=other)
+        # Membership and the timesheets, totalled from the rows.
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/timesheets/unpaid/?totals=true')
+        data = response.json()
+        self.assertEqual([timesheet.get('id') for timesheet in data.get('results')], [self.timesheet.id])
+        self.assertEqual((data.get('count'), data.get('total_hours'), data.get('total_amount')), (1, 20.0, 400.0))
+        # The hirer sees unpaid timesheets of every contract, filterable by contract.
+        self.client.force_authenticate(user=self.hirer)
+        response = self.client.get('/api/timesheets/unpaid/?contract=%s' % self.contract.id)
+        self.assertEqual([timesheet.get('id') for timesheet in response.json()], [self.timesheet.id])
+
+    def test_billing_status(self):
+        """Test billing status follows the invoices covering a timesheet."""
+        from fremancer_invoices.models import FremancerInvoice
+        self.assertEqual(self.timesheet.status(), 'In Progress')
+        invoice = FremancerInvoice.objects.create(
+            hirer=self.hirer,
+            freelancer=self.freelancer,
+            contract=self.contract,
+            total_hours=20.0,
+            amount=400.0,
+        )
+        invoice.timesheets.add(self.timesheet)
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual(timesheet.status(), 'Invoiced')
+        self.assertFalse(timesheet.is_editable())
+        invoice.paid = True
+        invoice.save()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual(timesheet.status(), 'Paid')
+        invoice.timesheets.clear()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual(timesheet.status(), 'In Progress')
+        # Deleting the invoice releases its timesheets.
+        invoice.timesheets.add(self.timesheet)
+        invoice.delete()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual(timesheet.status(), 'In Progress')
+        self.assertTrue(timesheet.is_editable())
+
+    def test_hirer_denormalized(self):
+        """Test timesheets carry the hirer of their contract, backfilled by command."""
+        self.assertEqual(self.timesheet.hirer, self.hirer)
+        FremancerTimeSheet.objects.update(hirer=None)
+        with open(os.devnull, 'w') as devnull:
+            call_command('sync_billing_status', stdout=devnull)
+        self.assertEqual(FremancerTimeSheet.objects.get(pk=self.timesheet.pk).hirer, self.hirer)
+        self.client.force_authenticate(user=self.hirer)
+        response = self.client.get('/api/timesheets/')
+        self.assertEqual([timesheet.get('id') for timesheet in response.json().get('results')], [self.timesheet.id])
+
+    def test_list_query_count(self):
+        """Test listing timesheets costs the same regardless of row count."""
+        for week in range(1, 6):
+            FremancerTimeSheet.objects.create(
+                contract=self.contract,
+                start_date=self.timesheet.start_date + timedelta(weeks=week),
+                user=self.freelancer
+            )
+        # Membership, validators, count and page.
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/timesheets/')
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(response.json().get('count'), 6)
+
+    def test_cursor_pagination(self):
+        """Test cursor pages are keyed on start date and may skip the count."""
+        for week in range(1, 6):
+            FremancerTimeSheet.objects.create(
+                contract=self.contract,
+                start_date=self.timesheet.start_date + timedelta(weeks=week),
+                user=self.freelancer
+            )
+        response = self.client.get('/api/timesheets/?pagination=cursor&page_size=2')
+        self.assertEqual(response.json().get('count'), 6)
+        start_dates = []
+        url = '/api/timesheets/?pagination=cursor&page_size=2&count=false'
+        while url:
+            # Membership, validators and the page, however deep.
+            with self.assertNumQueries(3):
+                page = self.client.get(url).json()
+            self.assertNotIn('count', page)
+            start_dates.extend(timesheet.get('start_date') for timesheet in page.get('results'))
+            url = page.get('next')
+        self.assertEqual(len(start_dates), 6)
+        self.assertEqual(start_dates, sorted(start_dates, reverse=True))
+
+    def test_get_daily_sheets_bulk(self):
+        """Test daily sheets are materialized with a single bulk insert."""
+        from fremancer_timesheets.views import TimeSheetsViewSet
+        FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 4),
+            hours=5.5,
+            user=self.freelancer
+        )
+        view = TimeSheetsViewSet()
+        # Read existing days, insert the missing ones and read them back.
+        with self.assertNumQueries(5):
+            daily_sheets = view.get_daily_sheets(self.freelancer, self.timesheet)
+        self.assertEqual([sheet.report_date.day for sheet in daily_sheets], list(range(3, 10)))
+        self.assertEqual(daily_sheets[1].hours, 5.5)
+        self.assertTrue(all(sheet.pk for sheet in daily_sheets))
+        # Once the week exists it costs one read.
+        with self.assertNumQueries(1):
+            view.get_daily_sheets(self.freelancer, self.timesheet)
+
+    def test_retrieve_read_only(self):
+        """Test retrieving a timesheet writes nothing and links weeks by key."""
+        # Membership, validators, timesheet with contract and users, daily sheets.
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/timesheets/%s/' % self.timesheet.id)
+        self.assertEqual(response.status_code, 200, response)
+        data = response.json()
+        self.assertEqual(len(data.get('daily_sheets')), 7)
+        self.assertEqual(data.get('next_timesheet'), '%s_2017-07-10' % self.contract.id)
+        self.assertEqual(FremancerTimeSheet.objects.count(), 1)
+        self.assertEqual(FremancerDailySheet.objects.count(), 0)
+
+    def test_retrieve_and_write_virtual_week(self):
+        """Test a week key reads virtually and is created on first write."""
+        week_key = '%s_2017-07-10' % self.contract.id
+        response = self.client.get('/api/timesheets/%s/' % week_key)
+        self.assertEqual(response.status_code, 200, response)
+        data = response.json()
+        self.assertIsNone(data.get('id'))
+        self.assertEqual(data.get('start_date'), '2017-07-10')
+        self.assertEqual(data.get('next_timesheet'), '%s_2017-07-17' % self.contract.id)
+        self.assertEqual(FremancerTimeSheet.objects.count(), 1)
+        response = self.client.patch('/api/timesheets/%s/' % week_key, {
+            'summary': 'Second week'
+        })
+        self.assertEqual(response.status_code, 200, response)
+        timesheet = FremancerTimeSheet.objects.get(contract=self.contract, start_date=date(2017, 7, 10))
+        self.assertEqual(timesheet.summary, 'Second week')
+        self.assertEqual(timesheet.user, self.freelancer)
+        self.assertEqual(FremancerDailySheet.objects.filter(timesheet=timesheet).count(), 7)
+        # Existing weeks resolve by key too.
+        response = self.client.get('/api/timesheets/%s/' % week_key)
+        self.assertEqual(response.json().get('id'), timesheet.id)
+        response = self.client.get('/api/timesheets/%s_2017-07-11/' % self.contract.id)
+        self.assertEqual(response.status_code, 404, response)
+
+    def test_write_virtual_week_invalid(self):
+        """Test a week key write that fails creates nothing."""
+        week_key = '%s_2017-07-17' % self.contract.id
+        response = self.client.put('/api/timesheets/%s/' % week_key, {'summary': 'Third week'})
+        self.assertEqual(response.status_code, 400, response)
+        self.assertIn('user', response.json())
+        # Only the freelancer of the contract starts its weeks.
+        self.client.force_authenticate(user=self.hirer)
+        response = self.client.patch('/api/timesheets/%s/' % week_key, {'summary': 'Third week'})
+        self.assertEqual(response.status_code, 404, response)
+        response = self.client.put('/api/dailysheets/%s_2017-07-18/' % self.contract.id, {'hours': 5})
+        self.assertEqual(response.status_code, 404, response)
+        self.client.force_authenticate(user=self.freelancer)
+        response = self.client.put('/api/dailysheets/%s_2017-07-18/' % self.contract.id, {'hours': 50})
+        self.assertEqual(response.status_code, 400, response)
+        self.assertFalse(FremancerTimeSheet.objects.filter(start_date=date(2017, 7, 17)).exists())
+        self.assertFalse(FremancerDailySheet.objects.exists())
+
+    def test_write_virtual_day(self):
+        """Test a day not written yet is saved by key, creating its week."""
+        response = self.client.get('/api/timesheets/%s_2017-07-10/' % self.contract.id)
+        tuesday = response.json().get('daily_sheets')[1]
+        self.assertEqual(tuesday.get('id'), '%s_2017-07-11' % self.contract.id)
+        response = self.client.put('/api/dailysheets/%s/' % tuesday.get('id'), {
+            'report_date': '2017-07-11',
+            'hours': 5,
+            'summary': 'Tuesday',
+            'timesheet': '',
+            'user': self.freelancer.id
+        })
+        self.assertEqual(response.status_code, 200, response)
+        timesheet = FremancerTimeSheet.objects.get(contract=self.contract, start_date=date(2017, 7, 10))
+        self.assertEqual(response.json().get('timesheet'), timesheet.id)
+        self.assertEqual(FremancerDailySheet.objects.filter(timesheet=timesheet).count(), 7)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (5, 100))
+        # The same key updates the day once it exists.
+        response = self.client.patch('/api/dailysheets/%s/' % tuesday.get('id'), {'hours': 6})
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(FremancerTimeSheet.objects.get(pk=timesheet.pk).total_hours, 6)
+        response = self.client.get('/api/dailysheets/%s/' % tuesday.get('id'))
+        self.assertEqual(response.json().get('summary'), 'Tuesday')
+        # Only the freelancer of the contract writes its days.
+        self.client.force_authenticate(user=self.hirer)
+        response = self.client.put('/api/dailysheets/%s_2017-07-12/' % self.contract.id, {
+            'report_date': '2017-07-12',
+            'hours': 5
+        })
+        self.assertEqual(response.status_code, 404, response)
+
+    def test_bulk_upsert_daily_sheets(self):
+        """Test a week of daily sheets is written at once with its totals."""
+        FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 3),
+            hours=4,
+            summary='Monday',
+            user=self.freelancer
+        )
+        other_week = FremancerTimeSheet.objects.create(
+            contract=self.contract,
+            start_date=date(2017, 7, 10),
+            user=self.freelancer
+        )
+        days = [{
+            'timesheet': self.timesheet.id,
+            'report_date': (date(2017, 7, 3) + timedelta(days)).isoformat(),
+            'hours': 5,
+            'summary': 'Day %s' % days
+        } for days in range(5)]
+        days.append({'timesheet': other_week.id, 'report_date': '2017-07-11', 'hours': 8})
+        response = self.client.post('/api/dailysheets/bulk/', {'daily_sheets': days}, format='json')
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual([
+            (timesheet.get('id'), timesheet.get('total_hours'), timesheet.get('total_amount'))
+            for timesheet in response.json().get('timesheets')
+        ], [(self.timesheet.id, '25.00', '500.00'), (other_week.id, '8.00', '160.00')])
+        monday = FremancerDailySheet.objects.get(timesheet=self.timesheet, report_date=date(2017, 7, 3))
+        self.assertEqual(monday.hours, 5)
+        self.assertEqual(monday.summary, 'Day 0')
+        self.assertEqual(FremancerDailySheet.objects.filter(timesheet=self.timesheet).count(), 5)
+        self.assertEqual(FremancerTimeSheet.objects.get(pk=self.timesheet.pk).total_hours, 25)
+        # The week would go over the maximum hours, nothing is written.
+        days = [{'timesheet': self.timesheet.id, 'report_date': '2017-07-08', 'hours': 6}]
+        response = self.client.post('/api/dailysheets/bulk/', {'daily_sheets': days}, format='json')
+        self.assertEqual(response.status_code, 400, response)
+        self.assertFalse(FremancerDailySheet.objects.filter(report_date=date(2017, 7, 8)).exists())
+        # Days out of the week are refused.
+        days = [{'timesheet': self.timesheet.id, 'report_date': '2017-07-10', 'hours': 1}]
+        response = self.client.post('/api/dailysheets/bulk/', {'daily_sheets': days}, format='json')
+        self.assertEqual(response.status_code, 400, response)
+
+    def test_bulk_upsert_concurrent_insert(self):
+        """Test a day created by another request after validation is a conflict, not an error."""
+        validate = DailySheetsUpsertSerializer.__dict__['validate']
+
+        def validate_then_insert(serializer, data):
+            data = validate(serializer, data)
+            FremancerDailySheet.objects.create(
+                timesheet=self.timesheet,
+                report_date=date(2017, 7, 4),
+                hours=3,
+                user=self.freelancer
+            )
+            return data
+
+        days = [{'timesheet': self.timesheet.id, 'report_date': '2017-07-04', 'hours': 5}]
+        DailySheetsUpsertSerializer.validate = validate_then_insert
+        try:
+            response = self.client.post('/api/dailysheets/bulk/', {'daily_sheets': days}, format='json')
+        finally:
+            DailySheetsUpsertSerializer.validate = validate
+        self.assertEqual(response.status_code, 409, response)
+        self.assertFalse(FremancerDailySheet.objects.filter(report_date=date(2017, 7, 4)).exists())
+        response = self.client.post('/api/dailysheets/bulk/', {'daily_sheets': days}, format='json')
+        self.assertEqual(response.status_code, 200, response)
+        self.assertEqual(FremancerDailySheet.objects.get(report_date=date(2017, 7, 4)).hours, 5)
+
+    def test_daily_hours_roll_up(self):
+        """Test daily sheet changes update the timesheet totals by delta."""
+        FremancerTimeSheet.objects.filter(pk=self.timesheet.pk).update(total_hours=0, total_amount=0)
+        sheet = FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 3),
+            hours=5,
+            user=self.freelancer
+        )
+        FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 4),
+            hours=2.5,
+            user=self.freelancer
+        )
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (7.5, 150))
+        sheet = FremancerDailySheet.objects.get(pk=sheet.pk)
+        sheet.hours = 8
+        # Savepoint, week and day locks, the day, contract terms, the delta update
+        # and the weekly rollup update, no aggregate.
+        with self.assertNumQueries(8):
+            sheet.save()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (10.5, 210))
+        sheet.delete()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (2.5, 50))
+        # Drifted totals are repaired from the daily sheets.
+        FremancerTimeSheet.objects.filter(pk=self.timesheet.pk).update(total_hours=40, total_amount=1)
+        call_command('recompute_timesheet_totals', stdout=open(os.devnull, 'w'))
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (2.5, 50))
+        # Invoiced totals are left as billed unless asked for.
+        FremancerTimeSheet.objects.filter(pk=self.timesheet.pk).update(
+            total_hours=40, total_amount=1, billing_status=FremancerTimeSheet.INVOICED)
+        call_command('recompute_timesheet_totals', stdout=open(os.devnull, 'w'))
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (40, 1))
+        call_command('recompute_timesheet_totals', include_invoiced=True, stdout=open(os.devnull, 'w'))
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (2.5, 50))
+
+    def test_daily_hours_concurrent(self):
+        """Test edits of a day read before another one was saved apply in turn."""
+        FremancerTimeSheet.objects.filter(pk=self.timesheet.pk).update(total_hours=0, total_amount=0)
+        sheet = FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 3),
+            hours=5,
+            user=self.freelancer
+        )
+        first = FremancerDailySheet.objects.get(pk=sheet.pk)
+        second = FremancerDailySheet.objects.get(pk=sheet.pk)
+        first.hours = 6
+        first.save()
+        second.hours = 8
+        second.save()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (8, 160))
+        first.delete()
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (0, 0))
+
+    def test_invoiced_daily_sheets(self):
+        """Test the daily sheets of an invoiced timesheet can not change its totals."""
+        FremancerTimeSheet.objects.filter(pk=self.timesheet.pk).update(total_hours=0, total_amount=0)
+        sheet = FremancerDailySheet.objects.create(
+            timesheet=self.timesheet,
+            report_date=date(2017, 7, 3),
+            hours=5,
+            user=self.freelancer
+        )
+        FremancerTimeSheet.objects.filter(pk=self.timesheet.pk).update(billing_status=FremancerTimeSheet.INVOICED)
+        response = self.client.patch('/api/dailysheets/%s/' % sheet.id, {'hours': 9})
+        self.assertEqual(response.status_code, 400, response)
+        response = self.client.post('/api/dailysheets/', {
+            'report_date': '2017-07-04',
+            'hours': 7,
+            'timesheet': self.timesheet.id,
+            'user': self.freelancer.id
+        })
+        self.assertEqual(response.status_code, 400, response)
+        response = self.client.delete('/api/dailysheets/%s/' % sheet.id)
+        self.assertEqual(response.status_code, 400, response)
+        sheet = FremancerDailySheet.objects.get(pk=sheet.pk)
+        sheet.hours = 2
+        with self.assertRaises(SuspiciousOperation):
+            sheet.save()
+        with self.assertRaises(SuspiciousOperation):
+            sheet.delete()
+        FremancerTimeSheet.add_hours(self.timesheet.pk, 4)
+        timesheet = FremancerTimeSheet.objects.get(pk=self.timesheet.pk)
+        self.assertEqual((timesheet.total_hours, timesheet.total_amount), (5, 100))
+        self.assertEqual(FremancerDailySheet.objects.get(pk=sheet.pk).hours, 5)
@@ -1,38 +1,95 @@
 from datetime import timedelta, datetime
 
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from rest_framework import serializers
 from rest_framework import status
 from rest_framework import viewsets
 from rest_framework.decorators import list_route
 from rest_framework.response import Response
 
+from fremancer.conditional import ConditionalModelMixin
 from fremancer_contracts.models import FremancerContract
 from fremancer_contracts.serializers import ContractSerializer
-from fremancer_timesheets.serializers import TimeSheetSerializer, DailySheetSerializer
-from fremancer_timesheets.models import FremancerTimeSheet, FremancerDailySheet
-from fremancer_users.models import UserProfile
+from fremancer_timesheets.serializers import DailySheetSerializer, DailySheetsUpsertSerializer, TimeSheetSerializer
+from fremancer_timesheets.models import FremancerTimeSheet, FremancerDailySheet, validate_monday
 
+TIMESHEET_KEY_SPLIT_CHAR = '_'
 
-class TimeSheetsViewSet(viewsets.ModelViewSet):
+
+def timesheet_key(contract_id, start_date):
+    """Reference a contract week whether or not its timesheet exists yet."""
+    return '%s%s%s' % (contract_id, TIMESHEET_KEY_SPLIT_CHAR, start_date.isoformat())
+
+
+def daily_sheet_key(contract_id, report_date):
+    """Reference a contract day whether or not its daily sheet exists yet."""
+    return timesheet_key(contract_id, report_date)
+
+
+def parse_key(key):
+    """Split a week or day key into contract and date, None for a plain id."""
+    if TIMESHEET_KEY_SPLIT_CHAR not in str(key):
+        return None
+    contract_id, key_date = str(key).split(TIMESHEET_KEY_SPLIT_CHAR, 1)
+    try:
+        return int(contract_id), datetime.strptime(key_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise Http404
+
+
+def parse_timesheet_key(key):
+    """Split a week key into contract and Monday, None for a plain id."""
+    week = parse_key(key)
+    if week is not None:
+        try:
+            validate_monday(week[1])
+        except ValidationError:
+            raise Http404
+    return week
+
+
+def materialize_week(contract, start_date):
+    """Get or create the timesheet of a contract week and its daily sheets."""
+    timesheet, created = FremancerTimeSheet.objects.get_or_create(
+        contract=contract,
+        start_date=start_date,
+        defaults={'user': contract.freelancer}
+    )
+    return timesheet, TimeSheetsViewSet.get_daily_sheets(contract.freelancer, timesheet)
+
+
+class TimeSheetsViewSet(ConditionalModelMixin, viewsets.ModelViewSet):
     """API endpoint for contracts handlers."""
     queryset = FremancerTimeSheet.objects.all().order_by('-date_changed')
     serializer_class = TimeSheetSerializer
     filter_fields = ('contract', 'user')
+    cursor_ordering = ('-start_date', '-id')
+    last_modified_fields = ('date_changed', 'contract__date_changed')
     DAYS_IN_WEEK = 7
 
     def get_queryset(self):
         """Pre filter queryset."""
-        profile = UserProfile.objects.get(user=self.request.user)
-        if profile.is_freelancer():
-            return FremancerTimeSheet.objects.filter(user=self.request.user).order_by('-date_changed')
+        qs = FremancerTimeSheet.objects.select_related('contract')
+        if self.request.membership == 'freelancer':
+            return qs.filter(user=self.request.user).order_by('-date_changed')
         else:
-            contracts = FremancerContract.objects.filter(hirer=self.request.user)
-            return FremancerTimeSheet.objects.filter(contract__in=contracts)
+            return qs.filter(hirer=self.request.user)
 
     def retrieve(self, request, pk):
-        """Retrieve an instance."""
-        qs = self.get_queryset()
-        timesheet = get_object_or_404(qs, pk=pk)
+        """Retrieve an instance without writing anything."""
+        if parse_timesheet_key(pk) is None:
+            # The week links move with the current date.
+            response = self.not_modified(
+                request, self.get_queryset().filter(pk=pk),
+                fields=self.last_modified_fields + ('fremancerdailysheet__date_changed',),
+                key=datetime.now().date(), counts=('fremancerdailysheet',))
+            if response is not None:
+                return response
+        timesheet = self.lookup_timesheet(pk)
         freelancer = timesheet.contract.freelancer
         hirer = timesheet.contract.hirer
         if self.request.user not in [freelancer, hirer]:
@@ -44,41 +101,107 @@ class TimeSheetsViewSet(viewsets.ModelViewSet):
         data['contract'] = contract_serializer.data
         # Gather Daily Sheets data.
         data['daily_sheets'] = []
-        for daily_sheet in self.get_daily_sheets(freelancer, timesheet):
-            data['daily_sheets'].append(DailySheetSerializer(daily_sheet).data)
-        # Get Reference of Previous and Next Timesheet.
+        for daily_sheet in self.get_virtual_daily_sheets(freelancer, timesheet):
+            daily_sheet_data = DailySheetSerializer(daily_sheet).data
+            if daily_sheet.pk is None:
+                # Days not written yet are saved by key, the day is created on write.
+                daily_sheet_data['id'] = daily_sheet_key(timesheet.contract_id, daily_sheet.report_date)
+            data['daily_sheets'].append(daily_sheet_data)
+        # Reference the previous and next week by key, they are created on first write.
         data['prev_timesheet'] = data['next_timesheet'] = None
-        # Get or Create Timesheet of previous week.
         prev_report_date = timesheet.start_date - timedelta(days=7)
         if prev_report_date > timesheet.contract.date_created.date():
-            prev_timesheet, created = FremancerTimeSheet.objects.get_or_create(
-                user=freelancer,
-                contract=timesheet.contract,
-                start_date=prev_report_date
-            )
-            data['prev_timesheet'] = prev_timesheet.id
-        # Get or Create Timesheet of next week.
+            data['prev_timesheet'] = timesheet_key(timesheet.contract_id, prev_report_date)
         next_report_date = timesheet.start_date + timedelta(days=7)
         if next_report_date < datetime.now().date():
-            next_timesheet, created = FremancerTimeSheet.objects.get_or_create(
-                user=freelancer,
-                contract=timesheet.contract,
-                start_date=next_report_date
-            )
-            data['next_timesheet'] = next_timesheet.id
+            data['next_timesheet'] = timesheet_key(timesheet.contract_id, next_report_date)
         return Response(data)
 
-    def get_daily_sheets(self, freelancer, timesheet):
-        """Create daily sheets for a timesheet."""
-        daily_sheets = []
+    def update(self, request, *args, **kwargs):
+        """Update a timesheet by id or week key, a week created for an invalid update is rolled back."""
+        with transaction.atomic():
+            return super(TimeSheetsViewSet, self).update(request, *args, **kwargs)
+
+    def get_object(self):
+        """Get an instance by id or week key, creating the week on write."""
+        materialize = self.action in ('update', 'partial_update')
+        timesheet = self.lookup_timesheet(self.kwargs['pk'], materialize=materialize)
+        if timesheet.pk is None:
+            raise Http404
+        self.check_object_permissions(self.request, timesheet)
+        return timesheet
+
+    def lookup_timesheet(self, pk, materialize=False):
+        """Find a timesheet by id or week key, unsaved if the week has none yet."""
+        qs = self.get_queryset().select_related(
+            'contract__freelancer', 'contract__hirer'
+        ).prefetch_related('fremancerdailysheet_set')
+        week = parse_timesheet_key(pk)
+        if week is None:
+            return get_object_or_404(qs, pk=pk)
+        contract_id, start_date = week
+        timesheet = qs.filter(contract=contract_id, start_date=start_date).first()
+        if timesheet is not None:
+            return timesheet
+        user = self.request.user
+        contracts = FremancerContract.objects.select_related('freelancer', 'hirer').filter(
+            Q(hirer=user) | Q(freelancer=user), freelancer__isnull=False)
+        if materialize:
+            # Only the freelancer of the contract starts its weeks.
+            contracts = contracts.filter(freelancer=user)
+        contract = get_object_or_404(contracts, pk=contract_id)
+        if materialize:
+            timesheet, daily_sheets = materialize_week(contract, start_date)
+            return timesheet
+        return FremancerTimeSheet(
+            contract=contract, user=contract.freelancer, hirer=contract.hirer, start_date=start_date)
+
+    def get_virtual_daily_sheets(self, freelancer, timesheet):
+        """List a week of daily sheets, leaving days not yet written unsaved."""
+        daily_sheets = {}
+        if timesheet.pk is not None:
+            daily_sheets = dict(
+                (sheet.report_date, sheet) for sheet in timesheet.fremancerdailysheet_set.all())
+        week = []
         for date_delta in range(self.DAYS_IN_WEEK):
-            instance, created = FremancerDailySheet.objects.get_or_create(
-                timesheet=timesheet,
-                report_date=timesheet.start_date + timedelta(date_delta),
-                user=freelancer
-            )
-            daily_sheets.append(instance)
-        return daily_sheets
+            report_date = timesheet.start_date + timedelta(date_delta)
+            if report_date not in daily_sheets:
+                daily_sheets[report_date] = FremancerDailySheet(
+                    timesheet=timesheet,
+                    report_date=report_date,
+                    user=freelancer
+                )
+            week.append(daily_sheets[report_date])
+        return week
+
+    @classmethod
+    def get_daily_sheets(cls, freelancer, timesheet):
+        """Create daily sheets for a timesheet."""
+        report_dates = [
+            timesheet.start_date + timedelta(date_delta)
+            for date_delta in range(cls.DAYS_IN_WEEK)
+        ]
+        qs = FremancerDailySheet.objects.filter(timesheet=timesheet, report_date__in=report_dates)
+        daily_sheets = dict((sheet.report_date, sheet) for sheet in qs)
+        missing = [
+            FremancerDailySheet(timesheet=timesheet, report_date=report_date, user=freelancer)
+            for report_date in report_dates if report_date not in daily_sheets
+        ]
+        if missing:
+            try:
+                with transaction.atomic():
+                    FremancerDailySheet.objects.bulk_create(missing)
+            except IntegrityError:
+                # A concurrent request created some of the days first.
+                for sheet in missing:
+                    try:
+                        with transaction.atomic():
+                            sheet.save(force_insert=True)
+                    except IntegrityError:
+                        pass
+            # Re-read so every instance carries its primary key.
+            daily_sheets = dict((sheet.report_date, sheet) for sheet in qs.all())
+        return [daily_sheets[report_date] for report_date in report_dates]
 
     def create(self, request):
         """Create a new timesheet with all related daily sheets."""
@@ -94,23 +217,90 @@ class TimeSheetsViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['get'])
     def unpaid(self, request):
-        """Get a list of not-invoiced timesheets."""
-        qs = FremancerTimeSheet.objects
-        if self.request.query_params.get('contract'):
-            qs = qs.filter(contract=self.request.query_params.get('contract'))
-        data = []
-        for timesheet in qs.filter(fremancer_invoice__isnull=True):
-            serializer = TimeSheetSerializer(timesheet)
-            data.append(serializer.data)
-        return Response(data)
+        """Get a list of not-invoiced timesheets, with their totals on `totals=true`."""
+        qs = self.get_queryset().filter(billing_status=FremancerTimeSheet.IN_PROGRESS)
+        if request.query_params.get('contract'):
+            qs = qs.filter(contract=request.query_params.get('contract'))
+        timesheets = list(qs.order_by('-start_date'))
+        data = TimeSheetSerializer(timesheets, many=True).data
+        if request.query_params.get('totals') != 'true':
+            return Response(data)
+        return Response({
+            'count': len(timesheets),
+            'total_hours': sum(timesheet.total_hours for timesheet in timesheets),
+            'total_amount': sum(timesheet.total_amount for timesheet in timesheets),
+            'results': data
+        })
 
 
-class DailySheetsViewSet(viewsets.ModelViewSet):
+class DailySheetsViewSet(ConditionalModelMixin, viewsets.ModelViewSet):
     """API endpoint for contracts handlers."""
     queryset = FremancerDailySheet.objects.all().order_by('-report_date')
     serializer_class = DailySheetSerializer
     filter_fields = ('timesheet', 'user')
+    cursor_ordering = ('-report_date', '-id')
 
     def get_queryset(self):
         """Pre filter queryset."""
         return FremancerDailySheet.objects.filter(user=self.request.user).order_by('-report_date')
+
+    def get_object(self):
+        """Get a daily sheet by id or day key, creating the week of the day on write."""
+        day = parse_key(self.kwargs['pk'])
+        if day is None:
+            return super(DailySheetsViewSet, self).get_object()
+        contract_id, report_date = day
+        if self.action in ('update', 'partial_update'):
+            contracts = FremancerContract.objects.select_related('freelancer')
+            contract = get_object_or_404(contracts, pk=contract_id, freelancer=self.request.user)
+            start_date = report_date - timedelta(days=report_date.weekday())
+            timesheet, daily_sheets = materialize_week(contract, start_date)
+            daily_sheet = daily_sheets[report_date.weekday()]
+        else:
+            daily_sheet = get_object_or_404(
+                self.get_queryset(), timesheet__contract=contract_id, report_date=report_date)
+        self.check_object_permissions(self.request, daily_sheet)
+        return daily_sheet
+
+    def retrieve(self, request, *args, **kwargs):
+        if parse_key(kwargs['pk']) is not None:
+            # Days by key are looked up by contract and date, without validators.
+            return super(ConditionalModelMixin, self).retrieve(request, *args, **kwargs)
+        return super(DailySheetsViewSet, self).retrieve(request, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        """Update a daily sheet by id, or by day key for a day not written yet."""
+        if parse_key(kwargs['pk']) is None:
+            return super(DailySheetsViewSet, self).update(request, *args, **kwargs)
+        with transaction.atomic():
+            # A week created for an invalid update is rolled back.
+            daily_sheet = self.get_object()
+            # The key names the day, whatever week the client sent along.
+            data = request.data.copy()
+            data['timesheet'] = daily_sheet.timesheet_id
+            data['user'] = daily_sheet.user_id
+            serializer = self.get_serializer(daily_sheet, data=data, partial=kwargs.pop('partial', False))
+            serializer.is_valid(raise_exception=True)
+            self.perform_update(serializer)
+        return Response(serializer.data)
+
+    def perform_destroy(self, instance):
+        if not instance.timesheet.is_editable():
+            raise serializers.ValidationError('Timesheet %s nolonger editable.' % instance.timesheet_id)
+        instance.delete()
+
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        """Upsert the daily sheets of whole weeks and return the week totals."""
+        serializer = DailySheetsUpsertSerializer(data=request.data, context={'user': request.user})
+        try:
+            with transaction.atomic():
+                if not serializer.is_valid():
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                timesheets = serializer.save()
+        except IntegrityError:
+            # A concurrent request created some of the days first, nothing was written.
+            return Response(
+                data={'error': 'Daily sheets changed concurrently, retry the request.'},
+                status=status.HTTP_409_CONFLICT)
+        return Response({'timesheets': TimeSheetSerializer(timesheets, many=True).data})
@@ -0,0 +1,61 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fremancer_invoices.models import FremancerInvoice
+from fremancer_users.models import UserBank, UserLedgerEntry
+from fremancer_withdrawals.models import FremancerWithdrawal
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the balance ledger from invoices and withdrawals, or only verify it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Report mismatching accounts without rewriting them.')
+        parser.add_argument('--user', type=int, help='Only process this user id.')
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(pk__in=self.account_ids()).order_by('pk')
+        if options['user']:
+            users = users.filter(pk=options['user'])
+        mismatches = 0
+        for user in users.iterator():
+            expected = self.replay(user)
+            entry = UserLedgerEntry.latest(user) or UserLedgerEntry()
+            if expected.available == entry.available and expected.balance == entry.balance:
+                continue
+            mismatches += 1
+            self.stdout.write('User %s: ledger balance %s available %s, expected %s and %s.' % (
+                user.pk, entry.balance, entry.available, expected.balance, expected.available))
+            if not options['verify']:
+                self.rebuild(user)
+        self.stdout.write('%s accounts %s.' % (
+            mismatches, 'mismatched' if options['verify'] else 'rebuilt'))
+
+    def account_ids(self):
+        invoiced = FremancerInvoice.objects.exclude(freelancer=None).values_list('freelancer', flat=True)
+        withdrawn = FremancerWithdrawal.objects.values_list('freelancer', flat=True)
+        recorded = UserLedgerEntry.objects.values_list('user', flat=True)
+        return set(invoiced) | set(withdrawn) | set(recorded)
+
+    def replay(self, user):
+        """Compute the snapshot an up to date ledger would hold."""
+        snapshot = UserLedgerEntry(total_earned=0, total_pending=0, total_withdrawn=0)
+        for invoice in FremancerInvoice.objects.filter(freelancer=user).iterator():
+            snapshot.total_earned += invoice.amount
+            if not invoice.paid or invoice.pending:
+                snapshot.total_pending += invoice.amount
+        for withdrawal in FremancerWithdrawal.objects.filter(freelancer=user, cancel=False).iterator():
+            snapshot.total_withdrawn += withdrawal.total_amount
+        return snapshot
+
+    @transaction.atomic
+    def rebuild(self, user):
+        """Replace an account history with one entry per invoice and withdrawal."""
+        UserLedgerEntry.objects.filter(user=user).delete()
+        UserBank.objects.filter(user=user).update(balance=0, available=0)
+        records = list(FremancerInvoice.objects.filter(freelancer=user))
+        records += list(FremancerWithdrawal.objects.filter(freelancer=user))
+        for record in sorted(records, key=lambda record: record.date_created):
+            record.record_ledger()
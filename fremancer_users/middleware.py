@@ -0,0 +1,19 @@
+from django.utils.functional import SimpleLazyObject
+
+from fremancer_users.models import UserProfile
+
+
+class MembershipMiddleware(object):
+    """Expose the membership of the user as `request.membership`.
+
+    Resolved lazily, once per request, so that users authenticated later by
+    the REST framework get theirs too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.membership = SimpleLazyObject(
+            lambda: UserProfile.get_membership(request.user, getattr(request, 'session', None)))
+        return self.get_response(request)
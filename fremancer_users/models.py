@@ -1,10 +1,15 @@
+import time
+from decimal import Decimal
+
 from django.core.validators import RegexValidator
 from django.contrib.auth.models import User
 
-from django.db import models
+from django.db import models, transaction
 from localflavor.us import models as us_models
 
 DIGITS_ONLY_REGEX = RegexValidator('\d+')
+MEMBERSHIP_SESSION_KEY = '_membership'
+MEMBERSHIP_SESSION_TIMEOUT = 60 * 5  # Bounds staleness when the profile changes elsewhere.
 
 
 class UserProfile(models.Model):
@@ -29,6 +34,27 @@ class UserProfile(models.Model):
     def is_hirer(self):
         return self.membership == 'hirer'
 
+    @classmethod
+    def get_membership(cls, user, session=None):
+        """Membership of a user, remembered for a while in their session.
+
+        Sessions are shared by every worker. A user without a profile yet is
+        not remembered, their profile applies as soon as it is created.
+        """
+        if not user.is_authenticated():
+            return None
+        now = time.time()
+        # Sessions not stored yet, of token clients, are not started for this.
+        remember = session is not None and session.session_key is not None
+        if remember:
+            memo = session.get(MEMBERSHIP_SESSION_KEY)
+            if memo and memo[0] == user.pk and memo[2] > now:
+                return memo[1]
+        membership = cls.objects.filter(user=user).values_list('membership', flat=True).first()
+        if membership and remember:
+            session[MEMBERSHIP_SESSION_KEY] = [user.pk, membership, now + MEMBERSHIP_SESSION_TIMEOUT]
+        return membership or None
+
 
 class UserBank(models.Model):
     """Banking related information of a user."""
@@ -46,3 +72,130 @@ class UserBank(models.Model):
     iban = models.CharField(max_length=255, blank=True, null=True, validators=[DIGITS_ONLY_REGEX])
     swift = models.CharField(max_length=255, blank=True, null=True, validators=[DIGITS_ONLY_REGEX])
     stripe_customer_id = models.CharField(max_length=100, blank=True, null=True)
+
+
+class UserLedgerEntry(models.Model):
+    """An append-only money movement on a freelancer account."""
+    user = models.ForeignKey(User, related_name='ledger_entries')
+    source = models.CharField(max_length=25, choices=[
+        ['invoice', 'Invoice'],
+        ['withdrawal', 'Withdrawal']
+    ])
+    reference_id = models.PositiveIntegerField()
+    # Movement recorded by this entry.
+    earned = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+    pending = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+    withdrawn = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+    # Snapshot of the account once this entry is applied.
+    total_earned = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+    total_pending = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+    total_withdrawn = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (('user', 'source', 'reference_id'),)
+
+    @property
+    def balance(self):
+        return self.total_earned - self.total_withdrawn
+
+    @property
+    def available(self):
+        return self.balance - self.total_pending
+
+    @classmethod
+    def latest(cls, user):
+        """Get the latest snapshot of an account, None without history."""
+        return cls.objects.filter(user=user).order_by('-id').first()
+
+    @classmethod
+    def record(cls, user_id, source, reference_id, earned=0, pending=0, withdrawn=0):
+        """Append whatever a record contributes beyond what is already recorded."""
+        with transaction.atomic():
+            # Serialize writers of the same account on the bank row.
+            UserBank.objects.select_for_update().get_or_create(user_id=user_id)
+            recorded = cls.objects.filter(
+                user_id=user_id, source=source, reference_id=reference_id
+            ).aggregate(
+                earned=models.Sum('earned'),
+                pending=models.Sum('pending'),
+                withdrawn=models.Sum('withdrawn'))
+            earned = Decimal(str(earned)) - (recorded['earned'] or 0)
+            pending = Decimal(str(pending)) - (recorded['pending'] or 0)
+            withdrawn = Decimal(str(withdrawn)) - (recorded['withdrawn'] or 0)
+            if not (earned or pending or withdrawn):
+                return None
+            last = cls.latest(user_id) or cls()
+            entry = cls.objects.create(
+                user_id=user_id,
+                source=source,
+                reference_id=reference_id,
+                earned=earned,
+                pending=pending,
+                withdrawn=withdrawn,
+                total_earned=Decimal(last.total_earned) + earned,
+                total_pending=Decimal(last.total_pending) + pending,
+                total_withdrawn=Decimal(last.total_withdrawn) + withdrawn)
+            UserBank.objects.filter(user_id=user_id).update(
+                balance=models.F('balance') + earned - withdrawn,
+                available=models.F('available') + earned - withdrawn - pending)
+            return entry
+
+
+class UserPaymentSource(models.Model):
+    """A local mirror of a Stripe payment source of a user."""
+    user = models.ForeignKey(User, related_name='payment_sources')
+    stripe_source_id = models.CharField(max_length=100, unique=True)
+    object_type = models.CharField(max_length=25)
+    brand = models.CharField(max_length=100, blank=True)
+    last4 = models.CharField(max_length=4, blank=True)
+    exp = models.CharField(max_length=10, blank=True)
+    name = models.CharField(max_length=255, blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_changed = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def source_fields(cls, source):
+        """Map a Stripe card or bank account to the mirrored fields."""
+        fields = {
+            'object_type': source.get('object'),
+            'last4': source.get('last4') or '',
+        }
+        if source.get('object') == 'card':
+            fields['brand'] = source.get('brand') or ''
+            fields['exp'] = '%s/%s' % (source.get('exp_month'), source.get('exp_year'))
+            fields['name'] = source.get('name') or ''
+        else:
+            fields['brand'] = source.get('bank_name') or ''
+            fields['exp'] = ''
+            fields['name'] = source.get('account_holder_name') or ''
+        return fields
+
+    @classmethod
+    def mirror(cls, user_id, source):
+        """Create or refresh the mirror of a Stripe source."""
+        instance, _ = cls.objects.update_or_create(
+            stripe_source_id=source.get('id'),
+            defaults=dict(cls.source_fields(source), user_id=user_id))
+        return instance
+
+    @classmethod
+    def replace(cls, user_id, sources):
+        """Replace every mirrored source of a user with the given ones."""
+        with transaction.atomic():
+            source_ids = [source.get('id') for source in sources]
+            cls.objects.filter(user_id=user_id).exclude(stripe_source_id__in=source_ids).delete()
+            for source in sources:
+                cls.mirror(user_id, source)
+
+    def as_payment(self):
+        return {
+            'id': self.stripe_source_id,
+            'last4': self.last4,
+            'object': self.object_type,
+            'brand': self.brand,
+            'exp': self.exp,
+            'name': self.name
+        }
@@ -1,7 +1,10 @@
 from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
 from django.test import TestCase, Client
 from rest_framework.test import APIClient
 
+from fremancer_users.models import MEMBERSHIP_SESSION_KEY, UserProfile
+
 
 class UsersTestCase(TestCase):
     """Testing the handling of users."""
@@ -137,3 +140,29 @@ class UsersTestCase(TestCase):
         response = c.get('/api/profiles/?membership=freelancer')
         result = response.json()
         self.assertEqual(result.get('count'), 2)
+
+    def test_membership_cached(self):
+        """Test the membership is remembered in the session, not before the profile exists."""
+        user = User.objects.create(username='new@yahoo.com', email='new@yahoo.com')
+        session = SessionStore()
+        session.create()
+        self.assertIsNone(UserProfile.get_membership(user, session))
+        self.assertNotIn(MEMBERSHIP_SESSION_KEY, session)
+        profile = UserProfile.objects.create(user=user, membership='freelancer')
+        self.assertEqual(UserProfile.get_membership(user, session), 'freelancer')
+        # Any worker reading the session has it.
+        UserProfile.objects.filter(user=user).update(membership='hirer')
+        with self.assertNumQueries(0):
+            self.assertEqual(UserProfile.get_membership(user, session), 'freelancer')
+        # For a while only, and never for another user of the session.
+        session[MEMBERSHIP_SESSION_KEY][2] = 0
+        self.assertEqual(UserProfile.get_membership(user, session), 'hirer')
+        other = User.objects.get(username='test1@yahoo.com')
+        self.assertEqual(UserProfile.get_membership(other, session), 'freelancer')
+        profile.delete()
+        self.assertIsNone(UserProfile.get_membership(user, SessionStore()))
+        # Requests of a logged in user read it from their session.
+        c = APIClient()
+        c.force_login(other)
+        c.get('/api/contracts/')
+        self.assertEqual(c.session[MEMBERSHIP_SESSION_KEY][:2], [other.pk, 'freelancer'])
@@ -0,0 +1,12 @@
+import django_filters
+
+from fremancer_withdrawals.models import FremancerWithdrawal
+
+
+class WithdrawalFilter(django_filters.FilterSet):
+    created_after = django_filters.DateTimeFilter(field_name='date_created', lookup_expr='gte')
+    created_before = django_filters.DateTimeFilter(field_name='date_created', lookup_expr='lt')
+
+    class Meta:
+        model = FremancerWithdrawal
+        fields = '__all__'
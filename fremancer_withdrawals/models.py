@@ -1,10 +1,42 @@
+from decimal import Decimal
+
 from django.contrib.auth.models import User
 from django.core.validators import EmailValidator, MaxValueValidator, MinValueValidator, MinLengthValidator, RegexValidator
 from django.db import models
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from fremancer_users.models import UserLedgerEntry
 
 DIGITS_ONLY_REGEX = RegexValidator('\d+')
 
 
+class FremancerWithdrawalQuerySet(models.QuerySet):
+
+    def summary(self):
+        """Aggregate withdrawn amounts per status in a single grouped query."""
+        groups = self.order_by().values('status', 'cancel').annotate(
+            count=models.Count('pk'),
+            total=models.Sum('total_amount'))
+        summary = {
+            'count': 0,
+            'total': Decimal(0),
+            'cancelled': Decimal(0),
+            'by_status': {}
+        }
+        for group in groups:
+            total = group['total'] or Decimal(0)
+            summary['count'] += group['count']
+            if group['cancel']:
+                summary['cancelled'] += total
+            else:
+                summary['total'] += total
+            by_status = summary['by_status'].setdefault(group['status'], {'count': 0, 'total': Decimal(0)})
+            by_status['count'] += group['count']
+            by_status['total'] += total
+        return summary
+
+
 class FremancerWithdrawal(models.Model):
     """A model for freelancer to withdraw money."""
     MAX_INVOICE_AMOUNT = 5000  # One thousand USD.
@@ -61,3 +93,26 @@ class FremancerWithdrawal(models.Model):
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_changed = models.DateTimeField(auto_now=True)
+
+    objects = FremancerWithdrawalQuerySet.as_manager()
+
+    class Meta:
+        # Per user lists, newest first.
+        index_together = (('freelancer', 'date_created'),)
+
+    def record_ledger(self):
+        """Record the withdrawn amount, nothing once cancelled."""
+        withdrawn = 0 if self.cancel else self.total_amount
+        return UserLedgerEntry.record(
+            self.freelancer_id, 'withdrawal', self.pk, withdrawn=withdrawn)
+
+    def save(self, *args, **kwargs):
+        super(FremancerWithdrawal, self).save(*args, **kwargs)
+        self.record_ledger()
+
+
+@receiver(pre_delete, sender=FremancerWithdrawal)
+def withdrawal_deleting(sender, instance, **kwargs):
+    """Reverse whatever a deleted withdrawal recorded in the ledger."""
+    # Before the delete, in its transaction, while the account still exists.
+    UserLedgerEntry.record(instance.freelancer_id, 'withdrawal', instance.pk)
@@ -1,11 +1,14 @@
+import os
 from datetime import date
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase, Client
 from rest_framework.test import APIClient
 
-from fremancer_users.models import UserProfile, UserBank
+from fremancer_users.models import UserProfile, UserBank, UserLedgerEntry
 from fremancer_invoices.models import FremancerInvoice
 from fremancer_contracts.models import FremancerContract
+from fremancer_withdrawals.models import FremancerWithdrawal
 
 
 class WithdrawalsTestCase(TestCase):
@@ -31,6 +34,7 @@ class WithdrawalsTestCase(TestCase):
             'fee': 5.0,
             'total_amount': 205.0,
             'method': 'wu',
+            'receive_method': 'cash',
             'first_name': 'Test',
             'last_name': 'Freelancer',
             'email': self.freelancer.email,
@@ -123,3 +127,61 @@ class WithdrawalsTestCase(TestCase):
         self.assertEqual(withdrawal.get('balance'), 338.0)
         self.assertEqual(withdrawal.get('available'), 138.0)
         self.assertEqual(withdrawal.get('pending'), 200.0)
+
+    def test_ledger_cancel_withdrawal(self):
+        """Test cancelling a withdrawal appends a reversing entry."""
+        self.create_test_invoice()
+        r = self.client.post('/api/withdrawals/', self.withdraw_form)
+        self.assertEqual(r.status_code, 201)
+        withdrawal = FremancerWithdrawal.objects.get(pk=r.json().get('id'))
+        withdrawal.cancel = True
+        withdrawal.save()
+        entries = UserLedgerEntry.objects.filter(user=self.freelancer).order_by('id')
+        self.assertEqual([entry.withdrawn for entry in entries], [0, 205, -205])
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/withdrawals/balance/')
+        self.assertEqual(response.json().get('balance'), 200.0)
+        self.assertEqual(response.json().get('withdrawal'), 0.0)
+
+    def test_ledger_delete(self):
+        """Test deleting a withdrawal or an invoice appends a reversing entry."""
+        invoice = self.create_test_invoice()
+        r = self.client.post('/api/withdrawals/', self.withdraw_form)
+        FremancerWithdrawal.objects.get(pk=r.json().get('id')).delete()
+        account = UserLedgerEntry.latest(self.freelancer)
+        self.assertEqual((account.withdrawn, account.balance, account.available), (-205, 200, 200))
+        invoice.delete()
+        account = UserLedgerEntry.latest(self.freelancer)
+        self.assertEqual((account.earned, account.balance, account.available), (-200, 0, 0))
+        self.assertEqual(UserBank.objects.get(user=self.freelancer).balance, 0)
+        # Deleting the freelancer takes the whole ledger along.
+        self.create_test_invoice()
+        self.freelancer.delete()
+        self.assertFalse(UserLedgerEntry.objects.exists())
+        self.assertFalse(UserBank.objects.exists())
+
+    def test_rebuild_ledger(self):
+        """Test the ledger command repairs accounts out of sync."""
+        invoice = self.create_test_invoice()
+        FremancerInvoice.objects.filter(pk=invoice.pk).update(amount=300)
+        with open(os.devnull, 'w') as devnull:
+            call_command('rebuild_ledger', verify=True, stdout=devnull)
+            self.assertEqual(UserLedgerEntry.latest(self.freelancer).balance, 200)
+            call_command('rebuild_ledger', stdout=devnull)
+        self.assertEqual(UserLedgerEntry.latest(self.freelancer).balance, 300)
+        self.assertEqual(UserBank.objects.get(user=self.freelancer).available, 300)
+
+    def test_withdrawal_summary(self):
+        """Test the summary is aggregated in the database."""
+        self.client.post('/api/withdrawals/', self.withdraw_form)
+        self.client.post('/api/withdrawals/', self.withdraw_form)
+        FremancerWithdrawal.objects.filter(pk=FremancerWithdrawal.objects.last().pk).update(
+            cancel=True, status='cancelled')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/withdrawals/summary/')
+        summary = response.json()
+        self.assertEqual(summary.get('total'), 205.0)
+        self.assertEqual(summary.get('cancelled'), 205.0)
+        self.assertEqual(summary.get('by_status').get('submitted').get('count'), 1)
+        response = self.client.get('/api/withdrawals/summary/?created_after=2100-01-01')
+        self.assertEqual(response.json().get('count'), 0)